@@ -1,101 +1,53 @@
+import functools
+import json
 import pathlib
-import subprocess
+import sqlite3
 import streamlit as st
 import sys
 from st_aggrid import AgGrid, GridOptionsBuilder
-import seaborn as sns
-import matplotlib.pyplot as plt
-import scipy.stats as stats
-import pandas as pd
 
 
 sys.path.append(str(pathlib.Path(__file__).resolve().parent.parent))
 
-from scripts.utils import query_df, get_connection, run_sql, CELL_TYPES, BASE_DIR  # noqa: E402
-
-# dynamically build the table w/ all cell types
-sql_cell_types = [
-    f"MAX(CASE WHEN cell_counts.cell_type = '{cell_type}' THEN cell_counts.count ELSE NULL END) AS {cell_type}"
-    for cell_type in CELL_TYPES]
-
-sql_query_samples = f'''
-    SELECT
-        projects.project_id,
-        subjects.subject_id,
-        subjects.condition,
-        subjects.age,
-        subjects.sex,
-        treatments.treatment_id,
-        samples.response,
-        samples.sample_id,
-        samples.sample_type,
-        samples.time_from_treatment_start,
-        {",\n".join(sql_cell_types)}
-    FROM
-        projects
-    JOIN subjects ON projects.project_id = subjects.project_id
-    JOIN samples ON subjects.subject_id = samples.subject_id
-    LEFT JOIN treatments ON samples.treatment_id = treatments.treatment_id
-    LEFT JOIN cell_counts ON samples.sample_id = cell_counts.sample_id
-    GROUP BY
-        samples.sample_id
-    ORDER BY
-        projects.project_id ASC
-'''
-
-sql_query_frequencies = '''
-        SELECT
-            cell_counts.sample_id,
-            cell_counts.cell_type AS population,
-            cell_counts.count,
-            totals.total_count,
-            100.0 * cell_counts.count / totals.total_count AS relative_frequency
-        FROM
-            cell_counts
-        JOIN (
-            SELECT sample_id,
-                   SUM(count) AS total_count
-            FROM cell_counts
-            GROUP BY sample_id
-        ) totals ON cell_counts.sample_id = totals.sample_id
-    '''
-
-sql_query_rich_frequencies = '''
-        SELECT
-            samples.sample_id,
-            samples.subject_id,
-            subjects.condition,
-            subjects.age,
-            subjects.sex,
-            samples.treatment_id,
-            samples.response,
-            samples.sample_type,
-            samples.time_from_treatment_start,
-            projects.project_id,
-            cell_counts.cell_type AS population,
-            cell_counts.count AS count,
-            total.total_count,
-            100.0 * cell_counts.count / total.total_count AS relative_frequency
-        FROM
-            samples
-        JOIN subjects ON samples.subject_id = subjects.subject_id
-        JOIN projects ON subjects.project_id = projects.project_id
-        LEFT JOIN treatments ON samples.treatment_id = treatments.treatment_id
-        JOIN cell_counts ON samples.sample_id = cell_counts.sample_id
-        JOIN (
-            SELECT
-                sample_id,
-                SUM(count) AS total_count
-            FROM
-                cell_counts
-            GROUP BY
-                sample_id
-        ) AS total ON samples.sample_id = total.sample_id
-        ORDER BY
-            samples.sample_id ASC, cell_counts.cell_type ASC
-'''
+from scripts.utils import (query_df, connection, run_sql, make_temp_db_path, replace_database, data_version,  # noqa: E402
+                           CELL_TYPES)
+from scripts.background import LoadJob  # noqa: E402
+from scripts.queries import (CUBE_FILTERS, CUBE_POPULATION_ROWS, CUBE_SAMPLE_ROWS, PAGED_QUERIES,  # noqa: E402
+                             sql_query_cube_population_moments, sql_query_cube_sample_summary,
+                             sql_query_cube_samples_per_project, sql_query_response_frequencies,
+                             sql_query_sample_summary, sql_query_samples_per_project, sql_query_subject_count,
+                             sql_query_subject_trajectory, sql_query_trajectory_summary, TRAJECTORY_ROWS)
+from scripts.pivot import add_cell_counts  # noqa: E402
+from scripts.paging import PAGE_SIZES, fetch_page, count_filtered_rows  # noqa: E402
+from scripts.filters import filter_where, where_clause  # noqa: E402
+from scripts.snapshot import read_manifest, snapshot_frame, snapshot_version  # noqa: E402
+from scripts.bulk import delete_matching, delete_rows, import_samples, read_import_file  # noqa: E402
+from scripts.load_data import refresh_trajectories  # noqa: E402
+from scripts.profiling import (current_run, export_jsonl, finish_run, history, query_plan, stage,  # noqa: E402
+                               stage_summary, start_run)
+# scripts.plots and scripts.analytics are imported where they're used, since matplotlib, seaborn and scipy
+# take a while to load and only the Samples page's analyses need them
+
+
+def fragment(func):
+    """
+    st.fragment: interacting with a widget inside func reruns only func, not the whole page.
+    Profiled as a stage of the page, or as a run of its own when it reruns by itself (see scripts.profiling).
+    """
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        if current_run() is None and st.session_state.get("profiler"):
+            start_run(f"fragment: {func.__name__}")
+            try:
+                return func(*args, **kwargs)
+            finally:
+                finish_run()
+        with stage(func.__name__):
+            return func(*args, **kwargs)
+    return st.fragment(run)
 
 
+@fragment
 def show_add_sample_form():
     with st.expander("**Add new sample**", expanded=False):
         with st.form("add_sample_form"):
@@ -136,7 +88,7 @@ def show_add_sample_form():
 
             if st.session_state.cell_count_rows < len(CELL_TYPES) and st.form_submit_button("Add another cell count", icon="➕"):
                 st.session_state.cell_count_rows += 1
-                st.rerun()
+                st.rerun(scope="fragment")
 
             if st.form_submit_button("Submit entry", icon="➕"):
                 errors = []
@@ -170,19 +122,17 @@ def show_add_sample_form():
                             response,
                             sample_type
                         )
-                        conn = get_connection()
-                        cursor = conn.cursor()
-                        cursor.execute(insert_sample_sql, params)
-
-                        for cell_type, count in cell_count_inputs:
-                            insert_cell_counts_sql = """
-                                INSERT INTO cell_counts (sample_id, cell_type, count)
-                                VALUES (?, ?, ?)
-                            """
-                            cursor.execute(insert_cell_counts_sql, (sample_id, cell_type, count))
-
-                        conn.commit()
-                        conn.close()
+                        with connection() as conn:
+                            cursor = conn.cursor()
+                            cursor.execute(insert_sample_sql, params)
+
+                            for cell_type, count in cell_count_inputs:
+                                insert_cell_counts_sql = """
+                                    INSERT INTO cell_counts (sample_id, cell_type, count)
+                                    VALUES (?, ?, ?)
+                                """
+                                cursor.execute(insert_cell_counts_sql, (sample_id, cell_type, count))
+                            refresh_trajectories(cursor)
 
                         st.session_state.add_success = True
                         st.rerun()
@@ -195,6 +145,31 @@ def show_add_sample_form():
                 st.session_state.add_success = False
 
 
+@fragment
+def show_bulk_import_form():
+    with st.expander("**Bulk import samples**", expanded=False):
+        if message := st.session_state.pop("import_success", None):
+            st.success(message)
+        st.write("A CSV or Parquet file with the same columns as cell-count.csv. Samples are imported all together, "
+                 "or not at all if any row has a problem.")
+        upload = st.file_uploader("Samples file", type=["csv", "parquet"])
+        if upload is not None and st.button("Import samples", icon="📥"):
+            try:
+                df = read_import_file(upload, upload.name)
+                written, problems = import_samples(df)
+            except Exception as e:
+                st.error(f"Failed to import samples: {e}")
+                return
+            if problems.empty:
+                # the whole page, so the tables and analyses include the new samples
+                st.session_state.import_success = f"Imported {len(df)} samples ({written} rows)."
+                st.rerun()
+            else:
+                st.error(f"Found {len(problems)} problem(s) in {problems['Row'].nunique()} row(s); nothing was imported.")
+                st.dataframe(problems, hide_index=True)
+
+
+@fragment
 def show_add_project_form():
     with st.expander("**Add new project**", expanded=False):
         with st.form("add_project_form"):
@@ -217,6 +192,7 @@ def show_add_project_form():
                 st.session_state.add_success = False
 
 
+@fragment
 def show_add_subject_form():
     with st.expander("**Add new subject**", expanded=False):
         with st.form("add_subject_form"):
@@ -258,6 +234,7 @@ def show_add_subject_form():
                 st.session_state.add_success = False
 
 
+@fragment
 def show_add_treatment_form():
     with st.expander("**Add new treatment**", expanded=False):
         with st.form("add_treatment_form"):
@@ -280,28 +257,366 @@ def show_add_treatment_form():
                 st.session_state.add_success = False
 
 
+@st.cache_resource
+def get_load_jobs():
+    """Shared by every session, so only one load runs at a time and everyone sees its progress."""
+    return {"current": None}
+
+
+def show_load_status():
+    job = get_load_jobs()["current"]
+    if job is None:
+        return
+    if job.running:
+        st.progress(job.progress, text=job.message)
+        return
+
+    if job.succeeded:
+        st.success("Reloaded successfully!")
+        st.caption("".join(job.output))
+    else:
+        st.error(f"Failed to run load_data.py:\n{''.join(job.output)}")
+
+    # rerun the whole page once so its tables pick up the new data
+    if st.session_state.seen_load_job is not job:
+        st.session_state.seen_load_job = job
+        st.rerun()
+
+
+@st.cache_data(max_entries=16, show_spinner="Resampling...")
+def cached_resampling(source, _df, n_resamples, seed):
+    """Seeded resampling results for _df, kept for as long as source (see filtered_frequencies) stays the same."""
+    from scripts.analytics import resampling_by_population
+    return resampling_by_population(_df, n_resamples, seed)
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def cached_box_plot(source, _df):
+    """The box plot of _df, rendered once per source (see filtered_frequencies)."""
+    from scripts.plots import box_plot_png
+    return box_plot_png(_df[_df['response'].isin(['y', 'n'])], xlabel="Cell Population",
+                        ylabel="Relative Frequency (%)", title="Relative Frequencies: Responders vs Non-Responders")
+
+
+def filtered_frequencies(use_snapshot):
+    """
+    The frequencies the analyses run on, filtered like the Frequencies grid, read either from the database or
+    from the memory-mapped snapshot. Also returns what they were read from (the query or snapshot, the filters
+    and the data's version), which the cached results above are keyed on instead of hashing the rows.
+    """
+    paged_query = PAGED_QUERIES["Frequencies"]
+    where, params = grid_filters("Frequencies", paged_query)
+    if use_snapshot:
+        # no conditions means no filters, or filters that can't be applied, which grid_filters() drops
+        filter_model = st.session_state.grid_filters.get("Frequencies") if where else None
+        df = snapshot_frame("frequencies", ["population", "response", "relative_frequency"], filter_model,
+                            paged_query["filters"])
+        return df, ("snapshot", json.dumps(filter_model, sort_keys=True), snapshot_version())
+    freq_query = sql_query_response_frequencies.format(where=where_clause(where))
+    return query_df(freq_query, params), (freq_query, tuple(params), data_version())
+
+
+def show_profiler(profile):
+    """Where this run's time went: each stage, the slowest queries with their plans, and an export of past runs."""
+    cached = sum(query['cached'] for query in profile.queries)
+    st.markdown(f"**This run took {profile.seconds:.3f}s**")
+    st.caption(f"{len(profile.queries)} queries ({cached} from cache), {profile.statements} SQL statements")
+    st.dataframe([{"Stage": "· " * depth + name, "Seconds": seconds, "Queries": queries, "Rows": rows}
+                  for name, depth, seconds, queries, rows in stage_summary(profile)],
+                 hide_index=True, column_config={"Seconds": st.column_config.NumberColumn(format="%.3f")})
+
+    st.markdown("**Slowest queries**")
+    slowest = sorted((query for query in profile.queries if not query['cached']),
+                     key=lambda query: query['seconds'], reverse=True)[:PROFILER_SLOWEST]
+    for query in slowest:
+        converting = f", {query['convert_seconds']:.3f}s to DataFrame" if query['convert_seconds'] else ""
+        with st.expander(f"{query['seconds']:.3f}s, {query['rows']} rows ({query['stage'] or 'no stage'})"):
+            st.caption(f"{query['seconds'] - (query['convert_seconds'] or 0):.3f}s in SQLite{converting}")
+            st.code(query['sql'], language="sql")
+            try:
+                with connection(read_only=True) as conn:
+                    st.code("\n".join(query_plan(conn, query['sql'], query['params'])), language=None)
+            except sqlite3.Error as e:
+                st.caption(f"No plan: {e}")
+    if not slowest:
+        st.caption("Every query was served from the cache.")
+
+    st.download_button("Export profile log", export_jsonl(history()), file_name="loblaw-profile.jsonl",
+                       mime="application/x-ndjson", help="The last runs profiled in this process, as JSON Lines")
+
+
+def reset_pages(name):
+    st.session_state.page_starts[name] = [None]
+
+
+def grid_filters(name, paged_query):
+    """The WHERE conditions and params for the filters set on a grid, see scripts.filters."""
+    try:
+        return filter_where(st.session_state.grid_filters.get(name), paged_query["filters"])
+    except ValueError:
+        # reported under the grid by show_paged_grid
+        return [], []
+
+
+def cube_filters(name):
+    """
+    grid_filters() on frequency_cube's columns instead (see CUBE_FILTERS), or None if any filter set on the grid
+    is on a column the cube doesn't have, so the summary has to come from the rows.
+    """
+    try:
+        return filter_where(st.session_state.grid_filters.get(name), CUBE_FILTERS)
+    except ValueError:
+        return None
+
+
+def grid_row_count(name, paged_query):
+    """The number of rows matching the filters set on a grid, see scripts.paging.count_filtered_rows."""
+    try:
+        return count_filtered_rows(paged_query, st.session_state.grid_filters.get(name))
+    except ValueError:
+        # reported under the grid by show_paged_grid, which shows the rows unfiltered
+        return count_filtered_rows(paged_query, {})
+
+
+def show_paged_grid(name, paged_query, page_func=None, selectable=False):
+    """
+    An AgGrid table showing one page of paged_query at a time, with navigation below it.
+    Only the visible page is fetched and sent to the browser; page_func, if given, adds to the page's rows.
+    Column filters are applied in SQL, so they cover the whole table rather than the page on screen.
+    """
+    # keyset of the first row of each page visited so far, so Previous can go back
+    starts = st.session_state.page_starts.setdefault(name, [None])
+    page_size = st.session_state.get(f"page_size_{name}", PAGE_SIZES[0])
+    filter_model = st.session_state.grid_filters.get(name, {})
+    try:
+        where, params = filter_where(filter_model, paged_query["filters"])
+    except ValueError as e:
+        st.error(f"Ignoring filters: {e}")
+        where, params = [], []
+    with stage(f"{name}: fetch page"):
+        df, next_start = fetch_page(paged_query["select"], paged_query["key"], starts[-1], page_size, where, params)
+    if page_func:
+        with stage(f"{name}: {page_func.__name__}"):
+            df = page_func(df)
+
+    gb = GridOptionsBuilder.from_dataframe(df)
+    if selectable:
+        gb.configure_selection('multiple', use_checkbox=True, groupSelectsChildren=True)
+    gb.configure_default_column(filter=True, autoSize=True, resizable=True)
+    for column in df.columns.difference(list(paged_query["filters"])):
+        # e.g. the pivoted cell counts: filtering them in the browser would only filter this page
+        gb.configure_column(column, filter=False)
+    # restores the filters if the grid is rebuilt, e.g. when switching pages
+    gb.configure_grid_options(autoSizeStrategy={'type': 'fitCellContents'},
+                              initialState={"filter": {"filterModel": filter_model}})
+
+    # serializing the page for the browser
+    with stage(f"{name}: AgGrid"):
+        grid_response = AgGrid(
+            df,
+            gridOptions=gb.build(),
+            update_on=["selectionChanged", "filterChanged"],
+            theme="streamlit",
+            key=f"grid_{name}"
+        )
+
+    # the grid reports no state until the user interacts with it
+    if grid_response.grid_state is not None:
+        new_filter_model = grid_response.grid_state.get("filter", {}).get("filterModel", {})
+        if new_filter_model != filter_model:
+            st.session_state.grid_filters[name] = new_filter_model
+            reset_pages(name)
+            # the whole page, since the stats and analyses follow the grids' filters
+            st.rerun()
+
+    first_row = (len(starts) - 1) * page_size
+    with stage(f"{name}: count rows"):
+        total_rows = grid_row_count(name, paged_query)
+    cols = st.columns([1, 1, 1, 2, 2])
+    # paging only changes this grid, so only its fragment reruns
+    if cols[0].button("First", key=f"first_{name}", disabled=len(starts) == 1):
+        reset_pages(name)
+        st.rerun(scope="fragment")
+    if cols[1].button("Previous", key=f"previous_{name}", disabled=len(starts) == 1):
+        starts.pop()
+        st.rerun(scope="fragment")
+    if cols[2].button("Next", key=f"next_{name}", disabled=next_start is None):
+        starts.append(next_start)
+        st.rerun(scope="fragment")
+    cols[3].write(f"Rows {first_row + 1 if len(df) else 0}-{first_row + len(df)} of {total_rows}")
+    cols[4].selectbox("Rows per page", PAGE_SIZES, key=f"page_size_{name}", on_change=reset_pages, args=(name,),
+                      label_visibility="collapsed")
+
+    return grid_response
+
+
+@fragment
+def show_table(name, config):
+    """A page's grid and, for tables with CRUD, deleting its selected or filtered rows."""
+    grid_response = show_paged_grid(name, config["paged_query"], config.get("page_func"),
+                                    selectable=bool(config['form_func']))  # ignore checkboxes if it's a table w/o CRUD
+    if not config['form_func']:  # again, ignore deleting if no CRUD
+        return
+    selected_rows = grid_response['selected_rows']
+
+    if selected_rows is not None and not selected_rows.empty:
+        st.write(f"Selected {len(selected_rows)} row(s).")
+
+        if st.button("Delete selected rows", icon="🗑️"):
+            ids_to_delete = selected_rows[config['id_field']].tolist()
+            try:
+                deleted = delete_rows(config['table_name'], config['id_field'], ids_to_delete)
+                st.success(f"Deleted {deleted} rows successfully.")
+                st.session_state.delete_success = True
+                st.rerun()
+            except Exception as e:
+                st.error(f"Failed to delete rows: {e}")
+    else:
+        st.info("Select rows to delete.")
+        if st.session_state.delete_success:
+            st.success("Deleted rows successfully!")
+            st.session_state.delete_success = False
+
+    # every row matching the grid's filters, not just the ones selected on this page
+    if st.session_state.grid_filters.get(name):
+        where, params = grid_filters(name, config["paged_query"])
+        num_filtered = grid_row_count(name, config["paged_query"])
+        with st.expander(f"**Delete all {num_filtered} filtered rows**"):
+            confirmed = st.checkbox(f"Yes, delete all {num_filtered} rows matching the filters", key=f"confirm_{name}")
+            if st.button("Delete filtered rows", icon="🗑️", disabled=not confirmed or not num_filtered):
+                try:
+                    delete_matching(config['table_name'], config['id_field'], config["paged_query"]["select"],
+                                    where, params)
+                    st.session_state.delete_success = True
+                    reset_pages(name)
+                    st.rerun()
+                except Exception as e:
+                    st.error(f"Failed to delete rows: {e}")
+
+
+@fragment
+def show_frequencies_table():
+    show_paged_grid("Frequencies", PAGED_QUERIES["Frequencies"])
+
+
+@fragment
+def show_box_plot(freq_source, df_filtered_freq):
+    with st.expander("**Box Plot**"):
+        st.image(cached_box_plot(freq_source, df_filtered_freq), use_container_width=True)
+
+
+@fragment
+def show_stats(freq_source, df_filtered_freq):
+    """The Mann-Whitney U tests, and the resampling statistics if asked for; its widgets rerun only this section."""
+    from scripts.analytics import N_RESAMPLES, mannwhitneyu_by_population, resampling_by_population
+
+    # every population tested in one batched pass, see scripts.analytics
+    with stage("Mann-Whitney U"):
+        stat_df = mannwhitneyu_by_population(df_filtered_freq).drop(columns='U').sort_values('p-value')
+
+    if st.toggle("Permutation p-values and bootstrap CIs",
+                 help="Resampling statistics on the difference in mean relative frequency (responders minus "
+                      "non-responders). Exact when a population has few enough samples."):
+        cols = st.columns(2)
+        n_resamples = cols[0].number_input("Resamples", min_value=1000, max_value=100_000, value=N_RESAMPLES,
+                                           step=1000)
+        seed = cols[1].number_input("Seed", min_value=0, value=0, step=1, placeholder="Random",
+                                    help="Clear for different random resamples on every run.")
+        with stage("Resampling"):
+            if seed is None:
+                with st.spinner("Resampling..."):
+                    resampled = resampling_by_population(df_filtered_freq, n_resamples)
+            else:
+                resampled = cached_resampling(freq_source, df_filtered_freq, n_resamples, seed)
+        stat_df = stat_df.merge(resampled, on='Population', how='left')
+
+    st.dataframe(stat_df.style.format({'p-value': '{:.4f}', 'Permutation p-value': '{:.4f}',
+                                       'Mean difference': '{:.3f}', 'CI low': '{:.3f}', 'CI high': '{:.3f}'}))
+
+
+@fragment
+def show_trajectories(where, params):
+    """
+    Each population's change from the subjects' baselines over time, for the samples the Samples grid is
+    filtered to, and one subject's on request. The writes to samples and counts refresh the trajectories
+    they change, so this only reads; subjects changed some other way can be refreshed with the button.
+    """
+    with st.expander("**Change From Baseline**"):
+        stale = run_sql("SELECT COUNT(*) AS stale FROM stale_subjects")[0]["stale"]
+        if stale:
+            st.caption(f"{stale} subject(s) changed since their trajectories were last computed.")
+            if st.button("Refresh trajectories", icon="🔄"):
+                try:
+                    with connection() as conn:
+                        refresh_trajectories(conn.cursor())
+                    st.rerun()
+                except sqlite3.OperationalError as e:
+                    # e.g. the loader holding the write lock
+                    st.error(f"Failed to refresh trajectories: {e}")
+        summary = query_df(sql_query_trajectory_summary.format(where=where_clause([*TRAJECTORY_ROWS, *where])),
+                           params)
+        if summary.empty:
+            st.caption("No subjects with a baseline sample (time from treatment start 0) match the filters.")
+            return
+        lines = summary.assign(line=summary['population'].astype(str) + " (" + summary['response'].astype(str) + ")")
+        st.line_chart(lines.pivot_table(index='time_from_treatment_start', columns='line', values='mean_delta'),
+                      x_label="Time from treatment start", y_label="Mean change from baseline (%)")
+        st.dataframe(summary, hide_index=True, column_config={
+            column: st.column_config.NumberColumn(format="%.3f")
+            for column in ['mean_baseline', 'mean_frequency', 'mean_delta', 'fold_change']})
+
+        subject_id = st.text_input("Subject", placeholder="Subject ID", help="Show one subject's trajectories")
+        if subject_id:
+            st.dataframe(query_df(sql_query_subject_trajectory, [subject_id]), hide_index=True)
+
+
+@fragment
+def show_means(use_snapshot, df_filtered_freq):
+    """
+    Mean relative frequencies by response, with Welch's t-tests, added up from frequency_cube when the Frequencies
+    grid's filters are all on its columns, or else from the filtered frequencies.
+    """
+    from scripts.analytics import population_moments, welch_by_population
+
+    cube_where = None if use_snapshot else cube_filters("Frequencies")
+    with st.expander("**Means by Response**"):
+        if cube_where is None:
+            moments = population_moments(df_filtered_freq)
+        else:
+            conditions, params = cube_where
+            moments = query_df(sql_query_cube_population_moments.format(
+                where=where_clause([*CUBE_POPULATION_ROWS, *conditions])), params)
+        st.dataframe(welch_by_population(moments).sort_values('p-value').style.format(
+            {column: '{:.3f}' for column in ['Mean (y)', 'SD (y)', 'Mean (n)', 'SD (n)', 't']} | {'p-value': '{:.4f}'}))
+
+
+# slowest queries listed, with their plans, in the profiler panel
+PROFILER_SLOWEST = 5
+
 # a config to modularize code and allow hotswapping of tables without repeated code
 PAGE_CONFIG = {
     "Samples": {
-        "sql_query": sql_query_samples,
+        "paged_query": PAGED_QUERIES["Samples"],
+        "page_func": add_cell_counts,  # pivots cell counts into the sample rows
         "form_func": show_add_sample_form,
+        "import_func": show_bulk_import_form,
         "table_name": "samples",
         "id_field": "sample_id"
     },
     "Projects": {
-        "sql_query": "SELECT * FROM projects ORDER BY project_id ASC",
+        "paged_query": PAGED_QUERIES["Projects"],
         "form_func": show_add_project_form,
         "table_name": "projects",
         "id_field": "project_id"
     },
     "Subjects": {
-        "sql_query": "SELECT * FROM subjects ORDER BY subject_id ASC",
+        "paged_query": PAGED_QUERIES["Subjects"],
         "form_func": show_add_subject_form,
         "table_name": "subjects",
         "id_field": "subject_id"
     },
     "Treatments": {
-        "sql_query": "SELECT * FROM treatments ORDER BY treatment_id ASC",
+        "paged_query": PAGED_QUERIES["Treatments"],
         "form_func": show_add_treatment_form,
         "table_name": "treatments",
         "id_field": "treatment_id"
@@ -316,6 +631,18 @@ if 'delete_success' not in st.session_state:
 if 'add_success' not in st.session_state:
     st.session_state.add_success = False
 
+# the last finished load job this session has refreshed for
+if 'seen_load_job' not in st.session_state:
+    st.session_state.seen_load_job = get_load_jobs()["current"]
+
+# the keyset each table's visited pages start at, see show_paged_grid
+if 'page_starts' not in st.session_state:
+    st.session_state.page_starts = {}
+
+# the AgGrid filter model set on each table, applied in SQL by show_paged_grid
+if 'grid_filters' not in st.session_state:
+    st.session_state.grid_filters = {}
+
 # use session_state to keep track of how many cell types the user wants to input
 if 'cell_count_rows' not in st.session_state:
     st.session_state.cell_count_rows = 1
@@ -327,17 +654,31 @@ page = st.sidebar.radio(
     ["Samples", "Projects", "Subjects", "Treatments"]
 )
 
-if st.sidebar.button("Reload", help="Reload data from CSV", icon="🔄"):
-    try:
-        result = subprocess.run(
-            [sys.executable, BASE_DIR / "scripts" / "load_data.py"],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        st.success("Reloaded successfully!")
-    except subprocess.CalledProcessError as e:
-        st.error(f"Failed to run load_data.py:\n{e.stderr}")
+# opt-in stage and query timings for each run, shown at the end of the sidebar once the page is done
+profiling = st.sidebar.toggle("Profiler", key="profiler", help="Time each stage of the page and its queries. "
+                              "Set LOBLAW_PROFILE_LOG to also append every profiled run to a JSON Lines file.")
+if profiling:
+    start_run(page)
+
+load_jobs = get_load_jobs()
+load_running = load_jobs["current"] is not None and load_jobs["current"].running
+
+if st.sidebar.button("Reload", help="Apply changes from the CSV (added, changed or removed samples)",
+                     icon="🔄", disabled=load_running):
+    load_jobs["current"] = LoadJob("--incremental")
+    st.rerun()
+
+if st.sidebar.button("Rebuild", help="Rebuild the database from the CSV in the background, then swap it in. "
+                     "Rows added through the dashboard are discarded.", icon="🏗️", disabled=load_running):
+    # built by the job, then swapped in from this process so the connection pool can let go of the old file
+    new_db_path = make_temp_db_path()
+    load_jobs["current"] = LoadJob("--output", str(new_db_path), on_success=lambda: replace_database(new_db_path))
+    st.rerun()
+
+with st.sidebar:
+    # poll for progress only while a load is running
+    st.fragment(show_load_status, run_every=1 if load_running else None)()
+    profiler_panel = st.container()
 
 # body text
 st.title("Loblaw Bio Analytics Dashboard")
@@ -347,120 +688,63 @@ config = PAGE_CONFIG[page]
 st.header(page)
 
 # pull up add entry form
-if config["form_func"]:
-    config["form_func"]()
-
-df = query_df(config["sql_query"])
-
-# using AgGrid for an interactive table!
-gb = GridOptionsBuilder.from_dataframe(df)
-if config['form_func']:  # ignore checkboxes if it's a table w/o CRUD
-    gb.configure_selection('multiple', use_checkbox=True, groupSelectsChildren=True)
-
-gb.configure_default_column(filter=True, autoSize=True, resizable=True)
-gb.configure_grid_options(autoSizeStrategy={'type': 'fitCellContents'})
-
-gridOptions = gb.build()
-
-grid_response = AgGrid(
-    df,
-    gridOptions=gridOptions,
-    update_on="SelectionChanged",
-    theme="streamlit"
-)
-
-df_filtered = grid_response['data']
-st.write(f"{df_filtered.shape[0]} rows showing")
+with stage("Forms"):
+    if config["form_func"]:
+        config["form_func"]()
+    if config.get("import_func"):
+        config["import_func"]()
 
-# delete button logic
-if config['form_func']:  # again, ignore deleting if no CRUD
-    selected_rows = grid_response['selected_rows']
-
-    if selected_rows is not None and not selected_rows.empty:
-        st.write(f"Selected {len(selected_rows)} row(s).")
-
-        if st.button("Delete selected rows", icon="🗑️"):
-            ids_to_delete = selected_rows[config['id_field']].tolist()
-            try:
-                placeholders = ",".join("?" for _ in ids_to_delete)
-                delete_sql = f"DELETE FROM {config['table_name']} WHERE {config['id_field']} IN ({placeholders})"
-                run_sql(delete_sql, ids_to_delete)
-                st.success(f"Deleted {len(ids_to_delete)} rows successfully.")
-                st.session_state.delete_success = True
-                st.rerun()
-            except Exception as e:
-                st.error(f"Failed to delete rows: {e}")
-    else:
-        st.info("Select rows to delete.")
-        if st.session_state.delete_success:
-            st.success("Deleted rows successfully!")
-            st.session_state.delete_success = False
+# using AgGrid for an interactive table, a page at a time!
+show_table(page, config)
 
 if page == "Samples":
-    with st.expander("**Filtered Stats**"):
-        num_samples = df_filtered['sample_id'].nunique()
-        num_subjects = df_filtered['subject_id'].nunique()
-        num_responders = (df_filtered['response'] == 'y').sum()
-        num_nonresponders = (df_filtered['response'] == 'n').sum()
-        num_males = (df_filtered['sex'] == 'M').sum()
-        num_females = (df_filtered['sex'] == 'F').sum()
-        projects_breakdown = df_filtered.groupby(
-            'project_id')['sample_id'].nunique().rename("total_samples").reset_index()
-
-        st.write(f"- Number of samples: {num_samples}")
-        st.write(f"- Number of subjects: {num_subjects}")
-        st.write(f"- Samples from responders (y): {num_responders}")
-        st.write(f"- Samples from non-responders (n): {num_nonresponders}")
-        st.write(f"- Samples from male subjects: {num_males}")
-        st.write(f"- Samples from female subjects: {num_females}")
-
-    with st.expander("**Samples Per Project**"):
-        st.dataframe(projects_breakdown)
+    where, params = grid_filters("Samples", PAGED_QUERIES["Samples"])
+    # summed from frequency_cube when the filters allow, rather than counted over every matching sample
+    cube_where = cube_filters("Samples")
+    if cube_where is not None:
+        cube_conditions, cube_params = cube_where
+    with stage("Filtered stats"), st.expander("**Filtered Stats**"):
+        if cube_where is None:
+            summary = query_df(sql_query_sample_summary.format(where=where_clause(where)), params).iloc[0]
+        else:
+            summary = {
+                **query_df(sql_query_cube_sample_summary.format(
+                    where=where_clause([*CUBE_SAMPLE_ROWS, *cube_conditions])), cube_params).iloc[0],
+                # distinct subjects don't add up across the cube's slices, so they're still counted from the rows
+                **query_df(sql_query_subject_count.format(where=where_clause(where)), params).iloc[0],
+            }
+        st.write(f"- Number of samples: {summary['num_samples']}")
+        st.write(f"- Number of subjects: {summary['num_subjects']}")
+        st.write(f"- Samples from responders (y): {summary['num_responders']}")
+        st.write(f"- Samples from non-responders (n): {summary['num_nonresponders']}")
+        st.write(f"- Samples from male subjects: {summary['num_males']}")
+        st.write(f"- Samples from female subjects: {summary['num_females']}")
+
+    with stage("Samples per project"), st.expander("**Samples Per Project**"):
+        if cube_where is None:
+            st.dataframe(query_df(sql_query_samples_per_project.format(where=where_clause(where)), params))
+        else:
+            st.dataframe(query_df(sql_query_cube_samples_per_project.format(
+                where=where_clause([*CUBE_SAMPLE_ROWS, *cube_conditions])), cube_params))
+
+    show_trajectories(where, params)
 
     st.markdown("### Relative Frequencies")
     st.write("The following visualizations are tied to this table. Any filtering you do will update the visualizations below.")
-    df_freq = query_df(sql_query_rich_frequencies)
-    gb_freq = GridOptionsBuilder.from_dataframe(df_freq)
-    gb_freq.configure_default_column(filter=True, autoSize=True, resizable=True)
-    gb_freq.configure_grid_options(autoSizeStrategy={'type': 'fitCellContents'})
-    gridOptions_freq = gb_freq.build()
-
-    grid_response_freq = AgGrid(
-        df_freq,
-        gridOptions=gridOptions_freq,
-        update_on="SelectionChanged",
-        theme="streamlit"
-    )
-
-    df_filtered_freq = grid_response_freq['data']
-
-    with st.expander("**Box Plot**"):
-        fig, ax = plt.subplots(figsize=(10, 6))
-        sns.boxplot(
-            data=df_filtered_freq[df_filtered_freq['response'].isin(['y', 'n'])],
-            x='population',
-            y='relative_frequency',
-            hue='response',
-            ax=ax
-        )
-        ax.set_ylabel("Relative Frequency (%)")
-        ax.set_xlabel("Cell Population")
-        ax.set_title("Relative Frequencies: Responders vs Non-Responders")
-        st.pyplot(fig)
-
-    stat_results = []
-    for cell_type in df_filtered_freq['population'].unique():
-        df_cell_type = df_filtered_freq[df_filtered_freq['population'] == cell_type]
-        responders = df_cell_type[df_cell_type['response'] == 'y']['relative_frequency']
-        nonresponders = df_cell_type[df_cell_type['response'] == 'n']['relative_frequency']
-        if len(responders) > 0 and len(nonresponders) > 0:
-            u_stat, p_val = stats.mannwhitneyu(responders, nonresponders)
-            stat_results.append({
-                'Population': cell_type,
-                'p-value': p_val,
-                '# Responders': len(responders),
-                '# Non-Responders': len(nonresponders)
-            })
-
-    stat_df = pd.DataFrame(stat_results).sort_values('p-value')
-    st.dataframe(stat_df.style.format({'p-value': '{:.4f}'}))
+    show_frequencies_table()
+
+    # the analyses can run on a snapshot instead (see scripts/snapshot.py), once one has been taken
+    manifest = read_manifest()
+    use_snapshot = manifest is not None and st.toggle(
+        "Analyze snapshot", help=f"Run the analyses below on the snapshot taken {manifest['created_at']}, "
+                                 "memory-mapped rather than queried. Changes made since aren't included.")
+    with stage("Frequencies for analysis"):
+        df_filtered_freq, freq_source = filtered_frequencies(use_snapshot)
+
+    show_box_plot(freq_source, df_filtered_freq)
+    show_means(use_snapshot, df_filtered_freq)
+    show_stats(freq_source, df_filtered_freq)
+
+if profiling:
+    with profiler_panel:
+        show_profiler(finish_run())
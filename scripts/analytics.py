@@ -0,0 +1,247 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations
+import math
+import multiprocessing as mp
+import os
+import threading
+import numpy as np
+import pandas as pd
+import scipy.stats as stats
+
+MANN_WHITNEY_COLUMNS = ['Population', 'U', 'p-value', '# Responders', '# Non-Responders']
+RESAMPLING_COLUMNS = ['Population', 'Mean difference', 'Permutation p-value', 'CI low', 'CI high']
+MOMENT_COLUMNS = ['population', 'response', 'n', 'sum_frequency', 'sum_squares']
+WELCH_COLUMNS = ['Population', 'Mean (y)', 'SD (y)', 'Mean (n)', 'SD (n)', 't', 'p-value']
+
+# permutations and bootstrap resamples drawn per population
+N_RESAMPLES = 10_000
+
+# resampled values held at once per population (in blocks of resamples), ~16MB of float64
+BLOCK_SIZE = 2_000_000
+
+# processes populations are spread across; 1 resamples in this process
+ANALYTICS_WORKERS = int(os.environ.get("LOBLAW_ANALYTICS_WORKERS", os.cpu_count() or 1))
+
+
+def mwu_methods(n1, n2, ties):
+    """scipy's method='auto' choice, per population: exact for small samples without ties."""
+    return np.where(((n1 > 8) & (n2 > 8)) | ties, "asymptotic", "exact")
+
+
+def group_by_population(df, population='population', response='response', value='relative_frequency'):
+    """
+    The responder ('y') and non-responder ('n') values of every population in df, grouped with one stable sort
+    rather than a boolean mask per population. Returns the populations (in order of first appearance), the values
+    sorted by population with each population's responders first, where each population starts, and the number
+    of responders (n1) and non-responders (n2) in each.
+    """
+    codes, populations = pd.factorize(df[population])
+    # a missing population never matches itself, so it isn't tested (codes of -1)
+    keep = df[response].isin(['y', 'n']).to_numpy() & (codes >= 0)
+    codes = codes[keep]
+    is_responder = (df[response] == 'y').to_numpy()[keep]
+    values = df[value].to_numpy(dtype=float)[keep]
+
+    n1 = np.bincount(codes[is_responder], minlength=len(populations))
+    n2 = np.bincount(codes[~is_responder], minlength=len(populations))
+    # each group keeps its row order
+    sorted_values = values[np.lexsort((~is_responder, codes))]
+    starts = np.concatenate(([0], np.cumsum(n1 + n2)[:-1]))
+    return populations, sorted_values, starts, n1, n2
+
+
+def mannwhitneyu_by_population(df, population='population', response='response', value='relative_frequency'):
+    """
+    Mann-Whitney U tests of responders ('y') against non-responders ('n') for every population in df.
+    Populations whose samples have the same shape (sizes and test method) are tested in a single scipy call
+    along axis=1, so the p-values are exactly what a separate mannwhitneyu() call per population returns.
+    Populations missing either group are left out; the rest come in order of first appearance in df.
+    """
+    populations, sorted_values, x_starts, n1, n2 = group_by_population(df, population, response, value)
+    n_populations = len(populations)
+    y_starts = x_starts + n1
+    codes = np.repeat(np.arange(n_populations), n1 + n2)
+
+    # whether a population's values tie, which decides the method just like scipy does for one population
+    by_value = np.lexsort((sorted_values, codes))
+    values, value_codes = sorted_values[by_value], codes[by_value]
+    tied = (values[1:] == values[:-1]) & (value_codes[1:] == value_codes[:-1])
+    ties = np.bincount(value_codes[1:][tied], minlength=n_populations) > 0
+    # NaNs make a population's p-value NaN; keep them out of other populations' batches all the same
+    has_nan = np.bincount(codes[np.isnan(sorted_values)], minlength=n_populations) > 0
+    methods = mwu_methods(n1, n2, ties)
+
+    u_stats = np.full(n_populations, np.nan)
+    p_values = np.full(n_populations, np.nan)
+    tested = np.flatnonzero((n1 > 0) & (n2 > 0))
+    batches = pd.DataFrame({'n1': n1[tested], 'n2': n2[tested], 'method': methods[tested],
+                            'has_nan': has_nan[tested]}).groupby(['n1', 'n2', 'method', 'has_nan'])
+    for (size1, size2, method, _), positions in batches.indices.items():
+        batch = tested[positions]
+        x = sorted_values[x_starts[batch, None] + np.arange(size1)]
+        y = sorted_values[y_starts[batch, None] + np.arange(size2)]
+        result = stats.mannwhitneyu(x, y, axis=1, method=method)
+        u_stats[batch] = result.statistic
+        p_values[batch] = result.pvalue
+
+    return pd.DataFrame({
+        'Population': populations[tested],
+        'U': u_stats[tested],
+        'p-value': p_values[tested],
+        '# Responders': n1[tested],
+        '# Non-Responders': n2[tested],
+    }, columns=MANN_WHITNEY_COLUMNS)
+
+
+def permutation_pvalue(x, y, n_resamples=N_RESAMPLES, rng=None):
+    """
+    Two-sided permutation p-value for the difference in means of x and y.
+    Exact, over every way of splitting the values into groups of their sizes, when there are no more
+    splits than n_resamples; otherwise estimated from n_resamples random permutations, drawn in blocks.
+    """
+    values = np.concatenate((x, y))
+    n, n1 = len(values), len(x)
+    total = values.sum()
+
+    def mean_differences(sums):
+        return sums / n1 - (total - sums) / (n - n1)
+
+    observed = abs(mean_differences(x.sum()))
+    # the same split summed in a different order can differ in the last bits
+    threshold = observed - 1e-12 * max(1.0, observed)
+
+    if math.comb(n, n1) <= n_resamples:
+        splits = np.array(list(combinations(range(n), n1)))
+        return np.mean(np.abs(mean_differences(values[splits].sum(axis=1))) >= threshold)
+
+    rng = np.random.default_rng(rng)
+    block = max(1, BLOCK_SIZE // n)
+    hits = 0
+    for start in range(0, n_resamples, block):
+        permuted = rng.permuted(np.tile(values, (min(block, n_resamples - start), 1)), axis=1)
+        hits += np.count_nonzero(np.abs(mean_differences(permuted[:, :n1].sum(axis=1))) >= threshold)
+    # the observed split counts as one of the permutations, so the estimate is never 0
+    return (hits + 1) / (n_resamples + 1)
+
+
+def bootstrap_ci(x, y, n_resamples=N_RESAMPLES, rng=None, confidence=0.95):
+    """Percentile bootstrap confidence interval for the difference in means of x and y."""
+    rng = np.random.default_rng(rng)
+    block = max(1, BLOCK_SIZE // (len(x) + len(y)))
+    differences = np.empty(n_resamples)
+    for start in range(0, n_resamples, block):
+        size = min(block, n_resamples - start)
+        differences[start:start + size] = (x[rng.integers(0, len(x), (size, len(x)))].mean(axis=1)
+                                           - y[rng.integers(0, len(y), (size, len(y)))].mean(axis=1))
+    alpha = (1 - confidence) / 2
+    return tuple(np.quantile(differences, [alpha, 1 - alpha]))
+
+
+def resample_population(x, y, n_resamples, seed):
+    """Mean difference, permutation p-value and bootstrap CI for one population; runs in a worker process."""
+    if np.isnan(x).any() or np.isnan(y).any():
+        return np.nan, np.nan, np.nan, np.nan
+    permutation_rng, bootstrap_rng = (np.random.default_rng(child) for child in seed.spawn(2))
+    return (x.mean() - y.mean(), permutation_pvalue(x, y, n_resamples, permutation_rng),
+            *bootstrap_ci(x, y, n_resamples, bootstrap_rng))
+
+
+_executor = None
+_executor_workers = None
+_executor_lock = threading.Lock()
+
+
+def get_executor(workers=ANALYTICS_WORKERS):
+    """
+    A process pool kept for the life of this process, so workers start (and import NumPy) once.
+    Spawned rather than forked, since the dashboard's process has threads of its own.
+    """
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor_workers != workers:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn"))
+            _executor_workers = workers
+        return _executor
+
+
+def population_seed(seed, population):
+    """
+    The random stream for one population: a child of seed (a SeedSequence) keyed by the population's name,
+    so it doesn't depend on the order populations come in, or on which others are resampled with it.
+    """
+    key = int.from_bytes(str(population).encode(), 'little')
+    return np.random.SeedSequence(seed.entropy, spawn_key=(*seed.spawn_key, key))
+
+
+def resampling_by_population(df, n_resamples=N_RESAMPLES, seed=None, workers=ANALYTICS_WORKERS,
+                             population='population', response='response', value='relative_frequency'):
+    """
+    Permutation p-values and bootstrap confidence intervals for the responder minus non-responder difference
+    in mean value, for every population in df that has both groups, spread across a process pool.
+    Each population gets its own random stream from seed and its name, and its groups' values are sorted first,
+    so a given seed gives the same results whatever order the rows come in and however many workers there are;
+    seed=None draws fresh ones.
+    """
+    populations, sorted_values, x_starts, n1, n2 = group_by_population(df, population, response, value)
+    tested = np.flatnonzero((n1 > 0) & (n2 > 0))
+    seed = np.random.SeedSequence(seed)
+    y_starts = x_starts + n1
+    tasks = [(np.sort(sorted_values[x_starts[i]:y_starts[i]]), np.sort(sorted_values[y_starts[i]:y_starts[i] + n2[i]]),
+              n_resamples, population_seed(seed, populations[i]))
+             for i in tested]
+
+    if workers > 1 and len(tasks) > 1:
+        results = list(get_executor(workers).map(resample_population, *zip(*tasks),
+                                                 chunksize=max(1, len(tasks) // (4 * workers))))
+    else:
+        results = [resample_population(*task) for task in tasks]
+
+    return pd.DataFrame([(populations[i], *result) for i, result in zip(tested, results)], columns=RESAMPLING_COLUMNS)
+
+
+def population_moments(df, population='population', response='response', value='relative_frequency'):
+    """
+    Each population's values in df by response, as the sample count, sum and sum of squares that
+    frequency_cube holds (see sql_query_cube_population_moments), for frames the cube can't answer for.
+    Missing values are left out, as the cube leaves out samples with no counts.
+    """
+    values = df[value].astype(float)
+    keep = values.notna()
+    grouped = pd.DataFrame({
+        'population': df[population][keep],
+        'response': df[response][keep],
+        'n': 1,
+        'sum_frequency': values[keep],
+        'sum_squares': values[keep] ** 2,
+    }).groupby(['population', 'response'], sort=False, dropna=False, observed=True)
+    return grouped.sum().reset_index()[MOMENT_COLUMNS]
+
+
+def welch_by_population(moments):
+    """
+    Responders' ('y') and non-responders' ('n') mean and standard deviation for every population in moments
+    (see population_moments), with Welch's t-test between them, all from the counts, sums and sums of squares,
+    without the values themselves. Populations missing either group are left out.
+    """
+    n = moments['n'].astype(float)
+    mean = moments['sum_frequency'] / n
+    # sums of squares far bigger than the variance can round it a little below 0
+    variance = ((moments['sum_squares'] - moments['sum_frequency'] * mean) / (n - 1)).clip(lower=0)
+    summary = pd.DataFrame({'population': moments['population'], 'response': moments['response'], 'n': n,
+                            'mean': mean, 'sd': np.sqrt(variance.where(n > 1))})
+    y = summary[summary['response'] == 'y'].set_index('population')
+    n_ = summary[summary['response'] == 'n'].set_index('population')
+    both = y.join(n_, how='inner', lsuffix='_y', rsuffix='_n')
+    t, p_values = stats.ttest_ind_from_stats(both['mean_y'], both['sd_y'], both['n_y'], both['mean_n'], both['sd_n'],
+                                             both['n_n'], equal_var=False)
+    return pd.DataFrame({
+        'Population': both.index,
+        'Mean (y)': both['mean_y'].to_numpy(),
+        'SD (y)': both['sd_y'].to_numpy(),
+        'Mean (n)': both['mean_n'].to_numpy(),
+        'SD (n)': both['sd_n'].to_numpy(),
+        't': np.asarray(t),
+        'p-value': np.asarray(p_values),
+    }, columns=WELCH_COLUMNS)
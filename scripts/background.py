@@ -0,0 +1,60 @@
+import subprocess
+import sys
+import threading
+from scripts.utils import BASE_DIR, PROGRESS_PREFIX
+
+LOAD_SCRIPT = BASE_DIR / "scripts" / "load_data.py"
+
+
+class LoadJob:
+    """
+    A load_data.py run in a background process.
+    A reader thread keeps the latest progress from its output, so the dashboard can poll it without blocking.
+    on_success, if given, runs on that thread once the process exits cleanly, before the job counts as done.
+    """
+
+    def __init__(self, *args, on_success=None):
+        self.args = [*args, "--progress"]
+        self.on_success = on_success
+        self.progress = 0.0
+        self.message = "Starting..."
+        self.output = []
+        self.error = None
+        self.returncode = None
+        self.process = subprocess.Popen(
+            [sys.executable, str(LOAD_SCRIPT), *self.args],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1
+        )
+        self.thread = threading.Thread(target=self._read_output, daemon=True)
+        self.thread.start()
+
+    def _read_output(self):
+        for line in self.process.stdout:
+            if line.startswith(PROGRESS_PREFIX):
+                _, fraction, message = line.rstrip("\n").split(" ", 2)
+                if fraction != "-":
+                    self.progress = float(fraction)
+                self.message = message
+            else:
+                self.output.append(line)
+        returncode = self.process.wait()
+        if returncode == 0 and self.on_success:
+            try:
+                self.on_success()
+            except Exception as e:
+                self.error = e
+                self.output.append(f"{type(e).__name__}: {e}\n")
+        if returncode == 0 and self.error is None:
+            self.progress = 1.0
+        self.returncode = returncode
+
+    @property
+    def running(self):
+        return self.returncode is None
+
+    @property
+    def succeeded(self):
+        return self.returncode == 0 and self.error is None
@@ -0,0 +1,259 @@
+import argparse
+from datetime import datetime, timezone
+import json
+from pathlib import Path
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import pandas as pd
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from scripts.utils import CONNECTION_PRAGMAS, fetch_df  # noqa: E402
+from scripts.load_data import init_db, load_data_from_csv, load_data_incremental, verify_frequency_cube  # noqa: E402
+from scripts.queries import (CUBE_POPULATION_ROWS, CUBE_SAMPLE_ROWS, PAGED_QUERIES,  # noqa: E402
+                             sql_query_cell_counts_long, sql_query_cell_counts_page, sql_query_cell_type_ranges,
+                             sql_query_cube_population_moments, sql_query_cube_sample_summary,
+                             sql_query_cube_samples_per_project, sql_query_response_frequencies,
+                             sql_query_rich_frequencies, sql_query_sample_metadata, sql_query_sample_summary,
+                             sql_query_samples_per_project, sql_query_subject_count, sql_query_subject_trajectory,
+                             sql_query_trajectory_summary, TRAJECTORY_ROWS)
+from scripts.paging import PAGE_SIZES, count_query, page_query  # noqa: E402
+from scripts.filters import where_clause  # noqa: E402
+from scripts.pivot import counts_dtype, order_cell_types, pivot_cell_counts  # noqa: E402
+from scripts.analytics import (mannwhitneyu_by_population, population_moments, resampling_by_population,  # noqa: E402
+                                welch_by_population)
+from scripts.plots import box_plot_png, box_stats  # noqa: E402
+from scripts.synthetic import generate_cell_counts, synthetic_cell_types  # noqa: E402
+
+BENCHMARK_SIZES = [10_000, 100_000, 1_000_000]
+
+# fewer than the dashboard's default, so the largest size finishes in minutes
+BENCHMARK_RESAMPLES = 1_000
+
+# steps slower than this in a comparison are flagged, as a ratio of new to old seconds,
+# unless they're within MIN_REGRESSION_SECONDS of the old time, which is down to noise
+REGRESSION_THRESHOLD = 1.2
+MIN_REGRESSION_SECONDS = 0.05
+
+
+def timed(steps, name, func, *args, repeat=1, **kwargs):
+    """Run func repeat times, recording the fastest run's seconds (and rows, for a frame) under steps[name]."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    steps[name] = {'seconds': best}
+    if isinstance(result, pd.DataFrame):
+        steps[name]['rows'] = len(result)
+    return result
+
+
+def read_only_connection(db_path):
+    conn = sqlite3.connect(f"{Path(db_path).resolve().as_uri()}?mode=ro", uri=True)
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def pivot_samples(conn, metadata):
+    """The whole Samples table with its counts pivoted in, read in long form, for timing the pivot at full size."""
+    ranges = conn.execute(sql_query_cell_type_ranges).fetchall()
+    cell_types = order_cell_types([cell_type for cell_type, _, _ in ranges])
+    return pivot_cell_counts(metadata['sample_id'], conn.execute(sql_query_cell_counts_long), cell_types,
+                             counts_dtype(ranges))
+
+
+def pivot_page(conn, page):
+    """One page of the Samples table with its counts pivoted in, as pivot.add_cell_counts() does."""
+    ranges = conn.execute(sql_query_cell_type_ranges).fetchall()
+    cell_types = order_cell_types([cell_type for cell_type, _, _ in ranges])
+    sample_ids = page['sample_id']
+    cursor = conn.execute(sql_query_cell_counts_page, (json.dumps(sample_ids.tolist()),))
+    return pivot_cell_counts(sample_ids, cursor, cell_types, counts_dtype(ranges))
+
+
+def benchmark_size(n_samples, work_dir, n_projects=3, samples_per_subject=3, n_cell_types=5, seed=0,
+                   n_resamples=BENCHMARK_RESAMPLES, repeat=1):
+    """
+    Time every stage of the dashboard on n_samples synthetic samples: generating and loading the CSV into a fresh
+    database in work_dir, each page's first page and row count, the full-table queries, the pivot, an incremental
+    reload of the CSV with 1% of its samples edited, and the statistics and box plot over every sample. Queries run
+    on a connection of their own, so none are cached. Raises a RuntimeError if the reload leaves frequency_cube
+    out of step with the counts. Returns {step: {'seconds': ..., 'rows': ...}}.
+    """
+    steps = {}
+    n_subjects = max(1, n_samples // samples_per_subject)
+    csv_path = work_dir / f"cell-count-{n_samples}.csv"
+    db_path = work_dir / f"benchmark-{n_samples}.sqlite"
+    df = timed(steps, "generate", generate_cell_counts, n_projects, n_subjects, samples_per_subject, n_cell_types,
+               seed)
+    df.to_csv(csv_path, index=False)
+    del df
+
+    init_db(db_path)
+    stats = timed(steps, "ingest", load_data_from_csv, csv_path, db_path,
+                  cell_types=synthetic_cell_types(n_cell_types))
+    steps["ingest"]["rows"] = stats['csv_rows']
+    steps["ingest"]["db_bytes"] = db_path.stat().st_size
+
+    conn = read_only_connection(db_path)
+    no_filters = where_clause([])
+    try:
+        for name, paged in PAGED_QUERIES.items():
+            page = timed(steps, f"page: {name}", fetch_df, conn, page_query(paged["select"], paged["key"]),
+                         [PAGE_SIZES[0]], repeat=repeat)
+            # the grid's unfiltered row count, from its count query if it has one, as count_filtered_rows() does
+            count_sql = (paged["count"]["query"].format(where=no_filters) if "count" in paged
+                         else count_query(paged["select"]))
+            timed(steps, f"count: {name}", fetch_df, conn, count_sql, repeat=repeat)
+            if name == "Samples":
+                timed(steps, "pivot: Samples page", pivot_page, conn, page, repeat=repeat)
+
+        timed(steps, "query: sample summary", fetch_df, conn, sql_query_sample_summary.format(where=no_filters),
+              repeat=repeat)
+        timed(steps, "query: samples per project", fetch_df, conn,
+              sql_query_samples_per_project.format(where=no_filters), repeat=repeat)
+        timed(steps, "query: subject count", fetch_df, conn, sql_query_subject_count.format(where=no_filters),
+              repeat=repeat)
+        timed(steps, "cube: sample summary", fetch_df, conn,
+              sql_query_cube_sample_summary.format(where=where_clause(CUBE_SAMPLE_ROWS)), repeat=repeat)
+        timed(steps, "cube: samples per project", fetch_df, conn,
+              sql_query_cube_samples_per_project.format(where=where_clause(CUBE_SAMPLE_ROWS)), repeat=repeat)
+        timed(steps, "cube: population moments", fetch_df, conn,
+              sql_query_cube_population_moments.format(where=where_clause(CUBE_POPULATION_ROWS)), repeat=repeat)
+        timed(steps, "query: trajectory summary", fetch_df, conn,
+              sql_query_trajectory_summary.format(where=where_clause(TRAJECTORY_ROWS)), repeat=repeat)
+        timed(steps, "query: subject trajectory", fetch_df, conn, sql_query_subject_trajectory, ["sbj1"],
+              repeat=repeat)
+        metadata = timed(steps, "query: sample metadata", fetch_df, conn, sql_query_sample_metadata, repeat=repeat)
+        timed(steps, "pivot: all samples", pivot_samples, conn, metadata, repeat=repeat)
+        del metadata
+        timed(steps, "query: rich frequencies", fetch_df, conn, sql_query_rich_frequencies, repeat=repeat)
+        freq = timed(steps, "query: response frequencies", fetch_df, conn,
+                     sql_query_response_frequencies.format(where=no_filters), repeat=repeat)
+    finally:
+        conn.close()
+
+    # the dashboard's Reload button, after every 100th sample's first count changed
+    cell_types = synthetic_cell_types(n_cell_types)
+    edited = pd.read_csv(csv_path)
+    edited.loc[edited.index % 100 == 0, cell_types[0]] += 1
+    edited.to_csv(csv_path, index=False)
+    del edited
+    reload_stats = timed(steps, "reload: incremental", load_data_incremental, csv_path, db_path,
+                         cell_types=cell_types)
+    steps["reload: incremental"]["rows"] = reload_stats['changed']
+    if mismatches := verify_frequency_cube(db_path):
+        raise RuntimeError(f"{len(mismatches)} frequency_cube mismatches after an incremental reload, "
+                           f"e.g. {mismatches[0]}")
+
+    freq = freq[freq['response'].isin(['y', 'n'])]
+    timed(steps, "stats: mann-whitney", mannwhitneyu_by_population, freq, repeat=repeat)
+    timed(steps, "stats: welch (from rows)", welch_by_population, population_moments(freq), repeat=repeat)
+    timed(steps, "stats: resampling", resampling_by_population, freq, n_resamples, seed, repeat=repeat)
+    timed(steps, "plot: box stats", box_stats, freq, repeat=repeat)
+    timed(steps, "plot: box plot", box_plot_png, freq, repeat=repeat)
+
+    csv_path.unlink()
+    db_path.unlink()
+    return steps
+
+
+def git_commit():
+    """The checked out commit, so results can be matched to the code they measured (None outside a checkout)."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=Path(__file__).resolve().parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes=BENCHMARK_SIZES, work_dir=None, **params):
+    """benchmark_size() for each of sizes, with what was run and where, as a dict ready to be dumped to JSON."""
+    results = {
+        'created_at': datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'params': params,
+        'sizes': {},
+    }
+    with tempfile.TemporaryDirectory(prefix="loblaw-benchmark-", dir=work_dir) as tmp_dir:
+        for n_samples in sizes:
+            results['sizes'][str(n_samples)] = benchmark_size(n_samples, Path(tmp_dir), **params)
+    return results
+
+
+def compare_results(old, new, threshold=REGRESSION_THRESHOLD):
+    """
+    (size, step, old seconds, new seconds, ratio, regressed) for every step timed in both results,
+    regressed meaning the new run took more than threshold times as long (and MIN_REGRESSION_SECONDS longer).
+    """
+    rows = []
+    for size, steps in new['sizes'].items():
+        for step, result in steps.items():
+            before = old['sizes'].get(size, {}).get(step)
+            if before is None:
+                continue
+            ratio = result['seconds'] / before['seconds'] if before['seconds'] else float('inf')
+            regressed = ratio > threshold and result['seconds'] - before['seconds'] > MIN_REGRESSION_SECONDS
+            rows.append((size, step, before['seconds'], result['seconds'], ratio, regressed))
+    return rows
+
+
+def print_results(results):
+    for size, steps in results['sizes'].items():
+        print(f"{int(size):,} samples")
+        for step, result in steps.items():
+            rows = f"{result['rows']:>12,} rows" if 'rows' in result else ""
+            print(f"  {step:<32} {result['seconds']:>9.3f}s {rows}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time the loader, the dashboard's queries, the pivot, and the statistics and plot on synthetic "
+                    "data at several sizes, and write the timings as JSON to compare between versions.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=BENCHMARK_SIZES,
+                        help="numbers of samples to benchmark (default: %(default)s)")
+    parser.add_argument('--projects', type=int, default=3, help="number of projects (default: %(default)s)")
+    parser.add_argument('--samples-per-subject', type=int, default=3,
+                        help="samples taken from each subject (default: %(default)s)")
+    parser.add_argument('--cell-types', type=int, default=5, help="count columns per sample (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0, help="random seed (default: %(default)s)")
+    parser.add_argument('--resamples', type=int, default=BENCHMARK_RESAMPLES,
+                        help="permutations and bootstrap resamples per population (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="runs of each query and analysis step, keeping the fastest (default: %(default)s)")
+    parser.add_argument('--work-dir', type=Path, help="where to write the temporary CSVs and databases "
+                                                      "(default: the system temp directory)")
+    parser.add_argument('--out', type=Path, help="file to write the results to as JSON")
+    parser.add_argument('--compare', type=Path, metavar='BASELINE',
+                        help="results JSON of an earlier run to compare against; exits non-zero if any step "
+                             f"got more than {REGRESSION_THRESHOLD}x slower")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.work_dir, n_projects=args.projects,
+                             samples_per_subject=args.samples_per_subject, n_cell_types=args.cell_types,
+                             seed=args.seed, n_resamples=args.resamples, repeat=args.repeat)
+    print_results(results)
+    if args.out:
+        args.out.write_text(json.dumps(results, indent=2))
+        print(f"Results written to {args.out}.")
+
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())
+        comparison = compare_results(baseline, results)
+        print(f"Compared with {args.compare} (commit {baseline['commit']}):")
+        if baseline['params'] != results['params']:
+            print(f"   note: the baseline was run with different parameters, {baseline['params']}")
+        for size, step, before, after, ratio, regressed in comparison:
+            print(f"{'!!' if regressed else '  '} {int(size):>9,} {step:<32} {before:>9.3f}s -> {after:>9.3f}s "
+                  f"({ratio:.2f}x)")
+        if any(regressed for *_, regressed in comparison):
+            raise SystemExit(1)
@@ -0,0 +1,171 @@
+from pathlib import Path
+import pandas as pd
+from scripts.filters import where_clause
+from scripts.load_data import (build_tables, create_schema, cube_upsert, drop_cube_triggers, insert_rows,
+                               migrate_cell_counts, refresh_trajectories, write_tables)
+from scripts.utils import CELL_TYPES, connection, get_pool
+
+# the columns of cell-count.csv, which an import file must have; any others are ignored
+IMPORT_COLUMNS = ['project', 'subject', 'condition', 'age', 'sex', 'treatment', 'response', 'sample',
+                  'sample_type', 'time_from_treatment_start', *CELL_TYPES]
+
+# columns that must be whole numbers >= 0 where they aren't blank
+NUMBER_COLUMNS = ['age', 'time_from_treatment_start', *CELL_TYPES]
+
+REQUIRED_COLUMNS = ['project', 'subject', 'sample']
+
+PROBLEM_COLUMNS = ['Row', 'Column', 'Problem']
+
+
+def read_import_file(file, name=None):
+    """A CSV or Parquet file of samples (a path or an uploaded file), by its extension."""
+    suffix = Path(name or file).suffix.lower()
+    if suffix == '.csv':
+        return pd.read_csv(file)
+    if suffix in ('.parquet', '.pq'):
+        return pd.read_parquet(file)
+    raise ValueError(f"Can't import {suffix or 'files without an extension'}; use .csv or .parquet")
+
+
+def stage_ids(cursor, ids):
+    """
+    Load ids into the temp table staged_ids (emptied first) in executemany() batches, so statements can join
+    against any number of them instead of binding one ? per id. Returns the number of ids staged.
+    """
+    cursor.execute('CREATE TEMP TABLE IF NOT EXISTS staged_ids (id TEXT PRIMARY KEY) WITHOUT ROWID')
+    cursor.execute('DELETE FROM temp.staged_ids')
+    return insert_rows(cursor, 'INSERT OR IGNORE INTO temp.staged_ids (id) VALUES (?)', ((id_,) for id_ in ids))
+
+
+def validate_samples(df, cursor):
+    """
+    Every problem with a file of new samples, one (row, column, problem) per problem, rows numbered from 1.
+    Samples must have a project, subject and sample ID not already in the file or the database, and any
+    response must be y or n, and any ages, times and counts whole and non-negative.
+    Raises a ValueError if the file is missing columns altogether.
+    """
+    missing = [column for column in IMPORT_COLUMNS if column not in df.columns]
+    if missing:
+        raise ValueError(f"Missing columns: {', '.join(missing)}")
+
+    rows = pd.Series(range(1, len(df) + 1), index=df.index)
+    problems = []
+
+    def report(mask, column, problem):
+        for row, value in zip(rows[mask], df.loc[mask, column]):
+            problems.append((row, column, problem.format(value=value)))
+
+    for column in REQUIRED_COLUMNS:
+        report(df[column].isna() | (df[column].astype(str).str.strip() == ''), column, "Required")
+
+    samples = df['sample'].astype(str)
+    report(df['sample'].notna() & samples.duplicated(), 'sample', "{value} appears more than once in the file")
+    stage_ids(cursor, samples[df['sample'].notna()].unique().tolist())
+    existing = {sample_id for sample_id, in cursor.execute(
+        'SELECT sample_id FROM samples WHERE sample_id IN (SELECT id FROM temp.staged_ids)')}
+    report(samples.isin(existing) & df['sample'].notna(), 'sample', "{value} already exists")
+
+    # e.g. healthy subjects' samples have no response or time from treatment
+    report(df['response'].notna() & ~df['response'].isin(['y', 'n']), 'response', "Must be y or n, not {value}")
+
+    for column in NUMBER_COLUMNS:
+        values = pd.to_numeric(df[column], errors='coerce')
+        blank = df[column].isna()
+        report(~blank & ~((values >= 0) & (values % 1 == 0)), column, "Must be a whole number >= 0, not {value}")
+
+    return pd.DataFrame(sorted(problems, key=lambda problem: problem[0]), columns=PROBLEM_COLUMNS)
+
+
+def clean_samples(df):
+    """The import's columns as the loader expects them: IDs as text, numbers as Python ints, blanks as None."""
+    df = df[IMPORT_COLUMNS].copy()
+    for column in df.columns:
+        if column in NUMBER_COLUMNS:
+            values = pd.to_numeric(df[column]).astype('Int64')
+        else:
+            values = df[column].where(df[column].isna(), df[column].astype(str))
+        df[column] = values.astype(object).where(values.notna(), None)
+    return df
+
+
+def migrate_first():
+    """
+    Move a database from before cell_types to the current layout, as the loader does before it writes anything:
+    create_schema() can't put the cell_counts view in place of the old table. Does nothing once it's moved.
+    """
+    migrate_cell_counts(get_pool().db_path)
+
+
+def import_samples(df):
+    """
+    Add a file of new samples (with their subjects, projects and treatments, if those are new too) through
+    the loader's batched inserts, all in one transaction: if any row has a problem nothing is imported, and the
+    problems are returned (see validate_samples). Rows imported this way have no CSV fingerprint, so
+    incremental reloads leave them alone, like rows added with the form. The new samples are added to
+    frequency_cube by one statement afterwards rather than by its per-row triggers (see delete_staged), and
+    their subjects' trajectories refreshed. Returns (rows written, problems).
+    """
+    migrate_first()
+    with connection() as conn:
+        cursor = conn.cursor()
+        problems = validate_samples(df, cursor)
+        if not problems.empty:
+            return 0, problems
+        create_schema(cursor)
+        drop_cube_triggers(cursor)
+        # validate_samples() left the file's sample IDs in staged_ids, and none of them existed before
+        written = write_tables(cursor, build_tables(clean_samples(df)))
+        cursor.execute(cube_upsert('SELECT sample_key FROM samples WHERE sample_id IN '
+                                   '(SELECT id FROM temp.staged_ids)', 1))
+        create_schema(cursor)
+        refresh_trajectories(cursor)
+        return written, problems
+
+
+def delete_staged(cursor, table, id_field):
+    """
+    Delete the rows of table whose id_field is in staged_ids. Samples' frequency_cube contributions are taken
+    away by one statement first, with the cube's per-row triggers dropped until the delete is done, which is
+    several times cheaper than the triggers for thousands of samples. The trajectories of subjects that lost
+    samples (directly or by cascade) are refreshed afterwards. Returns the number of rows deleted.
+    """
+    if table == 'samples':
+        # builds the cube first in a database from before it
+        create_schema(cursor)
+        drop_cube_triggers(cursor)
+        cursor.execute(cube_upsert(f'SELECT sample_key FROM samples WHERE {id_field} IN '
+                                   '(SELECT id FROM temp.staged_ids)', -1))
+    cursor.execute(f'DELETE FROM {table} WHERE {id_field} IN (SELECT id FROM temp.staged_ids)')
+    deleted = cursor.rowcount
+    if table == 'samples':
+        create_schema(cursor)
+    refresh_trajectories(cursor)
+    return deleted
+
+
+def delete_rows(table, id_field, ids):
+    """
+    Delete the rows of table whose id_field is in ids, however many there are: the ids are staged in a temp
+    table and the rows deleted by one statement joined against it, with any ON DELETE CASCADEs run by that
+    same statement. Returns the number of rows deleted.
+    table and id_field are interpolated into the SQL, so they must come from code, not input.
+    """
+    migrate_first()
+    with connection() as conn:
+        cursor = conn.cursor()
+        stage_ids(cursor, ids)
+        return delete_staged(cursor, table, id_field)
+
+
+def delete_matching(table, id_field, select, where=(), params=()):
+    """
+    delete_rows() for every row of a paged query (see scripts.queries.PAGED_QUERIES) matching where, e.g.
+    a grid's filters: the ids are staged straight from the query, without going through Python.
+    """
+    migrate_first()
+    with connection() as conn:
+        cursor = conn.cursor()
+        stage_ids(cursor, [])
+        cursor.execute(f'INSERT OR IGNORE INTO temp.staged_ids (id) SELECT {id_field} FROM ({select} '
+                       f'{where_clause(where)})', params)
+        return delete_staged(cursor, table, id_field)
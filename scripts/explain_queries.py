@@ -0,0 +1,120 @@
+import argparse
+from pathlib import Path
+import re
+import sqlite3
+import sys
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from scripts.utils import DB_PATH  # noqa: E402
+from scripts.queries import (CUBE_SAMPLE_ROWS, PAGED_QUERIES, sql_query_cell_counts_long,  # noqa: E402
+                             sql_query_cell_counts_page, sql_query_cell_type_ranges, sql_query_cube_sample_summary,
+                             sql_query_frequencies, sql_query_rich_frequencies, sql_query_response_frequencies,
+                             sql_query_sample_summary, sql_query_samples_per_project, sql_query_subject_count)
+from scripts.paging import page_query, count_query  # noqa: E402
+from scripts.filters import filter_where, where_clause  # noqa: E402
+
+# a row count reads its table in full; the joined ones walk the join from its smallest side, searching the rest
+ROW_COUNT_SCANS = {
+    "Samples": {"projects"},
+    "Projects": {"projects"},
+    "Subjects": {"subjects"},
+    "Treatments": {"treatments"},
+    "Frequencies": {"samples"},
+}
+
+# a handful of rows, walked for each sample to look its counts up by primary key
+DIMENSION_SCANS = {"cell_types"}
+
+# a typical grid filter model, to check filtered pages still walk the key's index
+EXAMPLE_FILTERS = {
+    "project_id": {"filterType": "text", "type": "equals", "filter": "prj1"},
+    "response": {"filterType": "text", "type": "equals", "filter": "y"},
+    "time_from_treatment_start": {"filterType": "number", "type": "inRange", "filter": 0, "filterTo": 7},
+}
+
+
+def example_where(paged):
+    return filter_where(EXAMPLE_FILTERS, paged["filters"])[0]
+
+
+# each query with the tables (or aliases) it is allowed to read in full; everything else must be an index search
+AUDITED_QUERIES = {
+    # the first page walks the key's index from the start, stopping at the LIMIT
+    **{f"{name} first page": (page_query(paged["select"], paged["key"]), {name.lower(), "samples"})
+       for name, paged in PAGED_QUERIES.items()},
+    **{f"{name} next page": (page_query(paged["select"], paged["key"], after=True), set())
+       for name, paged in PAGED_QUERIES.items()},
+    **{f"{name} filtered page": (page_query(paged["select"], paged["key"], after=True, where=example_where(paged)),
+                                 set()) for name, paged in PAGED_QUERIES.items() if name in ("Samples", "Frequencies")},
+    **{f"{name} row count": (count_query(paged["select"]), ROW_COUNT_SCANS[name])
+       for name, paged in PAGED_QUERIES.items()},
+    # the Frequencies grid counts its rows from sample_totals unless it's filtered on the counts (see PAGED_QUERIES)
+    "Frequencies row count (sample totals)": (PAGED_QUERIES["Frequencies"]["count"]["query"].format(
+        where=where_clause([])), {"samples"}),
+    # the unfiltered summaries read every sample once, through the one table that drives them
+    "sample summary": (sql_query_sample_summary.format(where=where_clause([])), {"samples"}),
+    "samples per project": (sql_query_samples_per_project.format(where=where_clause([])), {"projects"}),
+    "subject count": (sql_query_subject_count.format(where=where_clause([])), {"samples"}),
+    # frequency_cube has a row per slice, however many samples there are; its grouped queries sort those rows,
+    # which is cheap for the same reason, so only this one is audited
+    "cube sample summary": (sql_query_cube_sample_summary.format(where=where_clause(CUBE_SAMPLE_ROWS)),
+                            {"frequency_cube"}),
+    "cell counts (long)": (sql_query_cell_counts_long, {"cell_type_counts"}),
+    "cell counts (page)": (sql_query_cell_counts_page, {"json_each"}),
+    "cell type ranges": (sql_query_cell_type_ranges, set()),
+    "frequencies": (sql_query_frequencies, {"cell_type_counts", "totals"}),
+    "rich frequencies": (sql_query_rich_frequencies, {"samples"}),
+    "response frequencies": (sql_query_response_frequencies.format(where=where_clause([])), {"samples"}),
+}
+
+SCAN = re.compile(r"^SCAN (\w+)")
+# a sort, as opposed to the B-tree that deduplicates count(DISTINCT ...)
+TEMP_SORT = re.compile(r"TEMP B-TREE FOR (?!count\(DISTINCT\))")
+
+
+def explain(conn, sql):
+    """The EXPLAIN QUERY PLAN detail lines for sql, with any ? parameters bound to NULL."""
+    params = (None,) * sql.count("?")
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+
+def find_problems(plan, allowed_scans):
+    """Plan lines that sort in a temp B-tree, build an automatic index, or scan a table that should be searched."""
+    problems = []
+    for line in plan:
+        scan = SCAN.match(line)
+        if TEMP_SORT.search(line) or "AUTOMATIC" in line:
+            problems.append(line)
+        elif scan and scan.group(1) not in allowed_scans | DIMENSION_SCANS:
+            problems.append(line)
+    return problems
+
+
+def audit(db_path=None, queries=AUDITED_QUERIES):
+    """Returns {query name: (plan, problems)} for every audited query."""
+    conn = sqlite3.connect(f"{Path(db_path or DB_PATH).resolve().as_uri()}?mode=ro", uri=True)
+    results = {}
+    for name, (sql, allowed_scans) in queries.items():
+        plan = explain(conn, sql)
+        results[name] = (plan, find_problems(plan, allowed_scans))
+    conn.close()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run EXPLAIN QUERY PLAN on the dashboard's queries and fail on unindexed scans or temp sorts.")
+    parser.add_argument('--db', type=Path, default=DB_PATH, help="database to audit (default: %(default)s)")
+    args = parser.parse_args()
+
+    failed = 0
+    for name, (plan, problems) in audit(args.db).items():
+        print(f"{'FAIL' if problems else 'ok'}: {name}")
+        for line in plan:
+            print(f"    {'!! ' if line in problems else ''}{line}")
+        failed += bool(problems)
+
+    print(f"{failed} of {len(AUDITED_QUERIES)} queries have plan problems.")
+    if failed:
+        raise SystemExit(1)
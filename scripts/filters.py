@@ -0,0 +1,162 @@
+import pyarrow.compute as pc
+
+# AgGrid text filters are case-insensitive, as is LIKE for ASCII; {column} is the column's SQL expression
+TEXT_CONDITIONS = {
+    "equals": ("{column} LIKE ? ESCAPE '\\'", "{}"),
+    "notEqual": ("({column} IS NULL OR {column} NOT LIKE ? ESCAPE '\\')", "{}"),
+    "contains": ("{column} LIKE ? ESCAPE '\\'", "%{}%"),
+    "notContains": ("({column} IS NULL OR {column} NOT LIKE ? ESCAPE '\\')", "%{}%"),
+    "startsWith": ("{column} LIKE ? ESCAPE '\\'", "{}%"),
+    "endsWith": ("{column} LIKE ? ESCAPE '\\'", "%{}"),
+    "blank": ("({column} IS NULL OR {column} = '')", None),
+    "notBlank": ("({column} IS NOT NULL AND {column} != '')", None),
+}
+
+# AgGrid's inRange excludes both ends by default
+NUMBER_CONDITIONS = {
+    "equals": "{column} = ?",
+    "notEqual": "({column} IS NULL OR {column} != ?)",
+    "lessThan": "{column} < ?",
+    "lessThanOrEqual": "{column} <= ?",
+    "greaterThan": "{column} > ?",
+    "greaterThanOrEqual": "{column} >= ?",
+    "inRange": "({column} > ? AND {column} < ?)",
+    "blank": "{column} IS NULL",
+    "notBlank": "{column} IS NOT NULL",
+}
+
+
+# the same conditions as Arrow expressions, for filtering snapshots (see scripts.snapshot); match_like takes
+# the same patterns as LIKE, and Arrow's | and & treat nulls as SQL does
+def like(field, pattern):
+    return pc.match_like(field, pattern, ignore_case=True)
+
+
+TEXT_EXPRESSIONS = {
+    "equals": like,
+    "notEqual": lambda field, pattern: field.is_null() | ~like(field, pattern),
+    "contains": like,
+    "notContains": lambda field, pattern: field.is_null() | ~like(field, pattern),
+    "startsWith": like,
+    "endsWith": like,
+    "blank": lambda field: field.is_null() | (field == ""),
+    "notBlank": lambda field: field.is_valid() & (field != ""),
+}
+
+NUMBER_EXPRESSIONS = {
+    "equals": lambda field, value: field == value,
+    "notEqual": lambda field, value: field.is_null() | (field != value),
+    "lessThan": lambda field, value: field < value,
+    "lessThanOrEqual": lambda field, value: field <= value,
+    "greaterThan": lambda field, value: field > value,
+    "greaterThanOrEqual": lambda field, value: field >= value,
+    "inRange": lambda field, low, high: (field > low) & (field < high),
+    "blank": lambda field: field.is_null(),
+    "notBlank": lambda field: field.is_valid(),
+}
+
+
+def escape_like(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Not a number: {value!r}") from None
+
+
+def condition_params(condition):
+    """A condition's ({"filterType", "type", "filter", "filterTo"}) SQL template and params."""
+    filter_type, kind = condition.get("filterType"), condition.get("type")
+    if filter_type == "text" and kind in TEXT_CONDITIONS:
+        sql, pattern = TEXT_CONDITIONS[kind]
+        return sql, [pattern.format(escape_like(str(condition.get("filter", ""))))] if pattern else []
+    if filter_type == "number" and kind in NUMBER_CONDITIONS:
+        sql = NUMBER_CONDITIONS[kind]
+        return sql, [to_number(condition.get(name)) for name in ("filter", "filterTo")[:sql.count("?")]]
+    raise ValueError(f"Unsupported {filter_type} filter: {kind}")
+
+
+def condition_sql(column, condition):
+    """One filter condition as (SQL, params)."""
+    sql, params = condition_params(condition)
+    return sql.format(column=column), params
+
+
+def condition_expression(field, condition):
+    """One filter condition as an Arrow expression on field."""
+    _, params = condition_params(condition)
+    expressions = TEXT_EXPRESSIONS if condition.get("filterType") == "text" else NUMBER_EXPRESSIONS
+    return expressions[condition["type"]](field, *params)
+
+
+def split_conditions(column_filter):
+    """A column's filter as (operator, conditions); it is either one condition or several joined by an operator."""
+    conditions = column_filter.get("conditions")
+    if conditions is None:
+        if "operator" not in column_filter:
+            return "AND", [column_filter]
+        # older AgGrid versions send exactly two, as condition1/condition2
+        conditions = [column_filter["condition1"], column_filter["condition2"]]
+
+    operator = column_filter.get("operator", "AND").upper()
+    if operator not in ("AND", "OR"):
+        raise ValueError(f"Unsupported filter operator: {operator}")
+    return operator, [{"filterType": column_filter.get("filterType"), **condition} for condition in conditions]
+
+
+def column_filter_sql(column, column_filter):
+    """A column's filter as (SQL, params)."""
+    operator, conditions = split_conditions(column_filter)
+    parts = [condition_sql(column, condition) for condition in conditions]
+    if len(parts) == 1:
+        return parts[0]
+    sql = f" {operator} ".join(part_sql for part_sql, _ in parts)
+    return f"({sql})", [param for _, part_params in parts for param in part_params]
+
+
+def column_filter_expression(field, column_filter):
+    """A column's filter as an Arrow expression."""
+    operator, conditions = split_conditions(column_filter)
+    expressions = [condition_expression(field, condition) for condition in conditions]
+    combined = expressions[0]
+    for expression in expressions[1:]:
+        combined = (combined | expression) if operator == "OR" else (combined & expression)
+    return combined
+
+
+def filter_where(filter_model, columns):
+    """
+    The WHERE conditions (to be ANDed) and their params for an AgGrid filter model, {result column: column filter},
+    so grids can be filtered in SQL rather than in the browser. Values are always bound as params.
+    columns ({result column: SQL expression}) whitelists the filterable columns; filters on any other column
+    raise a ValueError rather than end up in SQL.
+    """
+    where, params = [], []
+    for name, column_filter in sorted((filter_model or {}).items()):
+        if name not in columns:
+            raise ValueError(f"Column can't be filtered: {name}")
+        sql, column_params = column_filter_sql(columns[name], column_filter)
+        where.append(sql)
+        params.extend(column_params)
+    return where, params
+
+
+def where_clause(where):
+    return f"WHERE {' AND '.join(where)}" if where else ""
+
+
+def filter_expression(filter_model, columns):
+    """
+    filter_where() for Arrow tables: the filter model as one Arrow expression (None if there are no filters),
+    on fields named after the result columns. columns whitelists the filterable columns, as in filter_where().
+    """
+    combined = None
+    for name, column_filter in sorted((filter_model or {}).items()):
+        if name not in columns:
+            raise ValueError(f"Column can't be filtered: {name}")
+        expression = column_filter_expression(pc.field(name), column_filter)
+        combined = expression if combined is None else combined & expression
+    return combined
@@ -1,18 +1,290 @@
+import argparse
+import glob
+from itertools import islice
+import multiprocessing as mp
+from pathlib import Path
+import sys
+import time
+import numpy as np
 import pandas as pd
-from utils import DB_PATH, CELL_COUNT_CSV, CELL_TYPES, get_connection
+
+# run as a script, and imported by the dashboard for its bulk import
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from scripts.utils import (DB_PATH, CELL_COUNT_CSV, CELL_TYPES, PROGRESS_PREFIX, SNAPSHOT_DIR,  # noqa: E402
+                           get_connection, make_temp_db_path, replace_database_file)
+from scripts.snapshot import read_snapshot  # noqa: E402
+
+# executemany batch size; large enough to amortize Python overhead, small enough to bound memory
+BATCH_SIZE = 50_000
+
+# rows per chunk in streaming mode; peak memory scales with this, not with the file size
+CHUNK_SIZE = 100_000
+
+# upper bound on remembered keys per table when deduping across chunks
+DEDUPE_MAX_KEYS = 1_000_000
+
+# load-time settings only; the database is rebuilt from the CSV if a load is interrupted
+LOAD_PRAGMAS = (
+    "PRAGMA synchronous = OFF",
+    "PRAGMA journal_mode = MEMORY",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -200000",
+)
+
+# integer keys of a sample_id and a cell_type, looked up through each table's unique index
+SAMPLE_KEY_SQL = '(SELECT sample_key FROM samples WHERE sample_id = ?)'
+CELL_TYPE_KEY_SQL = '(SELECT cell_type_key FROM cell_types WHERE cell_type = ?)'
+
+# keyed by table, in foreign key order
+INSERT_SQL = {
+    'projects': 'INSERT OR IGNORE INTO projects (project_id) VALUES (?)',
+    'subjects': '''
+        INSERT OR IGNORE INTO subjects (subject_id, project_id, condition, age, sex)
+        VALUES (?, ?, ?, ?, ?)
+    ''',
+    'treatments': 'INSERT OR IGNORE INTO treatments (treatment_id) VALUES (?)',
+    'samples': '''
+        INSERT OR IGNORE INTO samples (sample_id, subject_id, treatment_id, time_from_treatment_start, response, sample_type)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''',
+    'cell_types': 'INSERT OR IGNORE INTO cell_types (cell_type) VALUES (?)',
+    # rows come in as (sample_id, cell_type, count) and are stored by the two tables' integer keys
+    'cell_counts': f'''
+        INSERT OR IGNORE INTO cell_type_counts (sample_key, cell_type_key, count)
+        VALUES ({SAMPLE_KEY_SQL}, {CELL_TYPE_KEY_SQL}, ?)
+    ''',
+    'source_fingerprints': 'INSERT OR IGNORE INTO source_fingerprints (sample_id, row_hash) VALUES (?, ?)',
+}
+
+# incremental reloads overwrite rows that changed in the CSV instead of ignoring them
+UPSERT_SQL = {
+    'projects': INSERT_SQL['projects'],
+    'subjects': '''
+        INSERT INTO subjects (subject_id, project_id, condition, age, sex)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (subject_id) DO UPDATE SET
+            project_id = excluded.project_id,
+            condition = excluded.condition,
+            age = excluded.age,
+            sex = excluded.sex
+    ''',
+    'treatments': INSERT_SQL['treatments'],
+    'samples': '''
+        INSERT INTO samples (sample_id, subject_id, treatment_id, time_from_treatment_start, response, sample_type)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (sample_id) DO UPDATE SET
+            subject_id = excluded.subject_id,
+            treatment_id = excluded.treatment_id,
+            time_from_treatment_start = excluded.time_from_treatment_start,
+            response = excluded.response,
+            sample_type = excluded.sample_type
+    ''',
+    'cell_types': INSERT_SQL['cell_types'],
+    'cell_counts': f'''
+        INSERT INTO cell_type_counts (sample_key, cell_type_key, count)
+        VALUES ({SAMPLE_KEY_SQL}, {CELL_TYPE_KEY_SQL}, ?)
+        ON CONFLICT (sample_key, cell_type_key) DO UPDATE SET count = excluded.count
+    ''',
+    'source_fingerprints': '''
+        INSERT INTO source_fingerprints (sample_id, row_hash)
+        VALUES (?, ?)
+        ON CONFLICT (sample_id) DO UPDATE SET row_hash = excluded.row_hash
+    ''',
+}
+
+# maintain sample_totals; see drop_totals_triggers()
+TOTALS_TRIGGERS = ('cell_counts_totals_insert', 'cell_counts_totals_update', 'cell_counts_totals_delete')
+
+# what frequency_cube is summed over: a cohort slice, and the population (NULL in the rows counting whole samples)
+CUBE_DIMENSIONS = ('project_id', 'condition', 'treatment_id', 'sample_type', 'time_from_treatment_start',
+                   'response', 'sex', 'cell_type_key')
+CUBE_MEASURES = ('num_samples', 'sum_count', 'sum_frequency', 'sum_squares')
+# NULL is a value of its own here, so the unique key (and upserts' conflict target) map it to x'' instead
+CUBE_KEY = ", ".join(f"ifnull({dimension}, x'')" for dimension in CUBE_DIMENSIONS)
+
+# (name, timing, event, samples whose contribution it takes away (-1) or adds back (+1));
+# a change's samples are taken away before it and added back after, so the cube never re-aggregates more than them;
+# that's once per row written, so writes of many rows (bulk.py, incremental reloads) drop these and call
+# cube_upsert() once before and once after instead
+CUBE_TRIGGERS = (
+    # BEFORE INSERT runs for an upsert that turns into an UPDATE too, whose own triggers cover it
+    ('cube_counts_insert_before', 'BEFORE', 'INSERT ON cell_type_counts WHEN NOT EXISTS (SELECT 1 FROM '
+     'cell_type_counts WHERE sample_key = NEW.sample_key AND cell_type_key = NEW.cell_type_key)', 'NEW.sample_key', -1),
+    ('cube_counts_insert_after', 'AFTER', 'INSERT ON cell_type_counts', 'NEW.sample_key', 1),
+    ('cube_counts_update_before', 'BEFORE', 'UPDATE OF sample_key, count ON cell_type_counts',
+     'OLD.sample_key, NEW.sample_key', -1),
+    ('cube_counts_update_after', 'AFTER', 'UPDATE OF sample_key, count ON cell_type_counts',
+     'OLD.sample_key, NEW.sample_key', 1),
+    ('cube_counts_delete_before', 'BEFORE', 'DELETE ON cell_type_counts', 'OLD.sample_key', -1),
+    ('cube_counts_delete_after', 'AFTER', 'DELETE ON cell_type_counts', 'OLD.sample_key', 1),
+    ('cube_samples_insert', 'AFTER', 'INSERT ON samples', 'NEW.sample_key', 1),
+    ('cube_samples_update_before', 'BEFORE', 'UPDATE OF sample_key, subject_id, treatment_id, '
+     'time_from_treatment_start, response, sample_type ON samples', 'OLD.sample_key, NEW.sample_key', -1),
+    ('cube_samples_update_after', 'AFTER', 'UPDATE OF sample_key, subject_id, treatment_id, '
+     'time_from_treatment_start, response, sample_type ON samples', 'OLD.sample_key, NEW.sample_key', 1),
+    # its cell counts are deleted after it (ON DELETE CASCADE), by which time their triggers find no sample
+    ('cube_samples_delete', 'BEFORE', 'DELETE ON samples', 'OLD.sample_key', -1),
+    ('cube_subjects_update_before', 'BEFORE', 'UPDATE OF subject_id, project_id, condition, sex ON subjects',
+     'SELECT sample_key FROM samples WHERE subject_id IN (OLD.subject_id, NEW.subject_id)', -1),
+    ('cube_subjects_update_after', 'AFTER', 'UPDATE OF subject_id, project_id, condition, sex ON subjects',
+     'SELECT sample_key FROM samples WHERE subject_id IN (OLD.subject_id, NEW.subject_id)', 1),
+)
+
+# (name, event, the subjects it marks stale); see refresh_trajectories()
+TRAJECTORY_TRIGGERS = (
+    ('trajectories_samples_insert', 'INSERT ON samples', 'SELECT NEW.subject_id'),
+    ('trajectories_samples_update',
+     'UPDATE OF sample_key, subject_id, sample_type, time_from_treatment_start ON samples',
+     'SELECT OLD.subject_id UNION SELECT NEW.subject_id'),
+    ('trajectories_samples_delete', 'DELETE ON samples', 'SELECT OLD.subject_id'),
+    ('trajectories_counts_insert', 'INSERT ON cell_type_counts',
+     'SELECT subject_id FROM samples WHERE sample_key = NEW.sample_key'),
+    ('trajectories_counts_update', 'UPDATE OF sample_key, count ON cell_type_counts',
+     'SELECT subject_id FROM samples WHERE sample_key IN (OLD.sample_key, NEW.sample_key)'),
+    ('trajectories_counts_delete', 'DELETE ON cell_type_counts',
+     'SELECT subject_id FROM samples WHERE sample_key = OLD.sample_key'),
+)
+
+# CSV column holding each table's key, for deduping across chunks
+KEY_COLUMNS = {
+    'projects': 'project',
+    'subjects': 'subject',
+    'treatments': 'treatment',
+    'samples': 'sample',
+}
+
+
+def cube_rows(sample_keys, sign=1):
+    """
+    The frequency_cube rows the samples whose sample_key is IN (sample_keys) add up to, times sign: per population,
+    the samples, counts, and relative frequencies (%) and their squares summed, and for population NULL the
+    samples and their total counts. Relative frequencies are taken from the counts themselves, not sample_totals,
+    so the cube doesn't depend on which of their triggers runs first.
+    """
+    return f'''
+        SELECT
+            subjects.project_id, subjects.condition, samples.treatment_id, samples.sample_type,
+            samples.time_from_treatment_start, samples.response, subjects.sex, counts.cell_type_key,
+            {sign} * COUNT(*), {sign} * SUM(counts.count), {sign} * SUM(counts.frequency),
+            {sign} * SUM(counts.frequency * counts.frequency)
+        FROM (
+            SELECT
+                sample_key, cell_type_key, count,
+                100.0 * count / SUM(count) OVER (PARTITION BY sample_key) AS frequency
+            FROM cell_type_counts
+            WHERE sample_key IN ({sample_keys})
+        ) AS counts
+        JOIN samples ON samples.sample_key = counts.sample_key
+        JOIN subjects ON subjects.subject_id = samples.subject_id
+        WHERE counts.frequency IS NOT NULL
+        GROUP BY 1, 2, 3, 4, 5, 6, 7, 8
+        UNION ALL
+        SELECT
+            subjects.project_id, subjects.condition, samples.treatment_id, samples.sample_type,
+            samples.time_from_treatment_start, samples.response, subjects.sex, NULL,
+            {sign} * COUNT(*),
+            {sign} * SUM((SELECT COALESCE(SUM(count), 0) FROM cell_type_counts
+                          WHERE cell_type_counts.sample_key = samples.sample_key)),
+            0, 0
+        FROM samples
+        JOIN subjects ON subjects.subject_id = samples.subject_id
+        WHERE samples.sample_key IN ({sample_keys})
+        GROUP BY 1, 2, 3, 4, 5, 6, 7
+    '''
+
+
+def cube_upsert(sample_keys, sign):
+    """Add cube_rows(sample_keys, sign) into frequency_cube."""
+    # WHERE true tells the parser the ON CONFLICT belongs to the INSERT, not the SELECT's join
+    return f'''
+        INSERT INTO frequency_cube ({", ".join(CUBE_DIMENSIONS)}, {", ".join(CUBE_MEASURES)})
+        SELECT * FROM ({cube_rows(sample_keys, sign)}) WHERE true
+        ON CONFLICT ({CUBE_KEY}) DO UPDATE SET
+            {", ".join(f"{measure} = {measure} + excluded.{measure}" for measure in CUBE_MEASURES)}
+    '''
+
+
+def trajectory_rows(subjects=None):
+    """
+    subject_trajectories rows for the subjects IN (subjects), or every subject if None: each
+    population's relative frequency in every sample with a time from treatment start, against the subject's
+    baseline, its mean at time 0 in samples of the same type. Walks idx_samples_timeline, so each subject's
+    samples come in order and the baselines are windowed over them as they go.
+    """
+    where = "samples.time_from_treatment_start IS NOT NULL"
+    if subjects:
+        where += f" AND samples.subject_id IN ({subjects})"
+    return f'''
+        SELECT
+            subject_id, sample_type, cell_type_key, time_from_treatment_start, sample_key, relative_frequency,
+            baseline_frequency,
+            relative_frequency - baseline_frequency,
+            relative_frequency / NULLIF(baseline_frequency, 0)
+        FROM (
+            SELECT
+                samples.subject_id, samples.sample_type, cell_type_counts.cell_type_key,
+                samples.time_from_treatment_start, samples.sample_key,
+                100.0 * cell_type_counts.count / sample_totals.total_count AS relative_frequency,
+                AVG(100.0 * cell_type_counts.count / sample_totals.total_count)
+                    FILTER (WHERE samples.time_from_treatment_start = 0)
+                    OVER (PARTITION BY samples.subject_id, samples.sample_type, cell_type_counts.cell_type_key)
+                    AS baseline_frequency
+            FROM samples INDEXED BY idx_samples_timeline
+            JOIN cell_type_counts ON cell_type_counts.sample_key = samples.sample_key
+            JOIN sample_totals ON sample_totals.sample_key = samples.sample_key
+            WHERE {where}
+        )
+    '''
 
 
 def init_db(db_path):
     """Initialize the SQLite database."""
-    conn = get_connection()
+    conn = get_connection(db_path)
     cursor = conn.cursor()
 
-    cursor.execute('DROP TABLE IF EXISTS cell_counts')
+    cursor.execute('DROP TABLE IF EXISTS source_fingerprints')
+    cursor.execute('DROP TABLE IF EXISTS sample_totals')
+    cursor.execute('DROP TABLE IF EXISTS frequency_cube')
+    cursor.execute('DROP TABLE IF EXISTS subject_trajectories')
+    cursor.execute('DROP TABLE IF EXISTS stale_subjects')
+    # a view since cell_type_counts replaced it, a table in older databases
+    drop_table_or_view(cursor, 'cell_counts')
+    cursor.execute('DROP TABLE IF EXISTS cell_type_counts')
+    cursor.execute('DROP TABLE IF EXISTS cell_types')
     cursor.execute('DROP TABLE IF EXISTS samples')
     cursor.execute('DROP TABLE IF EXISTS treatments')
     cursor.execute('DROP TABLE IF EXISTS subjects')
     cursor.execute('DROP TABLE IF EXISTS projects')
 
+    create_schema(cursor)
+
+    conn.commit()
+    conn.close()
+
+
+def drop_table_or_view(cursor, name):
+    row = cursor.execute("SELECT type FROM sqlite_master WHERE name = ? AND type IN ('table', 'view')",
+                         (name,)).fetchone()
+    if row:
+        cursor.execute(f'DROP {row[0].upper()} {name}')
+
+
+def replace_trigger(cursor, triggers, trigger_sql):
+    """
+    Create the trigger in trigger_sql, replacing any of the same name, unless triggers ({name: sql}, as in
+    sqlite_master) already has it as it is. Any DDL makes every connection re-prepare its statements, so
+    create_schema() leaves triggers that are up to date alone.
+    """
+    trigger_sql = trigger_sql.strip()
+    name = trigger_sql.split()[2]
+    if triggers.get(name) != trigger_sql:
+        cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+        cursor.execute(trigger_sql)
+
+
+def create_schema(cursor):
+    """Create any missing tables. Safe to run against an existing database."""
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS projects (
             project_id TEXT PRIMARY KEY
@@ -36,9 +308,11 @@ def init_db(db_path):
         )
     ''')
 
+    # sample_key is the integer key cell counts are stored under; sample_id stays the key everything else uses
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS samples (
-            sample_id TEXT PRIMARY KEY,
+            sample_key INTEGER PRIMARY KEY,
+            sample_id TEXT NOT NULL UNIQUE,
             subject_id TEXT NOT NULL,
             treatment_id TEXT,
             time_from_treatment_start INTEGER,
@@ -49,57 +323,946 @@ def init_db(db_path):
         )
     ''')
 
+    # each population name stored once, under an integer key
     cursor.execute('''
-            CREATE TABLE IF NOT EXISTS cell_counts (
-                sample_id TEXT NOT NULL,
-                cell_type TEXT,
-                count INTEGER,
-                PRIMARY KEY (sample_id, cell_type),
-                FOREIGN KEY (sample_id) REFERENCES samples(sample_id) ON DELETE CASCADE
-            )
+        CREATE TABLE IF NOT EXISTS cell_types (
+            cell_type_key INTEGER PRIMARY KEY,
+            cell_type TEXT NOT NULL UNIQUE
+        )
+    ''')
+
+    # the counts by (sample_key, cell_type_key): WITHOUT ROWID stores the rows in the primary key's B-tree itself,
+    # so there's no separate rowid table and PK index, and integer keys take a byte or few instead of the names
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cell_type_counts (
+            sample_key INTEGER NOT NULL,
+            cell_type_key INTEGER NOT NULL,
+            count INTEGER,
+            PRIMARY KEY (sample_key, cell_type_key),
+            FOREIGN KEY (sample_key) REFERENCES samples(sample_key) ON DELETE CASCADE,
+            FOREIGN KEY (cell_type_key) REFERENCES cell_types(cell_type_key)
+        ) WITHOUT ROWID
+    ''')
+
+    # cell_counts as it was before cell_type_counts, by name, for ad-hoc queries and writes
+    cursor.execute('''
+        CREATE VIEW IF NOT EXISTS cell_counts AS
+        SELECT
+            samples.sample_id,
+            cell_types.cell_type,
+            cell_type_counts.count
+        FROM
+            cell_type_counts
+        JOIN samples ON samples.sample_key = cell_type_counts.sample_key
+        JOIN cell_types ON cell_types.cell_type_key = cell_type_counts.cell_type_key
+    ''')
+
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS cell_counts_insert INSTEAD OF INSERT ON cell_counts
+        BEGIN
+            INSERT OR IGNORE INTO cell_types (cell_type) VALUES (NEW.cell_type);
+            INSERT INTO cell_type_counts (sample_key, cell_type_key, count)
+            VALUES ({SAMPLE_KEY_SQL.replace('?', 'NEW.sample_id')}, {CELL_TYPE_KEY_SQL.replace('?', 'NEW.cell_type')},
+                    NEW.count);
+        END
+    ''')
+
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS cell_counts_update INSTEAD OF UPDATE OF count ON cell_counts
+        BEGIN
+            UPDATE cell_type_counts SET count = NEW.count
+            WHERE sample_key = {SAMPLE_KEY_SQL.replace('?', 'OLD.sample_id')}
+              AND cell_type_key = {CELL_TYPE_KEY_SQL.replace('?', 'OLD.cell_type')};
+        END
+    ''')
+
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS cell_counts_delete INSTEAD OF DELETE ON cell_counts
+        BEGIN
+            DELETE FROM cell_type_counts
+            WHERE sample_key = {SAMPLE_KEY_SQL.replace('?', 'OLD.sample_id')}
+              AND cell_type_key = {CELL_TYPE_KEY_SQL.replace('?', 'OLD.cell_type')};
+        END
+    ''')
+
+    # hash of each sample's CSV row as of the last load, for incremental reloads
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS source_fingerprints (
+            sample_id TEXT PRIMARY KEY,
+            row_hash INTEGER NOT NULL,
+            FOREIGN KEY (sample_id) REFERENCES samples(sample_id) ON DELETE CASCADE
+        )
+    ''')
+
+    # join/filter keys, with the child's key appended so lookups and ordered walks are covered by the index
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_subjects_project ON subjects (project_id, subject_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_samples_subject ON samples (subject_id, sample_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_samples_treatment ON samples (treatment_id, sample_id)')
+    # (cell_type_key, count, sample_key): a population's counts in order, for its min/max and population filters
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_cell_type_counts_cell_type ON cell_type_counts (cell_type_key, count)')
+
+    # SUM(count) per sample, kept current by the triggers below so relative frequencies don't re-aggregate the counts,
+    # and its number of cell_type_counts rows, so the Frequencies grid's rows are counted a sample at a time
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sample_totals (
+            sample_key INTEGER PRIMARY KEY,
+            total_count INTEGER NOT NULL DEFAULT 0,
+            num_counts INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (sample_key) REFERENCES samples(sample_key) ON DELETE CASCADE
+        )
+    ''')
+    # databases from before num_counts get theirs counted the first time they're opened
+    if 'num_counts' not in {row[1] for row in cursor.execute('PRAGMA table_info(sample_totals)')}:
+        cursor.execute('ALTER TABLE sample_totals ADD COLUMN num_counts INTEGER NOT NULL DEFAULT 0')
+        cursor.execute('''
+            UPDATE sample_totals SET num_counts = (
+                SELECT COUNT(*) FROM cell_type_counts WHERE cell_type_counts.sample_key = sample_totals.sample_key)
+        ''')
+
+    triggers = dict(cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'"))
+    replace_trigger(cursor, triggers, '''
+        CREATE TRIGGER cell_counts_totals_insert AFTER INSERT ON cell_type_counts
+        BEGIN
+            INSERT INTO sample_totals (sample_key, total_count, num_counts)
+            VALUES (NEW.sample_key, COALESCE(NEW.count, 0), 1)
+            ON CONFLICT (sample_key) DO UPDATE SET total_count = total_count + excluded.total_count,
+                num_counts = num_counts + 1;
+        END
+    ''')
+
+    replace_trigger(cursor, triggers, '''
+        CREATE TRIGGER cell_counts_totals_update AFTER UPDATE OF sample_key, count ON cell_type_counts
+        BEGIN
+            UPDATE sample_totals SET total_count = total_count - COALESCE(OLD.count, 0), num_counts = num_counts - 1
+            WHERE sample_key = OLD.sample_key;
+            INSERT INTO sample_totals (sample_key, total_count, num_counts)
+            VALUES (NEW.sample_key, COALESCE(NEW.count, 0), 1)
+            ON CONFLICT (sample_key) DO UPDATE SET total_count = total_count + excluded.total_count,
+                num_counts = num_counts + 1;
+        END
+    ''')
+
+    replace_trigger(cursor, triggers, '''
+        CREATE TRIGGER cell_counts_totals_delete AFTER DELETE ON cell_type_counts
+        BEGIN
+            UPDATE sample_totals SET total_count = total_count - COALESCE(OLD.count, 0), num_counts = num_counts - 1
+            WHERE sample_key = OLD.sample_key;
+        END
     ''')
 
+    # cohort summaries by CUBE_DIMENSIONS, kept current by CUBE_TRIGGERS so they're read without touching the counts;
+    # means and variances of relative frequency follow from num_samples, sum_frequency and sum_squares
+    new_cube = not cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'frequency_cube'").fetchone()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS frequency_cube (
+            project_id TEXT,
+            condition TEXT,
+            treatment_id TEXT,
+            sample_type TEXT,
+            time_from_treatment_start INTEGER,
+            response TEXT,
+            sex TEXT,
+            cell_type_key INTEGER,
+            num_samples INTEGER NOT NULL,
+            sum_count INTEGER,
+            sum_frequency REAL,
+            sum_squares REAL
+        )
+    ''')
+    cursor.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS idx_frequency_cube_key ON frequency_cube ({CUBE_KEY})')
+    for name, timing, event, sample_keys, sign in CUBE_TRIGGERS:
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {name} {timing} {event}
+            BEGIN
+                {cube_upsert(sample_keys, sign)};
+            END
+        ''')
+    # databases from before the cube get theirs built the first time they're opened
+    if new_cube:
+        rebuild_frequency_cube(cursor)
+
+    # each subject's samples in timeline order, for the trajectories below
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_samples_timeline '
+                   'ON samples (subject_id, sample_type, time_from_treatment_start)')
+
+    # every population's change from each subject's baseline, materialized so the dashboard doesn't self-join
+    # the relative frequencies; only the subjects queued in stale_subjects are recomputed (refresh_trajectories)
+    new_trajectories = not cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'subject_trajectories'").fetchone()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS subject_trajectories (
+            subject_id TEXT NOT NULL,
+            sample_type TEXT,
+            cell_type_key INTEGER NOT NULL,
+            time_from_treatment_start INTEGER NOT NULL,
+            sample_key INTEGER NOT NULL,
+            relative_frequency REAL,
+            baseline_frequency REAL,
+            delta REAL,
+            fold_change REAL,
+            PRIMARY KEY (subject_id, cell_type_key, sample_key)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE TABLE IF NOT EXISTS stale_subjects (subject_id TEXT PRIMARY KEY) WITHOUT ROWID')
+    for name, event, subjects in TRAJECTORY_TRIGGERS:
+        # an upsert's ON CONFLICT, unlike OR IGNORE (which earlier versions used), isn't overridden by the conflict
+        # handling of the statement that fired the trigger (e.g. an incremental reload's upserts)
+        replace_trigger(cursor, triggers, f'''
+            CREATE TRIGGER {name} AFTER {event}
+            BEGIN
+                INSERT INTO stale_subjects (subject_id) SELECT * FROM ({subjects}) WHERE true
+                ON CONFLICT (subject_id) DO NOTHING;
+            END
+        ''')
+    if new_trajectories:
+        cursor.execute('INSERT OR IGNORE INTO stale_subjects (subject_id) SELECT subject_id FROM subjects')
+
+
+def drop_totals_triggers(cursor):
+    """
+    Bulk loads drop the sample_totals, frequency_cube and trajectory triggers and rebuild all three in one pass
+    afterwards (rebuild_sample_totals), which is several times cheaper than a write per cell count.
+    """
+    for trigger in (*TOTALS_TRIGGERS, *(name for name, *_ in TRAJECTORY_TRIGGERS)):
+        cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    drop_cube_triggers(cursor)
+
+
+def drop_cube_triggers(cursor):
+    """Drop the frequency_cube triggers; create_schema() restores them."""
+    for name, *_ in CUBE_TRIGGERS:
+        cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+
+
+def rebuild_frequency_cube(cursor):
+    """
+    Recompute frequency_cube from scratch. Returns the number of cube rows.
+    Each sample's slice is numbered first, so its counts are grouped by two integers rather than
+    eight columns, about three times faster than cube_rows() over every sample. Totals come from sample_totals,
+    so it must be current.
+    """
+    slice_columns = ('subjects.project_id, subjects.condition, samples.treatment_id, samples.sample_type, '
+                     'samples.time_from_treatment_start, samples.response, subjects.sex')
+    cursor.execute('DELETE FROM frequency_cube')
+    cursor.execute('DROP TABLE IF EXISTS temp.cube_slices')
+    cursor.execute(f'''
+        CREATE TEMP TABLE cube_slices AS
+        SELECT
+            samples.sample_key,
+            {slice_columns},
+            dense_rank() OVER (ORDER BY {slice_columns}) AS slice,
+            sample_totals.total_count
+        FROM samples
+        JOIN subjects ON subjects.subject_id = samples.subject_id
+        LEFT JOIN sample_totals ON sample_totals.sample_key = samples.sample_key
+    ''')
+    # a slice's columns are the same in all its rows, so they're taken from any of them
+    slice_dimensions = ", ".join(CUBE_DIMENSIONS[:-1])
+    cursor.execute(f'''
+        INSERT INTO frequency_cube ({", ".join(CUBE_DIMENSIONS)}, {", ".join(CUBE_MEASURES)})
+        SELECT {slice_dimensions}, cell_type_key, COUNT(*), SUM(count), SUM(frequency), SUM(frequency * frequency)
+        FROM (
+            SELECT
+                cube_slices.*, cell_type_counts.cell_type_key, cell_type_counts.count,
+                100.0 * cell_type_counts.count / cube_slices.total_count AS frequency
+            FROM temp.cube_slices
+            CROSS JOIN cell_type_counts ON cell_type_counts.sample_key = cube_slices.sample_key
+        )
+        WHERE frequency IS NOT NULL
+        GROUP BY slice, cell_type_key
+        UNION ALL
+        SELECT {slice_dimensions}, NULL, COUNT(*), COALESCE(SUM(total_count), 0), 0, 0
+        FROM temp.cube_slices
+        GROUP BY slice
+    ''')
+    rows = cursor.rowcount
+    cursor.execute('DROP TABLE temp.cube_slices')
+    return rows
+
+
+def rebuild_trajectories(cursor):
+    """Recompute subject_trajectories for every subject. Returns the number of rows."""
+    cursor.execute('DELETE FROM subject_trajectories')
+    cursor.execute(f'INSERT INTO subject_trajectories {trajectory_rows()}')
+    rows = cursor.rowcount
+    cursor.execute('DELETE FROM stale_subjects')
+    return rows
+
+
+def refresh_trajectories(cursor):
+    """
+    Recompute subject_trajectories for the subjects in stale_subjects, which triggers on samples and
+    cell_type_counts queue, and empty it. Sample totals must be current. Returns the number of subjects refreshed.
+    Called by each write to samples or counts, in its own transaction, so reading the trajectories never writes.
+    """
+    stale = cursor.execute('SELECT COUNT(*) FROM stale_subjects').fetchone()[0]
+    if stale:
+        cursor.execute('DELETE FROM subject_trajectories WHERE subject_id IN (SELECT subject_id FROM stale_subjects)')
+        cursor.execute(f'INSERT INTO subject_trajectories '
+                       f'{trajectory_rows("SELECT subject_id FROM stale_subjects")}')
+        cursor.execute('DELETE FROM stale_subjects')
+    return stale
+
+
+def rebuild_sample_totals(cursor):
+    """
+    Recompute sample_totals, frequency_cube and subject_trajectories from scratch and restore their triggers.
+    Returns the number of samples totalled.
+    """
+    cursor.execute('DELETE FROM sample_totals')
+    cursor.execute('''
+        INSERT INTO sample_totals (sample_key, total_count, num_counts)
+        SELECT sample_key, SUM(COALESCE(count, 0)), COUNT(*)
+        FROM cell_type_counts
+        GROUP BY sample_key
+    ''')
+    totalled = cursor.rowcount
+    rebuild_frequency_cube(cursor)
+    create_schema(cursor)
+    rebuild_trajectories(cursor)
+    return totalled
+
+
+def build_tables(df, cell_types=CELL_TYPES):
+    """
+    Split the wide CSV frame into row frames for each table, with a count column for each of cell_types.
+    Cell types are melted into long form once, with NumPy reshapes instead of per-row loops.
+    """
+    projects = df[['project']].drop_duplicates()
+    subjects = df[['subject', 'project', 'condition', 'age', 'sex']].drop_duplicates('subject')
+    treatments = df[['treatment']].dropna().drop_duplicates()
+    samples = df[['sample', 'subject', 'treatment',
+                  'time_from_treatment_start', 'response', 'sample_type']].drop_duplicates('sample')
+
+    # row-major ravel keeps each sample's cell types together, so the PK index is filled in order
+    counts = df[cell_types].to_numpy()
+    cell_counts = pd.DataFrame({
+        'sample': np.repeat(df['sample'].to_numpy(), len(cell_types)),
+        'cell_type': np.tile(np.array(cell_types, dtype=object), len(df)),
+        'count': counts.ravel(),
+    }).drop_duplicates(['sample', 'cell_type'])
+
+    return {
+        'projects': projects,
+        'subjects': subjects,
+        'treatments': treatments,
+        'samples': samples,
+        'cell_types': pd.DataFrame({'cell_type': cell_types}),
+        'cell_counts': cell_counts,
+    }
+
+
+def fingerprint_samples(df):
+    """One hash per sample over its whole CSV row, so reloads can tell which samples changed."""
+    rows = df.drop_duplicates('sample')
+    hashes = pd.util.hash_pandas_object(rows, index=False).to_numpy()
+    return pd.DataFrame({
+        'sample': rows['sample'].to_numpy(),
+        'row_hash': hashes.view(np.int64),  # SQLite integers are signed
+    })
+
+
+def iter_rows(frame):
+    """Yield plain Python tuples (no NumPy scalars) for sqlite3."""
+    return zip(*(frame[column].tolist() for column in frame.columns))
+
+
+def insert_rows(cursor, sql, rows, batch_size=BATCH_SIZE):
+    """Write rows with executemany in fixed-size batches. Returns the number of rows sent."""
+    rows = iter(rows)
+    total = 0
+    while batch := list(islice(rows, batch_size)):
+        cursor.executemany(sql, batch)
+        total += len(batch)
+    return total
+
+
+def write_tables(cursor, tables, statements=INSERT_SQL, progress=None):
+    """
+    Insert the frames from build_tables(), parents before children. Returns rows written.
+    progress, if given, is called with (fraction of rows written, message) before each table.
+    """
+    total = sum(len(tables[table]) for table in statements if table in tables)
+    written = 0
+    for table, sql in statements.items():
+        if table not in tables:
+            continue
+        if progress:
+            progress(written / total if total else 0.0, f"Writing {table}")
+        written += insert_rows(cursor, sql, iter_rows(tables[table]))
+    return written
+
+
+def scaled(progress, start, end):
+    """Map a sub-step's 0-1 progress onto [start, end] of the overall progress."""
+    if progress is None:
+        return None
+    return lambda fraction, message: progress(start + (end - start) * fraction, message)
+
+
+def print_progress(fraction, message):
+    """Progress callback for --progress; fraction is None when the total is unknown."""
+    fraction = "-" if fraction is None else f"{fraction:.3f}"
+    print(f"{PROGRESS_PREFIX} {fraction} {message}", flush=True)
+
+
+def load_data_from_csv(file_path, db_path=None, progress=None, cell_types=CELL_TYPES):
+    """
+    Bulk load the CSV in a single transaction.
+    Returns load stats, including rows/sec, so regressions can be tracked.
+    """
+    start = time.perf_counter()
+    if progress:
+        progress(0.0, "Reading CSV")
+    df = pd.read_csv(file_path)
+    if progress:
+        progress(0.1, "Building tables")
+    tables = build_tables(df, cell_types)
+    tables['source_fingerprints'] = fingerprint_samples(df)
+
+    conn = get_connection(db_path)
+    for pragma in LOAD_PRAGMAS:
+        conn.execute(pragma)
+    cursor = conn.cursor()
+    drop_totals_triggers(cursor)
+    rows_written = write_tables(cursor, tables, progress=scaled(progress, 0.2, 0.95))
+    if progress:
+        progress(0.95, "Totalling samples")
+    rebuild_sample_totals(cursor)
+    # fresh statistics so the planner picks the indexes above
+    cursor.execute('ANALYZE')
+    conn.commit()
+    conn.close()
+
+    return load_stats(len(df), rows_written, start)
+
+
+def snapshot_tables(snapshot_dir):
+    """
+    Row frames for each table, as build_tables() makes them from the CSV, read back from a snapshot written
+    by snapshot.py: the tables' rows come from the samples snapshot and their cell counts from the frequencies one.
+    """
+    samples = read_snapshot('samples', snapshot_dir).to_pandas().rename(columns={
+        'project_id': 'project', 'subject_id': 'subject', 'treatment_id': 'treatment', 'sample_id': 'sample'})
+    cell_counts = read_snapshot('frequencies', snapshot_dir, ['sample_id', 'population', 'count']).to_pandas()
+    return {
+        'projects': samples[['project']].drop_duplicates(),
+        'subjects': samples[['subject', 'project', 'condition', 'age', 'sex']].drop_duplicates('subject'),
+        'treatments': samples[['treatment']].dropna().drop_duplicates(),
+        'samples': samples[['sample', 'subject', 'treatment',
+                            'time_from_treatment_start', 'response', 'sample_type']],
+        'cell_types': cell_counts[['population']].drop_duplicates().rename(columns={'population': 'cell_type'}),
+        'cell_counts': cell_counts.rename(columns={'sample_id': 'sample', 'population': 'cell_type'}),
+    }
+
+
+def load_data_from_snapshot(snapshot_dir, db_path=None, progress=None):
+    """
+    Bulk load a snapshot written by snapshot.py, like load_data_from_csv() does the CSV.
+    Snapshots carry no CSV fingerprints, so the first --incremental reload afterwards upserts every sample once.
+    """
+    start = time.perf_counter()
+    if progress:
+        progress(0.0, "Reading snapshot")
+    tables = snapshot_tables(snapshot_dir)
+
+    conn = get_connection(db_path)
+    for pragma in LOAD_PRAGMAS:
+        conn.execute(pragma)
+    cursor = conn.cursor()
+    drop_totals_triggers(cursor)
+    rows_written = write_tables(cursor, tables, progress=scaled(progress, 0.1, 0.95))
+    if progress:
+        progress(0.95, "Totalling samples")
+    rebuild_sample_totals(cursor)
+    cursor.execute('ANALYZE')
+    conn.commit()
+    conn.close()
+
+    return load_stats(len(tables['samples']), rows_written, start)
+
+
+def load_stats(csv_rows, rows_written, start):
+    elapsed = time.perf_counter() - start
+    return {
+        'csv_rows': csv_rows,
+        'rows_written': rows_written,
+        'seconds': elapsed,
+        'rows_per_sec': csv_rows / elapsed if elapsed else float('inf'),
+    }
+
+
+class SeenKeys:
+    """
+    Keys already written in earlier chunks, so repeated parent rows are skipped.
+    Memory is bounded by max_keys: once full it starts over, and INSERT OR IGNORE
+    keeps any duplicate that slips through harmless.
+    """
+
+    def __init__(self, max_keys=DEDUPE_MAX_KEYS):
+        self.max_keys = max_keys
+        self.keys = set()
+
+    def new_mask(self, values):
+        return np.fromiter((value not in self.keys for value in values), dtype=bool, count=len(values))
+
+    def add(self, values):
+        if len(self.keys) + len(values) > self.max_keys:
+            self.keys.clear()
+        self.keys.update(values)
+
+
+def drop_seen(tables, seen):
+    """Filter a chunk's tables down to keys not written by earlier chunks."""
+    tables = dict(tables)
+    for table, column in KEY_COLUMNS.items():
+        frame = tables[table]
+        keys = frame[column].tolist()
+        mask = seen[table].new_mask(keys)
+        if table == 'samples':
+            # child rows of an already-loaded sample were loaded with it
+            dropped = set(frame[column][~mask].tolist())
+            for child in ('cell_counts', 'source_fingerprints'):
+                rows = tables[child]
+                tables[child] = rows[~rows['sample'].isin(dropped)]
+        tables[table] = frame[mask]
+        seen[table].add(frame[column][mask].tolist())
+    return tables
+
+
+def resolve_sources(source):
+    """Expand a CSV file, a directory of CSV shards, or a glob pattern into a sorted file list."""
+    path = Path(source)
+    if path.is_dir():
+        return sorted(path.glob('*.csv'))
+    if glob.has_magic(str(source)):
+        return sorted(Path(match) for match in glob.glob(str(source)))
+    return [path]
+
+
+def parse_chunks(file_path, chunksize):
+    """Yield (csv_rows, tables) for each fixed-size chunk of one CSV file."""
+    for chunk in pd.read_csv(file_path, chunksize=chunksize):
+        tables = build_tables(chunk)
+        tables['source_fingerprints'] = fingerprint_samples(chunk)
+        yield len(chunk), tables
+
+
+def _parse_worker(file_paths, chunksize, queue):
+    try:
+        for file_path in file_paths:
+            for parsed in parse_chunks(file_path, chunksize):
+                queue.put(parsed)
+    except Exception as e:
+        queue.put(e)
+    finally:
+        queue.put(None)
+
+
+def iter_parsed_chunks(file_paths, chunksize, workers=1):
+    """
+    Yield parsed chunks from every file.
+    With workers > 1, shards are parsed in worker processes feeding this (single writer) process
+    through a bounded queue, so at most a few chunks are held in memory at once.
+    """
+    workers = min(workers, len(file_paths))
+    if workers <= 1:
+        for file_path in file_paths:
+            yield from parse_chunks(file_path, chunksize)
+        return
+
+    queue = mp.Queue(maxsize=2 * workers)
+    processes = [
+        mp.Process(target=_parse_worker, args=(file_paths[i::workers], chunksize, queue), daemon=True)
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    try:
+        finished = 0
+        while finished < workers:
+            parsed = queue.get()
+            if parsed is None:
+                finished += 1
+            elif isinstance(parsed, Exception):
+                raise parsed
+            else:
+                yield parsed
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+
+def load_data_streaming(source, chunksize=CHUNK_SIZE, workers=1, max_keys=DEDUPE_MAX_KEYS,
+                        db_path=None, progress=None):
+    """
+    Load a CSV, a directory of CSV shards, or a glob of shards in fixed-size chunks.
+    Each chunk is committed on its own, so peak memory stays flat regardless of file size.
+    Returns the same load stats as load_data_from_csv.
+    The total row count is unknown up front, so progress is reported without a fraction.
+    """
+    start = time.perf_counter()
+    file_paths = resolve_sources(source)
+    if not file_paths:
+        raise FileNotFoundError(f"No CSV files found for {source}")
+
+    conn = get_connection(db_path)
+    for pragma in LOAD_PRAGMAS:
+        conn.execute(pragma)
+    cursor = conn.cursor()
+
+    seen = {table: SeenKeys(max_keys) for table in KEY_COLUMNS}
+    csv_rows = 0
+    rows_written = 0
+    drop_totals_triggers(cursor)
+    for chunk_rows, tables in iter_parsed_chunks(file_paths, chunksize, workers):
+        rows_written += write_tables(cursor, drop_seen(tables, seen))
+        conn.commit()
+        csv_rows += chunk_rows
+        if progress:
+            progress(None, f"Loaded {csv_rows:,} rows")
+
+    if progress:
+        progress(None, "Totalling samples")
+    rebuild_sample_totals(cursor)
+    cursor.execute('ANALYZE')
     conn.commit()
+
     conn.close()
+    return load_stats(csv_rows, rows_written, start)
 
 
-def load_data_from_csv(file_path):
+def load_data_incremental(file_path, db_path=None, progress=None, cell_types=CELL_TYPES):
+    """
+    Apply only what changed in the CSV since the last load, without dropping any tables.
+    Samples are matched by their row fingerprints: new and changed samples are upserted,
+    and samples that were loaded from the CSV but are no longer in it are deleted.
+    Rows added through the dashboard have no fingerprint and are left alone.
+    frequency_cube is updated by one statement before the writes and one after, rather than by its per-row
+    triggers, which re-aggregate a sample for each of its counts written, and the changed subjects'
+    trajectories are refreshed in the same transaction.
+    """
+    start = time.perf_counter()
+    if progress:
+        progress(0.0, "Reading CSV")
     df = pd.read_csv(file_path)
-    conn = get_connection()
+    fingerprints = fingerprint_samples(df)
+
+    migrate_cell_counts(db_path)
+    conn = get_connection(db_path)
     cursor = conn.cursor()
-    for project_id in df['project'].unique():
-        cursor.execute('INSERT OR IGNORE INTO projects (project_id) VALUES (?)', (project_id,))
+    create_schema(cursor)
 
-    subjects = df[['subject', 'project', 'condition', 'age', 'sex']].drop_duplicates()
-    for _, row in subjects.iterrows():
-        cursor.execute('''
-            INSERT OR IGNORE INTO subjects (subject_id, project_id, condition, age, sex)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (row['subject'], row['project'], row['condition'], row['age'], row['sex']))
+    if progress:
+        progress(0.3, "Comparing fingerprints")
+    stored = dict(cursor.execute('SELECT sample_id, row_hash FROM source_fingerprints'))
+    current = dict(zip(fingerprints['sample'].tolist(), fingerprints['row_hash'].tolist()))
+    added = [sample for sample in current if sample not in stored]
+    changed = [sample for sample, row_hash in current.items() if sample in stored and stored[sample] != row_hash]
+    removed = [sample for sample in stored if sample not in current]
 
-    for treatment_id in df['treatment'].unique():
-        cursor.execute('INSERT OR IGNORE INTO treatments (treatment_id) VALUES (?)', (treatment_id,))
+    delta = set(added) | set(changed)
+    tables = build_tables(df[df['sample'].isin(delta)], cell_types)
+    tables['source_fingerprints'] = fingerprints[fingerprints['sample'].isin(delta)]
 
-    samples = df[['sample', 'subject', 'treatment',
-                  'time_from_treatment_start', 'response', 'sample_type']].drop_duplicates()
-    for _, row in samples.iterrows():
-        cursor.execute('''
-            INSERT OR IGNORE INTO samples (sample_id, subject_id, treatment_id, time_from_treatment_start, response, sample_type)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (row['sample'], row['subject'], row['treatment'], row['time_from_treatment_start'], row['response'], row['sample_type']))
+    # the samples reloaded or removed, and every sample of their subjects, whose attributes may change too
+    # (dashboard-added samples of theirs included), are taken out of the cube here and added back after the writes
+    drop_cube_triggers(cursor)
+    cursor.execute('CREATE TEMP TABLE IF NOT EXISTS reloaded_samples (sample_id TEXT PRIMARY KEY) WITHOUT ROWID')
+    cursor.execute('CREATE TEMP TABLE IF NOT EXISTS reloaded_subjects (subject_id TEXT PRIMARY KEY) WITHOUT ROWID')
+    cursor.execute('DELETE FROM temp.reloaded_samples')
+    cursor.execute('DELETE FROM temp.reloaded_subjects')
+    insert_rows(cursor, 'INSERT OR IGNORE INTO temp.reloaded_samples (sample_id) VALUES (?)',
+                ((sample,) for sample in [*delta, *removed]))
+    insert_rows(cursor, 'INSERT OR IGNORE INTO temp.reloaded_subjects (subject_id) VALUES (?)',
+                ((subject,) for subject in tables['subjects']['subject']))
+    cursor.execute('INSERT OR IGNORE INTO temp.reloaded_subjects (subject_id) SELECT subject_id FROM samples '
+                   'WHERE sample_id IN (SELECT sample_id FROM temp.reloaded_samples)')
+    # a UNION rather than an OR, so each side is looked up through its index instead of scanning samples
+    reloaded = ('SELECT sample_key FROM samples WHERE sample_id IN (SELECT sample_id FROM temp.reloaded_samples) '
+                'UNION SELECT sample_key FROM samples '
+                'WHERE subject_id IN (SELECT subject_id FROM temp.reloaded_subjects)')
+    cursor.execute(cube_upsert(reloaded, -1))
 
-    for _, row in df.iterrows():
-        for cell_type in CELL_TYPES:
-            cursor.execute('''
-                INSERT OR IGNORE INTO cell_counts (sample_id, cell_type, count)
-                VALUES (?, ?, ?)
-            ''', (row['sample'], cell_type, row[cell_type]))
+    # cell counts and fingerprints of removed samples go with them (ON DELETE CASCADE)
+    if progress:
+        progress(0.4, f"Removing {len(removed)} samples")
+    insert_rows(cursor, 'DELETE FROM samples WHERE sample_id = ?', ((sample,) for sample in removed))
+    write_tables(cursor, tables, UPSERT_SQL, progress=scaled(progress, 0.5, 1.0))
+    cursor.execute(cube_upsert(reloaded, 1))
+    create_schema(cursor)
+    refresh_trajectories(cursor)
+    conn.commit()
+    conn.close()
+
+    return {
+        'added': len(added),
+        'changed': len(changed),
+        'removed': len(removed),
+        'unchanged': len(current) - len(delta),
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def build_database(build, db_path):
+    """Run build(db_path) against a fresh database file, removing the partial file if it fails."""
+    try:
+        return build(db_path)
+    except BaseException:
+        Path(db_path).unlink(missing_ok=True)
+        raise
+
+
+def rebuild_atomically(build, db_path=None):
+    """
+    Run build(tmp_path) against a fresh temporary database next to db_path, then rename it into place.
+    The rename is atomic, so readers see either the old database or the finished new one, never a
+    half-loaded one.
+    """
+    tmp_path = make_temp_db_path(db_path)
+    result = build_database(build, tmp_path)
+    replace_database_file(tmp_path, db_path)
+    return result
 
+
+def backfill_sample_totals(db_path=None):
+    """
+    Recompute sample_totals from cell_counts, creating it (and its triggers) if missing.
+    For databases created before sample_totals existed. Returns the number of samples totalled.
+    """
+    # databases from before cell_types are migrated, which totals them too
+    migrate_cell_counts(db_path)
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+    create_schema(cursor)
+    totalled = rebuild_sample_totals(cursor)
     conn.commit()
     conn.close()
+    return totalled
+
+
+# tables rebuilt by migrate_cell_counts(), children first
+MIGRATED_TABLES = ('source_fingerprints', 'sample_totals', 'cell_counts', 'samples')
+
+
+def migrate_cell_counts(db_path=None):
+    """
+    Move a database created before cell_types existed to the current layout, keeping every row (the sample_id
+    of a row added through the dashboard included): samples get their integer sample_key, cell_counts is
+    moved into cell_types and cell_type_counts, and sample_totals is rebuilt. The file is vacuumed afterwards
+    to give back the space. Returns False if the database already has the current layout.
+    """
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+    if cursor.execute("SELECT type FROM sqlite_master WHERE name = 'cell_counts'").fetchone() != ('table',):
+        conn.close()
+        return False
+
+    # the old tables are renamed out of the way and dropped, so neither their foreign keys nor the references
+    # to them are kept up to date in between; foreign_key_check below checks the result instead
+    conn.execute('PRAGMA foreign_keys = OFF')
+    conn.execute('PRAGMA legacy_alter_table = ON')
+    cursor.execute('BEGIN')
+    drop_totals_triggers(cursor)
+    for index in ('idx_samples_subject', 'idx_samples_treatment', 'idx_cell_counts_cell_type'):
+        cursor.execute(f'DROP INDEX IF EXISTS {index}')
+    # databases older still may not have sample_totals or source_fingerprints yet
+    existing = {name for name, in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    migrated = [table for table in MIGRATED_TABLES if table in existing]
+    for table in migrated:
+        cursor.execute(f'ALTER TABLE {table} RENAME TO old_{table}')
+
+    create_schema(cursor)
+    drop_totals_triggers(cursor)
+    # keys handed out in sample_id order, so counts are stored in the order pages read them
+    cursor.execute('''
+        INSERT INTO samples (sample_id, subject_id, treatment_id, time_from_treatment_start, response, sample_type)
+        SELECT sample_id, subject_id, treatment_id, time_from_treatment_start, response, sample_type
+        FROM old_samples
+        ORDER BY sample_id
+    ''')
+    cursor.execute('''
+        INSERT INTO cell_types (cell_type)
+        SELECT DISTINCT cell_type FROM old_cell_counts WHERE cell_type IS NOT NULL ORDER BY cell_type
+    ''')
+    cursor.execute('''
+        INSERT INTO cell_type_counts (sample_key, cell_type_key, count)
+        SELECT samples.sample_key, cell_types.cell_type_key, old_cell_counts.count
+        FROM old_cell_counts
+        JOIN samples ON samples.sample_id = old_cell_counts.sample_id
+        JOIN cell_types ON cell_types.cell_type = old_cell_counts.cell_type
+        ORDER BY 1, 2
+    ''')
+    if 'source_fingerprints' in migrated:
+        cursor.execute('INSERT INTO source_fingerprints SELECT * FROM old_source_fingerprints')
+    for table in migrated:
+        cursor.execute(f'DROP TABLE old_{table}')
+    rebuild_sample_totals(cursor)
+
+    problems = cursor.execute('PRAGMA foreign_key_check').fetchall()
+    if problems:
+        conn.rollback()
+        conn.close()
+        raise RuntimeError(f"Migration left {len(problems)} rows with broken foreign keys, e.g. {problems[0]}")
+    cursor.execute('ANALYZE')
+    conn.commit()
+    conn.execute('VACUUM')
+    conn.close()
+    return True
+
+
+def verify_sample_totals(db_path=None):
+    """
+    Return (sample_id, expected, stored) for every sample whose stored total or number of counts disagrees with
+    cell_counts, each as a (total_count, num_counts) pair.
+    """
+    conn = get_connection(db_path)
+    mismatches = conn.execute('''
+        SELECT samples.sample_id, expected_total, expected_counts, stored_total, stored_counts
+        FROM (
+            SELECT
+                counts.sample_key,
+                counts.expected_total,
+                counts.expected_counts,
+                sample_totals.total_count AS stored_total,
+                sample_totals.num_counts AS stored_counts
+            FROM (
+                SELECT sample_key, SUM(COALESCE(count, 0)) AS expected_total, COUNT(*) AS expected_counts
+                FROM cell_type_counts
+                GROUP BY sample_key
+            ) AS counts
+            LEFT JOIN sample_totals ON counts.sample_key = sample_totals.sample_key
+            UNION ALL
+            -- totals left behind for samples with no cell counts should have dropped to 0
+            SELECT sample_key, 0, 0, total_count, num_counts
+            FROM sample_totals
+            WHERE (total_count != 0 OR num_counts != 0)
+              AND NOT EXISTS (SELECT 1 FROM cell_type_counts WHERE cell_type_counts.sample_key = sample_totals.sample_key)
+        ) AS checked
+        JOIN samples ON samples.sample_key = checked.sample_key
+        WHERE stored_total IS NOT expected_total OR stored_counts IS NOT expected_counts
+        ORDER BY samples.sample_id
+    ''').fetchall()
+    mismatches = [(sample_id, (expected_total, expected_counts), (stored_total, stored_counts))
+                  for sample_id, expected_total, expected_counts, stored_total, stored_counts in mismatches]
+    conn.close()
+    return mismatches
+
+
+def verify_frequency_cube(db_path=None):
+    """
+    Return (cube key, expected measures, stored measures) for every frequency_cube row that disagrees with
+    the cube rebuilt from the current rows, relative frequencies to within rounding.
+    """
+    conn = get_connection(db_path)
+    columns = [*CUBE_DIMENSIONS, *CUBE_MEASURES]
+    expected = {row[:len(CUBE_DIMENSIONS)]: row[len(CUBE_DIMENSIONS):] for row in conn.execute(
+        f'SELECT * FROM ({cube_rows("SELECT sample_key FROM samples")})')}
+    # slices whose samples have all gone are left with num_samples 0, which is the same as no row
+    stored = {row[:len(CUBE_DIMENSIONS)]: row[len(CUBE_DIMENSIONS):] for row in conn.execute(
+        f'SELECT {", ".join(columns)} FROM frequency_cube WHERE num_samples != 0')}
+    conn.close()
+
+    def same(a, b):
+        return a is not None and b is not None and a[:2] == b[:2] and all(
+            abs(x - y) <= 1e-6 * max(1.0, abs(x)) for x, y in zip(a[2:], b[2:]))
+
+    return [(key, expected.get(key), stored.get(key)) for key in sorted(expected.keys() | stored.keys(), key=str)
+            if not same(expected.get(key), stored.get(key))]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Initialize the database and load cell counts from CSV.")
+    parser.add_argument('source', nargs='?', default=str(CELL_COUNT_CSV),
+                        help="CSV file, directory of CSV shards, glob pattern, or with --snapshot a snapshot "
+                             "directory (default: %(default)s)")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--stream', action='store_true',
+                      help="read in fixed-size chunks, committing per chunk (implied for directories/globs)")
+    mode.add_argument('--snapshot', action='store_true',
+                      help="rebuild from an Arrow/Parquet snapshot written by snapshot.py instead of the CSV")
+    mode.add_argument('--incremental', action='store_true',
+                      help="apply only samples added, changed or removed since the last load, without a rebuild")
+    mode.add_argument('--backfill-totals', action='store_true',
+                      help="recompute sample_totals and frequency_cube from cell_counts for an existing database, "
+                           "then exit")
+    mode.add_argument('--verify-totals', action='store_true',
+                      help="check sample_totals against cell_counts, exiting non-zero on any mismatch")
+    mode.add_argument('--verify-cube', action='store_true',
+                      help="check frequency_cube against the cell counts, exiting non-zero on any mismatch")
+    mode.add_argument('--migrate', action='store_true',
+                      help="move a database created before cell_types to the current layout, keeping its rows, "
+                           "then exit")
+    parser.add_argument('--chunksize', type=int, default=CHUNK_SIZE,
+                        help="rows per chunk in streaming mode (default: %(default)s)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="worker processes parsing shards in streaming mode (default: %(default)s)")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--atomic', action='store_true',
+                        help="build into a temporary file next to the database and swap it in when done")
+    target.add_argument('--output', type=Path,
+                        help="build a fresh database at this path instead, leaving the current one alone")
+    parser.add_argument('--progress', action='store_true',
+                        help=f"print machine-readable '{PROGRESS_PREFIX} <fraction> <message>' lines")
+    args = parser.parse_args()
+    if args.snapshot and args.source == str(CELL_COUNT_CSV):
+        args.source = str(SNAPSHOT_DIR)
+    if (args.atomic or args.output) and (args.incremental or args.backfill_totals or args.verify_totals
+                                         or args.verify_cube or args.migrate):
+        parser.error("--atomic and --output build from scratch and only combine with --stream or --snapshot")
+    return args
+
+
+def full_load(args, db_path, progress=None):
+    init_db(db_path)
+    if args.snapshot:
+        return load_data_from_snapshot(args.source, db_path=db_path, progress=progress)
+    if args.stream or resolve_sources(args.source) != [Path(args.source)]:
+        return load_data_streaming(args.source, chunksize=args.chunksize, workers=args.workers,
+                                   db_path=db_path, progress=progress)
+    return load_data_from_csv(args.source, db_path=db_path, progress=progress)
 
 
 if __name__ == "__main__":
-    init_db(DB_PATH)
-    load_data_from_csv(CELL_COUNT_CSV)
-    print(f"Database initialized at {DB_PATH} and data loaded from {CELL_COUNT_CSV}.")
+    args = parse_args()
+    progress = print_progress if args.progress else None
+    if args.backfill_totals:
+        print(f"Backfilled sample_totals for {backfill_sample_totals():,} samples in {DB_PATH}.")
+    elif args.migrate:
+        if migrate_cell_counts():
+            print(f"Migrated {DB_PATH} to cell_types and cell_type_counts.")
+        else:
+            print(f"{DB_PATH} already stores cell counts in cell_type_counts.")
+    elif args.verify_totals:
+        mismatches = verify_sample_totals()
+        for sample_id, expected, stored in mismatches:
+            print(f"{sample_id}: cell_counts (total, rows) are {expected}, sample_totals has {stored}")
+        print(f"{len(mismatches)} sample_totals mismatches in {DB_PATH}.")
+        if mismatches:
+            raise SystemExit(1)
+    elif args.verify_cube:
+        mismatches = verify_frequency_cube()
+        for key, expected, stored in mismatches:
+            print(f"{dict(zip(CUBE_DIMENSIONS, key))}: expected {expected}, frequency_cube has {stored}")
+        print(f"{len(mismatches)} frequency_cube mismatches in {DB_PATH}.")
+        if mismatches:
+            raise SystemExit(1)
+    elif args.incremental:
+        stats = load_data_incremental(args.source, progress=progress)
+        print(f"Database at {DB_PATH} updated from {args.source}: {stats['added']} added, "
+              f"{stats['changed']} changed, {stats['removed']} removed, {stats['unchanged']} unchanged "
+              f"in {stats['seconds']:.2f}s.")
+    else:
+        db_path = args.output or DB_PATH
+        if args.atomic:
+            stats = rebuild_atomically(lambda tmp_path: full_load(args, tmp_path, progress))
+        elif args.output:
+            stats = build_database(lambda path: full_load(args, path, progress), args.output)
+        else:
+            stats = full_load(args, DB_PATH, progress)
+        print(f"Database initialized at {db_path} and data loaded from {args.source}.")
+        print(f"Loaded {stats['csv_rows']} rows ({stats['rows_written']} table rows) "
+              f"in {stats['seconds']:.2f}s ({stats['rows_per_sec']:,.0f} rows/sec).")
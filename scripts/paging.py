@@ -0,0 +1,59 @@
+from scripts.filters import filter_where, where_clause
+from scripts.utils import query_df
+
+PAGE_SIZES = [100, 500, 1000, 5000]
+
+
+def page_query(select, key, after=False, where=()):
+    """
+    select, restricted to the where conditions and to the rows after a key (if after), ordered and limited by the key.
+    Binds the where params, then the key's values (if after), then the row limit.
+    """
+    key_sql = ", ".join(key)
+    conditions = list(where)
+    if after:
+        conditions.append(f"({key_sql}) > ({', '.join('?' for _ in key)})")
+    return f"{select} {where_clause(conditions)} ORDER BY {key_sql} LIMIT ?"
+
+
+def count_query(select, where=()):
+    return f"SELECT COUNT(*) AS num_rows FROM ({select} {where_clause(where)})"
+
+
+def fetch_page(select, key, after=None, page_size=PAGE_SIZES[0], where=(), params=()):
+    """
+    One page of select by keyset pagination: the page_size rows following the key values in after
+    (a tuple, or None for the first page), found by an index search on the key rather than by
+    skipping OFFSET rows. key maps the key's SQL expressions to their result columns.
+    Returns the page and the after tuple for the next page (None if this is the last one).
+    """
+    sql = page_query(select, key, after is not None, where)
+    # one row more than the page, to tell whether there's another page without counting
+    df = query_df(sql, [*params, *(after or ()), page_size + 1])
+    if len(df) <= page_size:
+        return df, None
+    df = df.iloc[:page_size]
+    # tolist() turns NumPy scalars back into Python values sqlite3 can bind
+    return df, tuple(df[list(key.values())].iloc[-1].tolist())
+
+
+def count_rows(select, where=(), params=()):
+    return int(query_df(count_query(select, where), params)['num_rows'].iloc[0])
+
+
+def count_filtered_rows(paged, filter_model):
+    """
+    The number of rows of a PAGED_QUERIES entry matching a grid's filter model: from its count query when every
+    filter is on a column that query has, otherwise by counting the select's rows.
+    Raises a ValueError for filters neither can apply, like filter_where().
+    """
+    count = paged.get("count")
+    if count is not None:
+        try:
+            where, params = filter_where(filter_model, count["filters"])
+        except ValueError:
+            pass
+        else:
+            return int(query_df(count["query"].format(where=where_clause(where)), params)['num_rows'].iloc[0])
+    where, params = filter_where(filter_model, paged["filters"])
+    return count_rows(paged["select"], where, params)
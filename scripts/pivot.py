@@ -0,0 +1,67 @@
+import json
+import numpy as np
+import pandas as pd
+from scripts.utils import CELL_TYPES, connection, query_df
+from scripts.queries import sql_query_cell_counts_page, sql_query_cell_type_ranges
+
+# cell_counts rows pulled from SQLite per fetchmany() while pivoting
+FETCH_SIZE = 200_000
+
+
+def order_cell_types(cell_types):
+    """CELL_TYPES first, in their usual order, then any other populations alphabetically."""
+    known = [cell_type for cell_type in CELL_TYPES if cell_type in cell_types]
+    return known + sorted(set(cell_types) - set(known))
+
+
+def counts_dtype(ranges):
+    """The narrowest integer dtype holding every count, from (cell_type, min, max) rows."""
+    bounds = [int(bound) for _, low, high in ranges for bound in (low, high) if pd.notna(bound)]
+    if not bounds:
+        return np.dtype(np.int64)
+    return np.result_type(np.min_scalar_type(min(bounds)), np.min_scalar_type(max(bounds)))
+
+
+def pivot_cell_counts(sample_ids, cursor, cell_types, dtype, fetch_size=FETCH_SIZE):
+    """
+    Pivot (sample_id, cell_type, count) rows from cursor into one nullable integer column per cell type,
+    aligned with sample_ids. Rows are consumed fetch_size at a time and scattered into a preallocated
+    (samples x cell types) array, so memory is the wide result plus one chunk no matter how many
+    cell types there are.
+    """
+    rows = pd.Index(sample_ids)
+    columns = pd.Index(cell_types)
+    # column-major, so each cell type's column is a contiguous slice that pandas can wrap without copying
+    values = np.zeros((len(rows), len(columns)), dtype=dtype, order='F')
+    missing = np.ones((len(rows), len(columns)), dtype=bool, order='F')
+
+    while chunk := cursor.fetchmany(fetch_size):
+        chunk_samples, chunk_cell_types, chunk_counts = zip(*chunk)
+        counts = pd.array(chunk_counts, dtype="Int64")
+        row_idx = rows.get_indexer(chunk_samples)
+        col_idx = columns.get_indexer(chunk_cell_types)
+        keep = (row_idx >= 0) & (col_idx >= 0) & ~counts.isna()
+        values[row_idx[keep], col_idx[keep]] = counts[keep].to_numpy(dtype=dtype)
+        missing[row_idx[keep], col_idx[keep]] = False
+
+    return pd.DataFrame(
+        {cell_type: pd.arrays.IntegerArray(values[:, i], missing[:, i]) for i, cell_type in enumerate(cell_types)},
+        index=pd.RangeIndex(len(rows))
+    )
+
+
+def add_cell_counts(metadata):
+    """
+    A page of sample metadata, in sample_id order, with its count columns pivoted in.
+    Only that page's cell_counts are read; the columns and dtype come from the whole table,
+    so they don't change from page to page.
+    """
+    if metadata.empty:
+        return metadata
+    ranges = list(query_df(sql_query_cell_type_ranges).itertuples(index=False, name=None))
+    cell_types = order_cell_types([cell_type for cell_type, _, _ in ranges])
+    sample_ids = metadata['sample_id']
+    with connection(read_only=True) as conn:
+        cursor = conn.execute(sql_query_cell_counts_page, (json.dumps(sample_ids.tolist()),))
+        counts = pivot_cell_counts(sample_ids, cursor, cell_types, counts_dtype(ranges))
+    return pd.concat([metadata.reset_index(drop=True), counts], axis=1, copy=False)
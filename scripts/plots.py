@@ -0,0 +1,120 @@
+from io import BytesIO
+from matplotlib.figure import Figure
+from matplotlib.patches import Patch
+import numpy as np
+import pandas as pd
+import seaborn as sns
+
+# seaborn's defaults: the boxes for an x level share 80% of the space between ticks, and are dodged by hue
+BOX_WIDTH = 0.8
+BOX_SATURATION = 0.75
+LINE_COLOR = "0.25"
+
+
+def lerp(low, high, t):
+    """NumPy's percentile interpolation, including its rounding, so quartiles match np.percentile exactly."""
+    diff = high - low
+    return np.where(t >= 0.5, high - diff * (1 - t), low + diff * t)
+
+
+def box_stats(df, x='population', hue='response', value='relative_frequency', whis=1.5):
+    """
+    Box plot statistics for every (x, hue) group in df at once, as matplotlib's cbook.boxplot_stats()
+    computes them one group at a time: quartiles (linear interpolation), whiskers at the furthest
+    values within whis IQRs of the box, and the outliers beyond them.
+    Values are sorted once for all groups; NaNs are left out, as seaborn does.
+    Returns the x and hue levels (in order of first appearance) and one bxp() stats dict per non-empty group,
+    with the levels' indexes under "x" and "hue".
+    """
+    x_codes, x_levels = pd.factorize(df[x])
+    hue_codes, hue_levels = pd.factorize(df[hue])
+    values = df[value].to_numpy(dtype=float)
+    keep = (x_codes >= 0) & (hue_codes >= 0) & ~np.isnan(values)
+
+    groups = x_codes[keep] * len(hue_levels) + hue_codes[keep]
+    order = np.lexsort((values[keep], groups))
+    values, groups = values[keep][order], groups[order]
+
+    counts = np.bincount(groups, minlength=len(x_levels) * len(hue_levels))
+    present = np.flatnonzero(counts)
+    if not len(present):
+        return x_levels, hue_levels, []
+    n = counts[present]
+    starts = np.concatenate(([0], np.cumsum(n)[:-1]))
+
+    def percentile(q):
+        position = (n - 1) * q / 100
+        below = np.floor(position).astype(int)
+        above = np.minimum(below + 1, n - 1)
+        return lerp(values[starts + below], values[starts + above], position - below)
+
+    q1, med, q3 = percentile(25), percentile(50), percentile(75)
+    iqr = q3 - q1
+    # each value's group's bounds, for finding the whisker ends with one reduction per group
+    group_index = np.repeat(np.arange(len(present)), n)
+    low_bound, high_bound = (q1 - whis * iqr)[group_index], (q3 + whis * iqr)[group_index]
+    highest = np.maximum.reduceat(np.where(values <= high_bound, values, -np.inf), starts)
+    lowest = np.minimum.reduceat(np.where(values >= low_bound, values, np.inf), starts)
+    whishi = np.where(highest < q3, q3, highest)
+    whislo = np.where(lowest > q1, q1, lowest)
+
+    is_flier = (values < whislo[group_index]) | (values > whishi[group_index])
+    group_fliers = [group_values[flier] for group_values, flier in zip(np.split(values, starts[1:]),
+                                                                       np.split(is_flier, starts[1:]))]
+    stats = [
+        {'x': group // len(hue_levels), 'hue': group % len(hue_levels), 'med': med[i], 'q1': q1[i], 'q3': q3[i],
+         'whislo': whislo[i], 'whishi': whishi[i], 'fliers': group_fliers[i]}
+        for i, group in enumerate(present)
+    ]
+    return x_levels, hue_levels, stats
+
+
+def box_plot_png(df, x='population', hue='response', value='relative_frequency', xlabel=None, ylabel=None,
+                 title=None):
+    """
+    A seaborn-style box plot of value by x, dodged by hue, drawn with Axes.bxp() from box_stats() so the raw
+    rows never go through matplotlib. Returned as PNG bytes, so it can be cached as is.
+    """
+    x_levels, hue_levels, stats = box_stats(df, x, hue, value)
+    return draw_box_plot(x_levels, hue_levels, stats, hue, xlabel if xlabel is not None else x,
+                         ylabel if ylabel is not None else value, title)
+
+
+def draw_box_plot(x_levels, hue_levels, stats, hue='response', xlabel=None, ylabel=None, title=None):
+    """box_plot_png() from box_stats()'s levels and stats, e.g. ones gathered a few groups at a time."""
+    colors = [sns.desaturate(color, BOX_SATURATION) for color in sns.color_palette(n_colors=max(len(hue_levels), 1))]
+    width = BOX_WIDTH / max(len(hue_levels), 1)
+
+    fig = Figure(figsize=(10, 6))
+    ax = fig.subplots()
+    for hue_index, color in zip(range(len(hue_levels)), colors):
+        hue_stats = [stat for stat in stats if stat['hue'] == hue_index]
+        if not hue_stats:
+            continue
+        ax.bxp(
+            hue_stats,
+            positions=[stat['x'] - BOX_WIDTH / 2 + width * (hue_index + 0.5) for stat in hue_stats],
+            widths=width,
+            capwidths=width / 2,
+            patch_artist=True,
+            manage_ticks=False,
+            boxprops={'facecolor': color, 'edgecolor': LINE_COLOR},
+            medianprops={'color': LINE_COLOR},
+            whiskerprops={'color': LINE_COLOR},
+            capprops={'color': LINE_COLOR},
+            flierprops={'markeredgecolor': LINE_COLOR},
+        )
+
+    if len(x_levels):
+        ax.set_xticks(range(len(x_levels)), x_levels)
+        ax.set_xlim(-0.5, len(x_levels) - 0.5)
+    if len(hue_levels):
+        ax.legend([Patch(facecolor=color, edgecolor=LINE_COLOR) for color in colors], hue_levels, title=hue)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    if title:
+        ax.set_title(title)
+
+    png = BytesIO()
+    fig.savefig(png, format='png', bbox_inches='tight')
+    return png.getvalue()
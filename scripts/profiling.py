@@ -0,0 +1,142 @@
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+import json
+import os
+import threading
+import time
+
+# finished runs kept for the profiler panel and its export
+PROFILE_HISTORY = int(os.environ.get("LOBLAW_PROFILE_HISTORY", 50))
+
+# if set, every profiled run is also appended to this file as a line of JSON
+PROFILE_LOG = os.environ.get("LOBLAW_PROFILE_LOG")
+
+# statements longer than this are cut short in the log
+MAX_SQL_LENGTH = 2_000
+
+
+class RunProfile:
+    """Timings for one run of the dashboard script: its stages, the queries it ran and the statements SQLite saw."""
+
+    def __init__(self, label):
+        self.label = label
+        self.started_at = datetime.now(timezone.utc).isoformat(timespec="milliseconds")
+        self.start = time.perf_counter()
+        self.seconds = None
+        self.stages = []  # [name, depth, seconds], in the order they started
+        self.queries = []  # one dict per query_df()/run_sql()/iter_query() call
+        self.statements = 0  # every statement run on a pooled connection, including ones outside those
+        self._stack = []
+
+    def as_dict(self):
+        return {
+            'label': self.label,
+            'started_at': self.started_at,
+            'seconds': self.seconds,
+            'stages': [{'stage': name, 'depth': depth, 'seconds': seconds} for name, depth, seconds in self.stages],
+            'queries': self.queries,
+            'statements': self.statements,
+        }
+
+
+_current = ContextVar("loblaw_profile", default=None)
+_history = deque(maxlen=PROFILE_HISTORY)
+_log_lock = threading.Lock()
+
+
+def current_run():
+    """The profile being recorded in this thread's script run, or None when profiling is off."""
+    return _current.get()
+
+
+def start_run(label):
+    """Start profiling the current script run; replaces a run that never finished (e.g. cut short by a rerun)."""
+    profile = RunProfile(label)
+    _current.set(profile)
+    return profile
+
+
+def finish_run():
+    """Stop profiling the current run, keeping it in the history (and the log file, if set). Returns it."""
+    profile = _current.get()
+    if profile is None:
+        return None
+    _current.set(None)
+    profile.seconds = time.perf_counter() - profile.start
+    _history.append(profile)
+    if PROFILE_LOG:
+        with _log_lock, open(PROFILE_LOG, "a") as log:
+            log.write(json.dumps(profile.as_dict()) + "\n")
+    return profile
+
+
+def history():
+    """Finished runs, oldest first."""
+    return list(_history)
+
+
+def export_jsonl(profiles=None):
+    """Runs as JSON Lines, one run per line, for offline analysis."""
+    return "".join(json.dumps(profile.as_dict()) + "\n" for profile in (profiles if profiles is not None else _history))
+
+
+@contextmanager
+def stage(name):
+    """Time a block of the script run as a named stage; free when profiling is off."""
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    # listed when it starts, so stages nested in it come after it
+    entry = [name, len(profile._stack), None]
+    profile.stages.append(entry)
+    profile._stack.append(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile._stack.pop()
+        entry[2] = time.perf_counter() - start
+
+
+def record_query(sql, params, seconds, rows, convert_seconds=None, cached=False):
+    """
+    Record a query against the current run, if one is being profiled, under the innermost stage running.
+    convert_seconds is the part of seconds spent turning rows into DataFrames, as opposed to running SQL.
+    """
+    profile = _current.get()
+    if profile is None:
+        return
+    profile.queries.append({
+        'stage': profile._stack[-1] if profile._stack else None,
+        'sql': " ".join(sql.split())[:MAX_SQL_LENGTH],
+        'params': [param if isinstance(param, (int, float, str)) or param is None else str(param)
+                   for param in params or ()],
+        'seconds': seconds,
+        'convert_seconds': convert_seconds,
+        'rows': rows,
+        'cached': cached,
+    })
+
+
+def trace_statement(statement):
+    """sqlite3 trace callback for pooled connections, counting every statement the current run executes."""
+    profile = _current.get()
+    if profile is not None:
+        profile.statements += 1
+
+
+def query_plan(conn, sql, params=()):
+    """EXPLAIN QUERY PLAN for a recorded query, with the parameters it ran with."""
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+
+def stage_summary(profile):
+    """Each stage's total seconds and the queries run directly in it: [(stage, depth, seconds, queries, rows)]."""
+    queries = {}
+    for query in profile.queries:
+        count, rows = queries.get(query['stage'], (0, 0))
+        queries[query['stage']] = (count + 1, rows + (query['rows'] or 0))
+    return [(name, depth, seconds, *queries.get(name, (0, 0))) for name, depth, seconds in profile.stages]
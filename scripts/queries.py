@@ -0,0 +1,371 @@
+# one row per sample; cell counts are pivoted in by scripts.pivot
+sql_select_sample_metadata = '''
+    SELECT
+        projects.project_id,
+        subjects.subject_id,
+        subjects.condition,
+        subjects.age,
+        subjects.sex,
+        samples.treatment_id,
+        samples.response,
+        samples.sample_id,
+        samples.sample_type,
+        samples.time_from_treatment_start
+    FROM
+        samples
+    JOIN subjects ON samples.subject_id = subjects.subject_id
+    JOIN projects ON subjects.project_id = projects.project_id
+'''
+
+sql_query_sample_metadata = f'''{sql_select_sample_metadata}
+    ORDER BY
+        samples.sample_id ASC
+'''
+
+# the Samples page summary; {where} takes the Samples grid's filters (see scripts.filters.where_clause)
+sql_query_sample_summary = '''
+    SELECT
+        COUNT(*) AS num_samples,
+        COUNT(DISTINCT samples.subject_id) AS num_subjects,
+        COALESCE(SUM(samples.response = 'y'), 0) AS num_responders,
+        COALESCE(SUM(samples.response = 'n'), 0) AS num_nonresponders,
+        COALESCE(SUM(subjects.sex = 'M'), 0) AS num_males,
+        COALESCE(SUM(subjects.sex = 'F'), 0) AS num_females
+    FROM
+        samples
+    JOIN subjects ON samples.subject_id = subjects.subject_id
+    JOIN projects ON subjects.project_id = projects.project_id
+    {where}
+'''
+
+sql_query_samples_per_project = '''
+    SELECT
+        projects.project_id,
+        COUNT(*) AS total_samples
+    FROM
+        samples
+    JOIN subjects ON samples.subject_id = subjects.subject_id
+    JOIN projects ON subjects.project_id = projects.project_id
+    {where}
+    GROUP BY
+        projects.project_id
+    ORDER BY
+        projects.project_id ASC
+'''
+
+# frequency_cube columns (see scripts/load_data.py) the grids' filters can be answered on, {result column: SQL
+# expression}; filters on any other column (e.g. subject_id or age) need the row-level queries
+CUBE_FILTERS = {
+    "project_id": "frequency_cube.project_id",
+    "condition": "frequency_cube.condition",
+    "sex": "frequency_cube.sex",
+    "treatment_id": "frequency_cube.treatment_id",
+    "response": "frequency_cube.response",
+    "sample_type": "frequency_cube.sample_type",
+    "time_from_treatment_start": "frequency_cube.time_from_treatment_start",
+    "population": "cell_types.cell_type",
+}
+
+# the cube's whole-sample rows, and its per-population rows; subjects without a project are left out,
+# as the row-level queries' JOIN projects leaves them out
+CUBE_SAMPLE_ROWS = ["frequency_cube.cell_type_key IS NULL", "frequency_cube.project_id IS NOT NULL"]
+CUBE_POPULATION_ROWS = ["frequency_cube.cell_type_key IS NOT NULL", "frequency_cube.project_id IS NOT NULL"]
+
+# sql_query_sample_summary from the cube, but for the subject count, which can't be added up across slices;
+# {where} takes CUBE_SAMPLE_ROWS and the grid's filters on CUBE_FILTERS
+sql_query_cube_sample_summary = '''
+    SELECT
+        COALESCE(SUM(num_samples), 0) AS num_samples,
+        COALESCE(SUM(CASE WHEN response = 'y' THEN num_samples END), 0) AS num_responders,
+        COALESCE(SUM(CASE WHEN response = 'n' THEN num_samples END), 0) AS num_nonresponders,
+        COALESCE(SUM(CASE WHEN sex = 'M' THEN num_samples END), 0) AS num_males,
+        COALESCE(SUM(CASE WHEN sex = 'F' THEN num_samples END), 0) AS num_females
+    FROM
+        frequency_cube
+    {where}
+'''
+
+sql_query_subject_count = '''
+    SELECT
+        COUNT(DISTINCT samples.subject_id) AS num_subjects
+    FROM
+        samples
+    JOIN subjects ON samples.subject_id = subjects.subject_id
+    JOIN projects ON subjects.project_id = projects.project_id
+    {where}
+'''
+
+# sql_query_samples_per_project from the cube; slices whose samples were all deleted are left with 0
+sql_query_cube_samples_per_project = '''
+    SELECT
+        project_id,
+        SUM(num_samples) AS total_samples
+    FROM
+        frequency_cube
+    {where}
+    GROUP BY
+        project_id
+    HAVING
+        total_samples > 0
+    ORDER BY
+        project_id ASC
+'''
+
+# each population's relative frequencies by response, as sample counts, sums and sums of squares
+# (see scripts.analytics.welch_by_population); {where} takes CUBE_POPULATION_ROWS and the grid's filters
+sql_query_cube_population_moments = '''
+    SELECT
+        cell_types.cell_type AS population,
+        frequency_cube.response,
+        SUM(frequency_cube.num_samples) AS n,
+        SUM(frequency_cube.sum_frequency) AS sum_frequency,
+        SUM(frequency_cube.sum_squares) AS sum_squares
+    FROM
+        frequency_cube
+    JOIN cell_types ON cell_types.cell_type_key = frequency_cube.cell_type_key
+    {where}
+    GROUP BY
+        cell_types.cell_type,
+        frequency_cube.response
+    HAVING
+        n > 0
+'''
+
+# subject_trajectories (see scripts/load_data.py) rows whose subject has a baseline to compare against
+TRAJECTORY_ROWS = ["subject_trajectories.baseline_frequency IS NOT NULL"]
+
+# each population's mean change from baseline at each time from treatment start, by response, with the fold
+# change of the mean (a mean of per-sample fold changes is pulled up by small baselines);
+# {where} takes TRAJECTORY_ROWS and the Samples grid's filters, applied to the later samples
+sql_query_trajectory_summary = '''
+    SELECT
+        cell_types.cell_type AS population,
+        samples.response,
+        subject_trajectories.time_from_treatment_start,
+        COUNT(DISTINCT subject_trajectories.subject_id) AS num_subjects,
+        AVG(subject_trajectories.baseline_frequency) AS mean_baseline,
+        AVG(subject_trajectories.relative_frequency) AS mean_frequency,
+        AVG(subject_trajectories.delta) AS mean_delta,
+        AVG(subject_trajectories.relative_frequency) / AVG(subject_trajectories.baseline_frequency) AS fold_change
+    FROM
+        subject_trajectories
+    JOIN samples ON samples.sample_key = subject_trajectories.sample_key
+    JOIN subjects ON samples.subject_id = subjects.subject_id
+    JOIN projects ON subjects.project_id = projects.project_id
+    JOIN cell_types ON cell_types.cell_type_key = subject_trajectories.cell_type_key
+    {where}
+    GROUP BY
+        cell_types.cell_type,
+        samples.response,
+        subject_trajectories.time_from_treatment_start
+    ORDER BY
+        population, samples.response, subject_trajectories.time_from_treatment_start
+'''
+
+# one subject's trajectories, read off the subject_trajectories primary key
+sql_query_subject_trajectory = '''
+    SELECT
+        cell_types.cell_type AS population,
+        subject_trajectories.sample_type,
+        subject_trajectories.time_from_treatment_start,
+        samples.sample_id,
+        subject_trajectories.relative_frequency,
+        subject_trajectories.baseline_frequency,
+        subject_trajectories.delta,
+        subject_trajectories.fold_change
+    FROM
+        subject_trajectories
+    JOIN samples ON samples.sample_key = subject_trajectories.sample_key
+    JOIN cell_types ON cell_types.cell_type_key = subject_trajectories.cell_type_key
+    WHERE
+        subject_trajectories.subject_id = ?
+    ORDER BY
+        population, subject_trajectories.sample_type, subject_trajectories.time_from_treatment_start,
+        samples.sample_id
+'''
+
+# long form, read straight off the cell_type_counts primary key; rows come in sample_key order
+sql_query_cell_counts_long = '''
+    SELECT
+        samples.sample_id,
+        cell_types.cell_type,
+        cell_type_counts.count
+    FROM
+        cell_type_counts
+    CROSS JOIN samples ON samples.sample_key = cell_type_counts.sample_key
+    JOIN cell_types ON cell_types.cell_type_key = cell_type_counts.cell_type_key
+'''
+
+# the counts of one page of samples, looked up by the page's sample_ids (a JSON array) in the samples.sample_id index;
+# only those samples, not everything the filter skipped between the page's first and last
+sql_query_cell_counts_page = '''
+    SELECT
+        samples.sample_id,
+        cell_types.cell_type,
+        cell_type_counts.count
+    FROM
+        samples
+    CROSS JOIN cell_type_counts ON cell_type_counts.sample_key = samples.sample_key
+    JOIN cell_types ON cell_types.cell_type_key = cell_type_counts.cell_type_key
+    WHERE
+        samples.sample_id IN (SELECT value FROM json_each(?))
+'''
+
+# sizes the pivot: which populations exist and how wide their counts are,
+# from each end of their run of idx_cell_type_counts_cell_type
+sql_query_cell_type_ranges = '''
+    SELECT
+        cell_type,
+        (SELECT MIN(count) FROM cell_type_counts WHERE cell_type_key = cell_types.cell_type_key) AS min_count,
+        (SELECT MAX(count) FROM cell_type_counts WHERE cell_type_key = cell_types.cell_type_key) AS max_count
+    FROM
+        cell_types
+    WHERE
+        EXISTS (SELECT 1 FROM cell_type_counts WHERE cell_type_key = cell_types.cell_type_key)
+'''
+
+sql_query_frequencies = '''
+        SELECT
+            samples.sample_id,
+            cell_types.cell_type AS population,
+            cell_type_counts.count,
+            totals.total_count,
+            100.0 * cell_type_counts.count / totals.total_count AS relative_frequency
+        FROM
+            cell_type_counts
+        CROSS JOIN samples ON samples.sample_key = cell_type_counts.sample_key
+        JOIN cell_types ON cell_types.cell_type_key = cell_type_counts.cell_type_key
+        JOIN sample_totals AS totals ON cell_type_counts.sample_key = totals.sample_key
+    '''
+
+# samples drives the join in sample_id order (CROSS JOIN pins it), and each sample's counts are looked up by
+# primary key for each cell type in name order, so ordering by (sample_id, population) needs no sort
+sql_from_rich_frequencies = '''
+        FROM
+            samples
+        CROSS JOIN cell_types
+        JOIN cell_type_counts
+            ON cell_type_counts.sample_key = samples.sample_key
+            AND cell_type_counts.cell_type_key = cell_types.cell_type_key
+        JOIN subjects ON samples.subject_id = subjects.subject_id
+        JOIN projects ON subjects.project_id = projects.project_id
+        JOIN sample_totals AS total ON samples.sample_key = total.sample_key
+'''
+
+sql_select_rich_frequencies = f'''
+        SELECT
+            samples.sample_id,
+            samples.subject_id,
+            subjects.condition,
+            subjects.age,
+            subjects.sex,
+            samples.treatment_id,
+            samples.response,
+            samples.sample_type,
+            samples.time_from_treatment_start,
+            projects.project_id,
+            cell_types.cell_type AS population,
+            cell_type_counts.count AS count,
+            total.total_count,
+            100.0 * cell_type_counts.count / total.total_count AS relative_frequency
+        {sql_from_rich_frequencies}'''
+
+# the Frequencies grid's row count without reading its rows: each matching sample's number of counts, summed;
+# {where} takes filters on FREQUENCY_COUNT_FILTERS
+sql_query_frequencies_count = '''
+        SELECT
+            COALESCE(SUM(total.num_counts), 0) AS num_rows
+        FROM
+            samples
+        JOIN subjects ON samples.subject_id = subjects.subject_id
+        JOIN projects ON subjects.project_id = projects.project_id
+        JOIN sample_totals AS total ON samples.sample_key = total.sample_key
+        {where}
+'''
+
+# the Frequencies grid's columns that are the same in all of a sample's rows, which its row count can be filtered on
+FREQUENCY_COUNT_FILTERS = {
+    "sample_id": "samples.sample_id",
+    "subject_id": "samples.subject_id",
+    "condition": "subjects.condition",
+    "age": "subjects.age",
+    "sex": "subjects.sex",
+    "treatment_id": "samples.treatment_id",
+    "response": "samples.response",
+    "sample_type": "samples.sample_type",
+    "time_from_treatment_start": "samples.time_from_treatment_start",
+    "project_id": "projects.project_id",
+    "total_count": "total.total_count",
+}
+
+sql_query_rich_frequencies = f'''{sql_select_rich_frequencies}
+        ORDER BY
+            samples.sample_id ASC, cell_types.cell_type ASC
+'''
+
+# just what the box plot and Mann-Whitney tests need; {where} takes the frequencies grid's filters
+sql_query_response_frequencies = f'''
+        SELECT
+            cell_types.cell_type AS population,
+            samples.response,
+            100.0 * cell_type_counts.count / total.total_count AS relative_frequency
+        {sql_from_rich_frequencies}
+        {{where}}
+'''
+
+# the table shown on each page of the dashboard, and the long-form frequencies table below the Samples one:
+# - select: a SELECT without WHERE/ORDER BY
+# - key: the columns it is paged by ({SQL expression: result column}), which must be a unique key
+# - filters: the columns that can be filtered in the grid, {result column: SQL expression}
+# - count (optional): a query counting the rows without reading them ({where} takes its filters), and the columns
+#   it can be filtered on; with a filter on any other column, the select's rows are counted instead
+PAGED_QUERIES = {
+    "Samples": {
+        "select": sql_select_sample_metadata,
+        "key": {"samples.sample_id": "sample_id"},
+        "filters": {
+            "project_id": "projects.project_id",
+            "subject_id": "subjects.subject_id",
+            "condition": "subjects.condition",
+            "age": "subjects.age",
+            "sex": "subjects.sex",
+            "treatment_id": "samples.treatment_id",
+            "response": "samples.response",
+            "sample_id": "samples.sample_id",
+            "sample_type": "samples.sample_type",
+            "time_from_treatment_start": "samples.time_from_treatment_start",
+        },
+    },
+    "Projects": {
+        "select": "SELECT * FROM projects",
+        "key": {"projects.project_id": "project_id"},
+        "filters": {"project_id": "projects.project_id"},
+    },
+    "Subjects": {
+        "select": "SELECT * FROM subjects",
+        "key": {"subjects.subject_id": "subject_id"},
+        "filters": {
+            "subject_id": "subjects.subject_id",
+            "project_id": "subjects.project_id",
+            "condition": "subjects.condition",
+            "age": "subjects.age",
+            "sex": "subjects.sex",
+        },
+    },
+    "Treatments": {
+        "select": "SELECT * FROM treatments",
+        "key": {"treatments.treatment_id": "treatment_id"},
+        "filters": {"treatment_id": "treatments.treatment_id"},
+    },
+    "Frequencies": {
+        "select": sql_select_rich_frequencies,
+        "key": {"samples.sample_id": "sample_id", "cell_types.cell_type": "population"},
+        "filters": {
+            **FREQUENCY_COUNT_FILTERS,
+            "population": "cell_types.cell_type",
+            "count": "cell_type_counts.count",
+            "relative_frequency": "100.0 * cell_type_counts.count / total.total_count",
+        },
+        "count": {"query": sql_query_frequencies_count, "filters": FREQUENCY_COUNT_FILTERS},
+    },
+}
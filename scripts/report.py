@@ -0,0 +1,267 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import multiprocessing as mp
+from pathlib import Path
+import re
+import sqlite3
+import sys
+import time
+import pandas as pd
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from scripts.utils import BASE_DIR, CONNECTION_PRAGMAS, DB_PATH, FETCH_SIZE, fetch_df, typed_frames  # noqa: E402
+from scripts.queries import (PAGED_QUERIES, sql_query_response_frequencies,  # noqa: E402
+                             sql_select_rich_frequencies)
+from scripts.filters import filter_where, where_clause  # noqa: E402
+from scripts.analytics import (ANALYTICS_WORKERS, N_RESAMPLES, mannwhitneyu_by_population,  # noqa: E402
+                               population_moments, resampling_by_population, welch_by_population)
+from scripts.plots import box_stats, draw_box_plot  # noqa: E402
+
+REPORT_DIR = BASE_DIR / "reports"
+
+# cohorts are AgGrid filter models on the Frequencies grid's columns, so one can be copied from the dashboard
+FREQUENCY_FILTERS = PAGED_QUERIES["Frequencies"]["filters"]
+
+# rows per chunk written to frequencies.csv in bounded-memory mode; a chunk of FETCH_SIZE rows takes ~90MB
+BOUNDED_CHUNK_SIZE = 5_000
+
+BOX_PLOT_LABELS = {'xlabel': "Cell Population", 'ylabel': "Relative Frequency (%)",
+                   'title': "Relative Frequencies: Responders vs Non-Responders"}
+
+# the frequency table in the Frequencies grid's order, which the join produces without a sort
+sql_query_cohort_frequencies = f'''{sql_select_rich_frequencies}
+        {{where}}
+        ORDER BY
+            samples.sample_id ASC, cell_types.cell_type ASC
+'''
+
+# each worker process reads through its own read-only connection, opened once by open_worker_connection()
+_conn = None
+
+
+def read_only_connection(db_path):
+    conn = sqlite3.connect(f"{Path(db_path).resolve().as_uri()}?mode=ro", uri=True)
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def open_worker_connection(db_path, bounded_memory=False):
+    global _conn
+    _conn = read_only_connection(db_path)
+    if bounded_memory:
+        # pages read through the memory map count against the process, up to the map's full 256MB
+        _conn.execute("PRAGMA mmap_size = 0")
+
+
+def project_cohorts(db_path=None):
+    """A cohort per project, filtered on project_id just as the Frequencies grid would be."""
+    conn = read_only_connection(db_path or DB_PATH)
+    try:
+        projects = [row[0] for row in conn.execute("SELECT project_id FROM projects ORDER BY project_id")]
+    finally:
+        conn.close()
+    return {project: {"project_id": {"filterType": "text", "type": "equals", "filter": project}}
+            for project in projects}
+
+
+def check_cohorts(cohorts):
+    """Raises a ValueError for any cohort whose filter model the Frequencies grid couldn't apply."""
+    for filter_model in cohorts.values():
+        filter_where(filter_model, FREQUENCY_FILTERS)
+
+
+def cohort_dir_name(name):
+    return re.sub(r"[^\w.-]+", "_", str(name)).strip("._") or "cohort"
+
+
+def cohort_dir_names(names):
+    """
+    {name: directory name} for each cohort, numbering the second and later of any names that would share a
+    directory ("a/b" and "a b" are both a_b), compared without case for case-insensitive file systems.
+    """
+    dir_names, taken = {}, {"summary.csv"}
+    for name in names:
+        base = dir_name = cohort_dir_name(name)
+        number = 1
+        while dir_name.casefold() in taken:
+            number += 1
+            dir_name = f"{base}-{number}"
+        taken.add(dir_name.casefold())
+        dir_names[name] = dir_name
+    return dir_names
+
+
+def write_frequency_table(path, where, params, chunksize=FETCH_SIZE):
+    """The cohort's rows of the Frequencies table as CSV, streamed chunksize rows at a time. Returns the row count."""
+    cursor = _conn.execute(sql_query_cohort_frequencies.format(where=where_clause(where)), params)
+    columns = [desc[0] for desc in cursor.description]
+    rows = 0
+    with open(path, "w", newline="") as f:
+        pd.DataFrame(columns=columns).to_csv(f, index=False)
+        for frame in typed_frames(cursor, columns, chunksize):
+            frame.to_csv(f, index=False, header=False)
+            rows += len(frame)
+    return rows
+
+
+def plotted_box_stats(df):
+    """box_stats() of responders and non-responders, with populations in cell type order and responders first."""
+    df = df[df['response'].isin(['y', 'n'])]
+    return box_stats(df.sort_values(['population', 'response'], ascending=[True, False], kind='stable'))
+
+
+def analyze(df, n_resamples, seed):
+    """
+    The dashboard's statistics on (part of) a cohort's frequencies: Mann-Whitney U (and resampling), and moments.
+    Resampling runs in this process, since the cohorts are already spread across the pool; each population's
+    results depend only on seed and its own values, so they're the same whether it's read whole or on its own.
+    """
+    stat_df = mannwhitneyu_by_population(df)
+    if n_resamples:
+        stat_df = stat_df.merge(resampling_by_population(df, n_resamples, seed, workers=1), on='Population',
+                                how='left')
+    return stat_df, population_moments(df)
+
+
+def read_whole(where, params, n_resamples, seed):
+    """Analyze the cohort's frequencies read in one query, as the dashboard does."""
+    df = fetch_df(_conn, sql_query_response_frequencies.format(where=where_clause(where)), params)
+    stat_df, moments = analyze(df, n_resamples, seed)
+    return stat_df, moments, plotted_box_stats(df)
+
+
+def read_by_population(where, params, n_resamples, seed):
+    """
+    read_whole() holding only one population's frequencies at a time, for cohorts too large to read whole.
+    Every statistic is computed per population, so the results are the same; the box plot is drawn from
+    each population's box stats.
+    """
+    populations = [row[0] for row in _conn.execute("SELECT cell_type FROM cell_types ORDER BY cell_type")]
+    stat_dfs, moments, x_levels, hue_levels, box = [], [], [], [], []
+    for population in populations:
+        df = fetch_df(_conn, sql_query_response_frequencies.format(
+            where=where_clause([*where, "cell_types.cell_type = ?"])), [*params, population])
+        if df.empty:
+            continue
+        population_stats, population_moments_ = analyze(df, n_resamples, seed)
+        if not population_stats.empty:
+            stat_dfs.append(population_stats)
+        moments.append(population_moments_)
+
+        _, hues, stats = plotted_box_stats(df)
+        if stats:
+            hue_levels.extend(level for level in hues if level not in hue_levels)
+            box.extend({**stat, 'x': len(x_levels), 'hue': hue_levels.index(hues[stat['hue']])} for stat in stats)
+            x_levels.append(population)
+    if not moments:
+        return read_whole(where, params, n_resamples, seed)
+    stat_df = pd.concat(stat_dfs, ignore_index=True) if stat_dfs else analyze(df.iloc[:0], 0, seed)[0]
+    return stat_df, pd.concat(moments, ignore_index=True), (x_levels, hue_levels, box)
+
+
+def run_cohort(name, filter_model, cohort_dir, n_resamples=0, seed=0, bounded_memory=False, chunksize=None):
+    """
+    Write one cohort's frequency table, statistics and box plot to cohort_dir:
+    frequencies.csv, mann_whitney.csv (with the resampling columns if n_resamples), welch.csv and box_plot.png.
+    With bounded_memory, the table is written in smaller chunks and the frequencies are read a population at a time.
+    Runs in a worker process (see open_worker_connection). Returns a summary row for the report.
+    """
+    start = time.perf_counter()
+    where, params = filter_where(filter_model, FREQUENCY_FILTERS)
+    cohort_dir = Path(cohort_dir)
+    cohort_dir.mkdir(parents=True, exist_ok=True)
+
+    rows = write_frequency_table(cohort_dir / "frequencies.csv", where, params,
+                                 chunksize or (BOUNDED_CHUNK_SIZE if bounded_memory else FETCH_SIZE))
+    read = read_by_population if bounded_memory else read_whole
+    stat_df, moments, (x_levels, hue_levels, box) = read(where, params, n_resamples, seed)
+    # tied p-values by population, so the order doesn't depend on the order the rows were read in
+    by_p_value = ['p-value', 'Population']
+    stat_df.sort_values(by_p_value, kind='stable').to_csv(cohort_dir / "mann_whitney.csv", index=False)
+    welch_by_population(moments).sort_values(by_p_value, kind='stable').to_csv(cohort_dir / "welch.csv", index=False)
+    (cohort_dir / "box_plot.png").write_bytes(draw_box_plot(x_levels, hue_levels, box, **BOX_PLOT_LABELS))
+    return {'cohort': name, 'directory': cohort_dir.name, 'rows': rows,
+            'populations': len(stat_df), 'seconds': round(time.perf_counter() - start, 3)}
+
+
+def run_report(cohorts, out_dir=REPORT_DIR, db_path=None, workers=ANALYTICS_WORKERS, bounded_memory=False,
+               **options):
+    """
+    run_cohort() for every cohort ({name: filter model}), spread across a pool of worker processes that each
+    read through one read-only connection, and a summary.csv of them all. Returns the summary rows.
+    """
+    db_path = db_path or DB_PATH
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    # bad filters fail here rather than in a worker
+    check_cohorts(cohorts)
+    cohort_dirs = {name: out_dir / dir_name for name, dir_name in cohort_dir_names(cohorts).items()}
+
+    workers = max(1, min(workers, len(cohorts)))
+    summary = []
+    if workers == 1:
+        open_worker_connection(db_path, bounded_memory)
+        for name, filter_model in cohorts.items():
+            summary.append(run_cohort(name, filter_model, cohort_dirs[name], bounded_memory=bounded_memory, **options))
+            print(f"{name}: {summary[-1]['rows']:,} rows in {summary[-1]['seconds']:.2f}s")
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn"),
+                                 initializer=open_worker_connection, initargs=(db_path, bounded_memory)) as executor:
+            futures = [executor.submit(run_cohort, name, filter_model, cohort_dirs[name],
+                                       bounded_memory=bounded_memory, **options)
+                       for name, filter_model in cohorts.items()]
+            for future in as_completed(futures):
+                summary.append(future.result())
+                print(f"{summary[-1]['cohort']}: {summary[-1]['rows']:,} rows in {summary[-1]['seconds']:.2f}s")
+
+    # in the order the cohorts were given, however they finished
+    order = {name: i for i, name in enumerate(cohorts)}
+    summary.sort(key=lambda row: order[row['cohort']])
+    pd.DataFrame(summary).to_csv(out_dir / "summary.csv", index=False)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Write the dashboard's frequency table, statistics and box plot for each cohort, without "
+                    "Streamlit.")
+    parser.add_argument('out_dir', nargs='?', type=Path, default=REPORT_DIR,
+                        help="directory to write a subdirectory per cohort to (default: %(default)s)")
+    parser.add_argument('--db', type=Path, default=DB_PATH, help="database to report on (default: %(default)s)")
+    cohort = parser.add_mutually_exclusive_group()
+    cohort.add_argument('--by', choices=["project", "all"], default="project",
+                        help="one cohort per project, or all samples as one (default: %(default)s)")
+    cohort.add_argument('--cohorts', type=Path, metavar='JSON',
+                        help="file of {cohort name: AgGrid filter model on the Frequencies grid's columns}")
+    parser.add_argument('--workers', type=int, default=ANALYTICS_WORKERS,
+                        help="worker processes, each reporting on one cohort at a time (default: %(default)s)")
+    parser.add_argument('--resamples', type=int, default=0,
+                        help=f"permutations and bootstrap resamples per population, e.g. {N_RESAMPLES}; "
+                             "0 skips them (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0, help="resampling seed (default: %(default)s)")
+    parser.add_argument('--bounded-memory', action='store_true',
+                        help="read each cohort's frequencies one population at a time rather than whole, "
+                             "and write its table in smaller chunks, for databases too large to read whole")
+    parser.add_argument('--chunksize', type=int,
+                        help=f"rows per chunk written to frequencies.csv (default: {FETCH_SIZE}, "
+                             f"or {BOUNDED_CHUNK_SIZE} with --bounded-memory)")
+    args = parser.parse_args()
+
+    if args.cohorts:
+        # a malformed file or filter is a usage error; anything raised by the report itself isn't
+        try:
+            cohorts = json.loads(args.cohorts.read_text())
+            check_cohorts(cohorts)
+        except ValueError as e:
+            parser.error(str(e))
+    elif args.by == "project":
+        cohorts = project_cohorts(args.db)
+    else:
+        cohorts = {"all": {}}
+    start = time.perf_counter()
+    summary = run_report(cohorts, args.out_dir, args.db, args.workers, n_resamples=args.resamples,
+                         seed=args.seed, bounded_memory=args.bounded_memory, chunksize=args.chunksize)
+    print(f"Reported on {len(summary)} cohorts in {args.out_dir} in {time.perf_counter() - start:.2f}s.")
@@ -0,0 +1,225 @@
+import argparse
+from datetime import datetime, timezone
+import json
+import os
+from pathlib import Path
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from scripts.utils import DB_PATH, SNAPSHOT_DIR, QueryCache  # noqa: E402
+from scripts.queries import sql_query_rich_frequencies, sql_query_sample_metadata  # noqa: E402
+from scripts.filters import filter_expression  # noqa: E402
+
+# rows fetched from SQLite and written per record batch
+SNAPSHOT_BATCH_SIZE = 100_000
+
+# Parquet datasets are split into one directory per project (project_id=<id>/)
+PARTITIONING = ds.partitioning(pa.schema([("project_id", pa.string())]), flavor="hive")
+
+MANIFEST = "snapshot.json"
+
+SAMPLES_SCHEMA = pa.schema([
+    ("project_id", pa.string()),
+    ("subject_id", pa.string()),
+    ("condition", pa.string()),
+    ("age", pa.int64()),
+    ("sex", pa.string()),
+    ("treatment_id", pa.string()),
+    ("response", pa.string()),
+    ("sample_id", pa.string()),
+    ("sample_type", pa.string()),
+    ("time_from_treatment_start", pa.int64()),
+])
+
+FREQUENCIES_SCHEMA = pa.schema([
+    ("sample_id", pa.string()),
+    ("subject_id", pa.string()),
+    ("condition", pa.string()),
+    ("age", pa.int64()),
+    ("sex", pa.string()),
+    ("treatment_id", pa.string()),
+    ("response", pa.string()),
+    ("sample_type", pa.string()),
+    ("time_from_treatment_start", pa.int64()),
+    ("project_id", pa.string()),
+    ("population", pa.string()),
+    ("count", pa.int64()),
+    ("total_count", pa.int64()),
+    ("relative_frequency", pa.float64()),
+])
+
+# each snapshot table with the query it is exported from
+SNAPSHOT_TABLES = {
+    "samples": (sql_query_sample_metadata, SAMPLES_SCHEMA),
+    "frequencies": (sql_query_rich_frequencies, FREQUENCIES_SCHEMA),
+}
+
+
+def record_batches(cursor, schema, batch_size=SNAPSHOT_BATCH_SIZE):
+    """Yield the cursor's rows as Arrow record batches of schema, batch_size rows at a time."""
+    while rows := cursor.fetchmany(batch_size):
+        columns = zip(*rows)
+        yield pa.RecordBatch.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                                         schema=schema)
+
+
+def export_table(conn, table, out_dir, formats, batch_size=SNAPSHOT_BATCH_SIZE):
+    """
+    Stream one table out of SQLite in a single pass: each batch is appended to the Arrow IPC file on its way
+    into the Parquet dataset (for whichever of the two formats are wanted), so only a batch or two is held
+    in memory at a time. Returns the number of rows written.
+    """
+    sql, schema = SNAPSHOT_TABLES[table]
+    batches = record_batches(conn.execute(sql), schema, batch_size)
+    writer = pa.ipc.new_file(str(out_dir / f"{table}.arrow"), schema) if "arrow" in formats else None
+    rows = 0
+
+    def written():
+        nonlocal rows
+        for batch in batches:
+            rows += batch.num_rows
+            if writer is not None:
+                writer.write_batch(batch)
+            yield batch
+
+    try:
+        if "parquet" in formats:
+            # an empty table still gets its (empty) dataset directory
+            (out_dir / table).mkdir()
+            ds.write_dataset(written(), out_dir / table, schema=schema, format="parquet", partitioning=PARTITIONING,
+                             max_rows_per_group=batch_size, existing_data_behavior="overwrite_or_ignore")
+        else:
+            for _ in written():
+                pass
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+def export_snapshot(out_dir=None, db_path=None, formats=("arrow", "parquet"), batch_size=SNAPSHOT_BATCH_SIZE):
+    """
+    Export the joined samples table and the rich frequencies table as a columnar snapshot in out_dir:
+    <table>.arrow, an uncompressed Arrow IPC file the dashboard can memory-map, and <table>/, a Parquet dataset
+    partitioned by project. Everything is written to a temporary directory first and then moved into place,
+    so files a reader has mapped are replaced rather than overwritten.
+    Returns the manifest written alongside: when and from where the snapshot was taken, and its row counts.
+    """
+    out_dir = Path(out_dir or SNAPSHOT_DIR)
+    db_path = Path(db_path or DB_PATH).resolve()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+
+    tmp_dir = Path(tempfile.mkdtemp(prefix=f".{out_dir.name}.", dir=out_dir.parent))
+    try:
+        # one read transaction, so both tables come from the same state of the database
+        # write_dataset() pulls batches from a thread of its own, one at a time
+        conn = sqlite3.connect(f"{db_path.as_uri()}?mode=ro", uri=True, check_same_thread=False)
+        try:
+            conn.execute("BEGIN")
+            rows = {table: export_table(conn, table, tmp_dir, formats, batch_size) for table in SNAPSHOT_TABLES}
+        finally:
+            conn.close()
+
+        manifest = {
+            "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "source": str(db_path),
+            "formats": list(formats),
+            "rows": rows,
+            "seconds": time.perf_counter() - start,
+        }
+        (tmp_dir / MANIFEST).write_text(json.dumps(manifest, indent=2))
+
+        for table in SNAPSHOT_TABLES:
+            shutil.rmtree(out_dir / table, ignore_errors=True)
+            (out_dir / f"{table}.arrow").unlink(missing_ok=True)
+        # the manifest goes last, since readers take a new manifest to mean a new snapshot
+        for path in sorted(tmp_dir.iterdir(), key=lambda path: path.name == MANIFEST):
+            os.replace(path, out_dir / path.name)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return manifest
+
+
+def read_manifest(snapshot_dir=None):
+    """The snapshot's manifest, or None if there's no snapshot in snapshot_dir."""
+    path = Path(snapshot_dir or SNAPSHOT_DIR) / MANIFEST
+    try:
+        return json.loads(path.read_text())
+    except FileNotFoundError:
+        return None
+
+
+def read_snapshot(table, snapshot_dir=None, columns=None):
+    """
+    One snapshot table as an Arrow table. The Arrow IPC file is memory-mapped, so this doesn't copy it into memory:
+    pages are read in by the OS as columns are used, and shared between processes reading the same snapshot.
+    Snapshots without one are read from the Parquet dataset instead.
+    """
+    snapshot_dir = Path(snapshot_dir or SNAPSHOT_DIR)
+    path = snapshot_dir / f"{table}.arrow"
+    if path.exists():
+        arrow_table = pa.ipc.open_file(pa.memory_map(str(path))).read_all()
+        return arrow_table.select(columns) if columns is not None else arrow_table
+    schema = SNAPSHOT_TABLES[table][1]
+    dataset = ds.dataset(snapshot_dir / table, schema=schema, format="parquet", partitioning=PARTITIONING)
+    return dataset.to_table(columns=columns)
+
+
+def snapshot_version(snapshot_dir=None):
+    """Like utils.data_version(), a token that changes when the snapshot is replaced."""
+    try:
+        stat = (Path(snapshot_dir or SNAPSHOT_DIR) / MANIFEST).stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
+
+
+_frame_cache = QueryCache()
+
+
+def snapshot_frame(table, columns, filter_model=None, filters=(), snapshot_dir=None):
+    """
+    The columns of a snapshot table, filtered by an AgGrid filter model on the filters columns (see
+    filters.filter_expression), as a DataFrame. Filtering runs on the memory-mapped Arrow columns, so only
+    the matching rows are copied into pandas. Results are cached until the snapshot is replaced.
+    """
+    snapshot_dir = Path(snapshot_dir or SNAPSHOT_DIR)
+    key = (table, tuple(columns), json.dumps(filter_model or {}, sort_keys=True), str(snapshot_dir))
+    version = snapshot_version(snapshot_dir)
+    df = _frame_cache.get(key, version)
+    if df is None:
+        expression = filter_expression(filter_model, filters)
+        # only the columns shown or filtered on are read, and filtered before any are copied
+        filtered_columns = [name for name in (filter_model or {}) if name not in columns]
+        arrow_table = read_snapshot(table, snapshot_dir, [*columns, *filtered_columns])
+        if expression is not None:
+            arrow_table = arrow_table.filter(expression)
+        df = arrow_table.select(columns).to_pandas()
+        _frame_cache.put(key, version, df)
+    return df.copy()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export the samples and frequencies tables as an Arrow/Parquet snapshot. "
+                    "Load one back with `python scripts/load_data.py --snapshot <dir>`.")
+    parser.add_argument('out_dir', nargs='?', type=Path, default=SNAPSHOT_DIR,
+                        help="directory to write the snapshot to (default: %(default)s)")
+    parser.add_argument('--db', type=Path, default=DB_PATH, help="database to export (default: %(default)s)")
+    parser.add_argument('--format', nargs='+', choices=["arrow", "parquet"], default=["arrow", "parquet"],
+                        dest='formats', help="formats to write (default: both)")
+    parser.add_argument('--batch-size', type=int, default=SNAPSHOT_BATCH_SIZE,
+                        help="rows per record batch (default: %(default)s)")
+    args = parser.parse_args()
+
+    manifest = export_snapshot(args.out_dir, args.db, args.formats, args.batch_size)
+    rows = ", ".join(f"{count:,} {table}" for table, count in manifest["rows"].items())
+    print(f"Snapshot of {manifest['source']} written to {args.out_dir} ({rows}) in {manifest['seconds']:.2f}s.")
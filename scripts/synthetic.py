@@ -0,0 +1,88 @@
+import argparse
+from pathlib import Path
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from scripts.utils import CELL_TYPES  # noqa: E402
+
+CONDITIONS = ['melanoma', 'lung', 'healthy']
+TREATMENTS = ['tr1', 'tr2']
+SAMPLE_TYPES = ['PBMC', 'tumor']
+# days between a subject's samples, the first taken at treatment start
+SAMPLE_INTERVAL = 7
+
+# responders' share of each cell type is scaled by up to this much either way, so the tests have something to find
+RESPONSE_EFFECT = 0.2
+
+
+def synthetic_cell_types(n_cell_types):
+    """CELL_TYPES, then made-up populations (population_6, ...) if more are asked for."""
+    return [*CELL_TYPES, *(f"population_{i}" for i in range(len(CELL_TYPES) + 1, n_cell_types + 1))][:n_cell_types]
+
+
+def generate_cell_counts(n_projects=3, n_subjects=1_000, samples_per_subject=3, n_cell_types=len(CELL_TYPES),
+                         seed=0):
+    """
+    A cell-count.csv-shaped frame of made-up samples: n_subjects subjects spread over n_projects projects, each with
+    samples_per_subject samples, and a count column for each of n_cell_types cell types (see synthetic_cell_types).
+    Healthy subjects get no treatment, response or time from treatment start, as in the real data, and
+    responders' cell type proportions are shifted from non-responders'. The same arguments give the same frame.
+    """
+    rng = np.random.default_rng(seed)
+    n_samples = n_subjects * samples_per_subject
+    cell_types = synthetic_cell_types(n_cell_types)
+
+    condition = rng.choice(len(CONDITIONS), n_subjects, p=[0.5, 0.3, 0.2])
+    healthy = np.array(CONDITIONS)[condition] == 'healthy'
+    responder = rng.random(n_subjects) < 0.5
+    subjects = pd.DataFrame({
+        'project': pd.Categorical.from_codes(rng.integers(0, n_projects, n_subjects),
+                                             [f"prj{i}" for i in range(1, n_projects + 1)]),
+        'subject': [f"sbj{i}" for i in range(1, n_subjects + 1)],
+        'condition': pd.Categorical.from_codes(condition, CONDITIONS),
+        'age': rng.integers(30, 81, n_subjects),
+        'sex': pd.Categorical.from_codes(rng.integers(0, 2, n_subjects), ['F', 'M']),
+        'treatment': np.where(healthy, 'none', np.array(TREATMENTS)[rng.integers(0, len(TREATMENTS), n_subjects)]),
+        'response': pd.array(np.where(healthy, None, np.where(responder, 'y', 'n')), dtype=object),
+    })
+
+    # each subject's samples are consecutive rows, a week apart
+    df = subjects.iloc[np.repeat(np.arange(n_subjects), samples_per_subject)].reset_index(drop=True)
+    timepoint = np.tile(np.arange(samples_per_subject), n_subjects)
+    df['sample'] = [f"s{i}" for i in range(1, n_samples + 1)]
+    df['sample_type'] = pd.Categorical.from_codes((rng.random(n_samples) < 0.05).astype(int), SAMPLE_TYPES)
+    df['time_from_treatment_start'] = pd.array(
+        np.where(np.repeat(healthy, samples_per_subject), None, SAMPLE_INTERVAL * timepoint), dtype='Int64')
+
+    # each sample's total split across cell types around a shared set of proportions
+    proportions = rng.dirichlet(np.full(n_cell_types, 2.0))
+    effect = 1 + rng.uniform(-RESPONSE_EFFECT, RESPONSE_EFFECT, n_cell_types)
+    sample_proportions = rng.dirichlet(proportions * 50, n_samples)
+    sample_proportions[np.repeat(responder & ~healthy, samples_per_subject)] *= effect
+    sample_proportions /= sample_proportions.sum(axis=1, keepdims=True)
+    totals = rng.lognormal(np.log(100_000), 0.3, n_samples)
+    counts = rng.poisson(sample_proportions * totals[:, None])
+    for i, cell_type in enumerate(cell_types):
+        df[cell_type] = counts[:, i]
+    return df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic cell-count CSV, e.g. to benchmark or test "
+                                                 "the loader and dashboard at scale.")
+    parser.add_argument('out', type=Path, help="CSV file to write")
+    parser.add_argument('--projects', type=int, default=3, help="number of projects (default: %(default)s)")
+    parser.add_argument('--subjects', type=int, default=1_000, help="number of subjects (default: %(default)s)")
+    parser.add_argument('--samples-per-subject', type=int, default=3,
+                        help="samples taken from each subject (default: %(default)s)")
+    parser.add_argument('--cell-types', type=int, default=len(CELL_TYPES),
+                        help="count columns per sample (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0, help="random seed (default: %(default)s)")
+    args = parser.parse_args()
+
+    df = generate_cell_counts(args.projects, args.subjects, args.samples_per_subject, args.cell_types, args.seed)
+    df.to_csv(args.out, index=False)
+    print(f"Wrote {len(df):,} samples from {args.subjects:,} subjects to {args.out}.")
@@ -1,23 +1,452 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import os
 from pathlib import Path
+import shutil
 import sqlite3
+import tempfile
+import threading
+import time
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
+from scripts.profiling import current_run, record_query, trace_statement
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 DB_PATH = BASE_DIR / "data" / "sample_data.sqlite"
 CELL_COUNT_CSV = BASE_DIR / "data" / "cell-count.csv"
+# where columnar snapshots are written (see snapshot.py), and where the dashboard looks for one
+SNAPSHOT_DIR = Path(os.environ.get("LOBLAW_SNAPSHOT_DIR", BASE_DIR / "data" / "snapshot"))
 CELL_TYPES = ['b_cell', 'cd8_t_cell', 'cd4_t_cell', 'nk_cell', 'monocyte']
 
+# prefix of the machine-readable progress lines load_data.py prints with --progress
+PROGRESS_PREFIX = "PROGRESS"
 
-def get_connection():
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("PRAGMA foreign_keys = ON")
+# max pooled read-only connections; writes share a single connection, since SQLite allows one writer at a time
+POOL_SIZE = int(os.environ.get("LOBLAW_POOL_SIZE", 4))
+
+# max query_df results kept in memory, least recently used evicted first
+QUERY_CACHE_SIZE = int(os.environ.get("LOBLAW_QUERY_CACHE_SIZE", 32))
+
+# rows fetched per fetchmany() by query_df() and iter_query()
+FETCH_SIZE = int(os.environ.get("LOBLAW_FETCH_SIZE", 50_000))
+
+# dtypes of query result columns, by column name, so results aren't left as Python objects:
+# - "category" for columns with a handful of distinct values
+# - "string[pyarrow]" for IDs, stored as Arrow buffers rather than one Python string per row
+# - "int32" or "int64" for integers at least that wide, int32 widening to int64 if a value doesn't fit (nullable
+#   if there are NULLs); counts are int64, since they're summed and scaled, where narrower types would wrap
+# columns not listed get whatever pandas infers
+RESULT_DTYPES = {
+    "project_id": "category",
+    "condition": "category",
+    "sex": "category",
+    "treatment_id": "category",
+    "response": "category",
+    "sample_type": "category",
+    "cell_type": "category",
+    "population": "category",
+    "subject_id": "string[pyarrow]",
+    "sample_id": "string[pyarrow]",
+    "age": "int32",
+    "time_from_treatment_start": "int32",
+    "count": "int64",
+    "total_count": "int64",
+}
+
+# applied once when a connection is opened
+CONNECTION_PRAGMAS = (
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA cache_size = -65536",
+)
+
+
+def get_connection(db_path=None):
+    """A new, unpooled connection, e.g. for the loader. The dashboard should use connection() instead."""
+    conn = sqlite3.connect(db_path or DB_PATH)
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
 
-def query_df(query):
-    conn = get_connection()
-    cursor = conn.execute(query)
-    return pd.DataFrame(cursor.fetchall(), columns=[desc[0] for desc in cursor.description])
+class ConnectionPool:
+    """
+    Reusable SQLite connections, safe to share across Streamlit's session threads.
+    Each connection is handed to one thread at a time; read-only connections are kept
+    separate from the (single) write connection, which also switches the database to WAL
+    so readers don't block on writes.
+    """
+
+    def __init__(self, db_path=None, size=POOL_SIZE):
+        self.db_path = Path(db_path or DB_PATH).resolve()
+        self.size = size
+        self._idle = {True: [], False: []}  # keyed by read_only
+        self._opened = {True: 0, False: 0}
+        self._file_ids = {}  # connection -> identity of the file it opened
+        self._in_use = 0
+        self._swapping = False
+        self._cond = threading.Condition()
+
+    def _limit(self, read_only):
+        return self.size if read_only else 1
+
+    def _file_id(self):
+        try:
+            stat = self.db_path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_dev, stat.st_ino
+
+    def _discard(self, conn, read_only):
+        conn.close()
+        self._opened[read_only] -= 1
+        self._file_ids.pop(conn, None)
+
+    def _connect(self, read_only):
+        if read_only:
+            conn = sqlite3.connect(f"{self.db_path.as_uri()}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode = WAL")
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self, read_only=False):
+        """Check out a connection, waiting if all are in use or the database is being swapped."""
+        with self._cond:
+            while True:
+                # the file was swapped by another process; don't hand out connections to the old one
+                file_id = self._file_id()
+                idle = self._idle[read_only]
+                for conn in [conn for conn in idle if self._file_ids[conn] != file_id]:
+                    idle.remove(conn)
+                    self._discard(conn, read_only)
+                if not self._swapping and (idle or self._opened[read_only] < self._limit(read_only)):
+                    break
+                self._cond.wait()
+            self._in_use += 1
+            if idle:
+                return idle.pop()
+            self._opened[read_only] += 1
+
+        try:
+            conn = self._connect(read_only)
+            with self._cond:
+                self._file_ids[conn] = file_id
+            return conn
+        except Exception:
+            with self._cond:
+                self._opened[read_only] -= 1
+                self._in_use -= 1
+                self._cond.notify_all()
+            raise
+
+    def release(self, conn, read_only=False):
+        with self._cond:
+            if self._file_ids[conn] == self._file_id():
+                self._idle[read_only].append(conn)
+            else:
+                self._discard(conn, read_only)
+            self._in_use -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def connection(self, read_only=False):
+        """
+        Borrow a connection for the duration of a with block.
+        Write connections commit when the block exits normally and roll back on an exception, and invalidate
+        cached query results if anything was written.
+        """
+        conn = self.acquire(read_only)
+        # counts statements for the profiler (see scripts.profiling), only while a run is being profiled
+        profiled = current_run() is not None
+        if profiled:
+            conn.set_trace_callback(trace_statement)
+        try:
+            if read_only:
+                yield conn
+            else:
+                changes = conn.total_changes
+                try:
+                    with conn:
+                        yield conn
+                finally:
+                    # a block that wrote nothing leaves cached results (and data_version()) alone
+                    if conn.total_changes != changes:
+                        notify_write()
+        finally:
+            if profiled:
+                conn.set_trace_callback(None)
+            self.release(conn, read_only)
+
+    def _close_idle(self):
+        for read_only, idle in self._idle.items():
+            for conn in idle:
+                self._discard(conn, read_only)
+            idle.clear()
+
+    def close(self):
+        with self._cond:
+            self._close_idle()
+
+    def replace_database(self, new_path):
+        """
+        Atomically swap new_path in as the database file.
+        Waits for in-flight queries on the old database, closes every pooled connection so its
+        WAL can be folded back in, then renames; connections reopen lazily on the new file.
+        """
+        with self._cond:
+            self._swapping = True
+            try:
+                while self._in_use:
+                    self._cond.wait()
+                self._close_idle()
+                replace_database_file(new_path, self.db_path)
+            finally:
+                self._swapping = False
+                self._cond.notify_all()
+                notify_write()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool()
+        return _pool
+
+
+def connection(read_only=False):
+    """Borrow a pooled connection: `with connection() as conn: ...`"""
+    return get_pool().connection(read_only)
+
+
+def make_temp_db_path(db_path=None):
+    """An empty temporary file next to db_path, on the same filesystem so it can be renamed over it."""
+    db_path = Path(db_path or DB_PATH)
+    fd, tmp_path = tempfile.mkstemp(prefix=f"{db_path.name}.", suffix=".tmp", dir=db_path.parent)
+    os.close(fd)
+    return Path(tmp_path)
+
+
+def replace_database_file(new_path, db_path=None):
+    """
+    Rename new_path over db_path. The old database is first taken out of WAL mode, which
+    removes its -wal/-shm files so they can't be mistaken for the new database's.
+    That needs exclusive access, so this fails (discarding new_path) while other processes have
+    the old database open.
+    """
+    db_path = Path(db_path or DB_PATH)
+    if db_path.exists():
+        conn = sqlite3.connect(db_path)
+        try:
+            conn.execute("PRAGMA busy_timeout = 5000")
+            conn.execute("PRAGMA journal_mode = DELETE")
+        except sqlite3.OperationalError as e:
+            Path(new_path).unlink(missing_ok=True)
+            raise RuntimeError(f"{db_path} is in use by another process; "
+                               "rebuild from the dashboard or stop it first") from e
+        finally:
+            conn.close()
+        shutil.copymode(db_path, new_path)
+    os.replace(new_path, db_path)
+
+
+def replace_database(new_path):
+    """Swap new_path in as DB_PATH, going through the pool if this process has one."""
+    if _pool is not None:
+        _pool.replace_database(new_path)
+    else:
+        replace_database_file(new_path)
+
+
+_write_generation = 0
+
+
+def notify_write():
+    """Mark the database as changed by this process, invalidating cached query results."""
+    global _write_generation
+    _write_generation += 1
+
+
+def data_version(db_path=None):
+    """
+    A token that changes whenever the database may have changed: on writes made by this process,
+    and, for other processes (e.g. the loader), when the database or its WAL file is modified or
+    replaced. Checking it costs a couple of stat() calls and no SQL.
+    """
+    db_path = Path(db_path or DB_PATH)
+    files = []
+    for path in (db_path, db_path.with_name(db_path.name + "-wal")):
+        try:
+            stat = path.stat()
+            files.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            files.append(None)
+    return _write_generation, tuple(files)
+
+
+class QueryCache:
+    """LRU cache of query results, keyed on SQL text and parameters and dropped whenever data_version() changes."""
+
+    def __init__(self, max_entries=QUERY_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._results = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            if version != self._version:
+                self._results.clear()
+                self._version = version
+                return None
+            result = self._results.get(key)
+            if result is not None:
+                self._results.move_to_end(key)
+            return result
+
+    def put(self, key, version, result):
+        with self._lock:
+            if version != self._version:
+                return
+            self._results[key] = result
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+
+_query_cache = QueryCache()
+
+# the integer types each RESULT_DTYPES integer kind can end up as, narrowest first
+INTEGER_DTYPES = {"int32": [np.int32, np.int64], "int64": [np.int64]}
+
+
+def compact_integers(values, dtypes=INTEGER_DTYPES["int32"]):
+    """A nullable Int64 array in the first of dtypes that holds it; NumPy's if it has no NULLs."""
+    valid = values[~values.isna()]
+    if not len(valid):
+        return values
+    low, high = int(valid.min()), int(valid.max())
+    dtype = next(dtype for dtype in dtypes if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max)
+    if len(valid) < len(values):
+        return values.astype(pd.api.types.pandas_dtype(np.dtype(dtype).name.capitalize()))
+    return values.to_numpy(dtype=dtype)
+
+
+def typed_column(name, values):
+    """One column of fetched rows (a tuple of Python values) as an array of its RESULT_DTYPES dtype."""
+    dtype = RESULT_DTYPES.get(name)
+    if dtype == "category":
+        return pd.Categorical(values)
+    if dtype in INTEGER_DTYPES:
+        return pd.array(values, dtype="Int64")
+    if dtype is not None:
+        return pd.array(values, dtype=dtype)
+    return pd.Series(values, dtype=None if values else object).array
+
+
+def typed_frame(rows, columns):
+    """
+    Fetched rows as a DataFrame, converting them a column at a time straight into typed arrays.
+    Integer columns are left as Int64 here; combine_frames() narrows them once every chunk is in.
+    """
+    values = list(zip(*rows)) if rows else [()] * len(columns)
+    return pd.DataFrame({name: typed_column(name, column) for name, column in zip(columns, values)}, columns=columns)
+
+
+def combine_frames(frames, columns):
+    """Chunks from typed_frame() as one DataFrame, with categories merged and integers narrowed."""
+    if not frames:
+        return typed_frame([], columns).pipe(narrow_integers)
+    data = {}
+    for name in columns:
+        parts = [frame[name] for frame in frames]
+        if RESULT_DTYPES.get(name) == "category":
+            data[name] = union_categoricals([part.array for part in parts])
+        else:
+            data[name] = pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0]
+    return narrow_integers(pd.DataFrame(data, columns=columns))
+
+
+def narrow_integers(df):
+    for name in df.columns:
+        if RESULT_DTYPES.get(name) in INTEGER_DTYPES:
+            df[name] = compact_integers(df[name].array, INTEGER_DTYPES[RESULT_DTYPES[name]])
+    return df
+
+
+def typed_frames(cursor, columns, chunksize):
+    while rows := cursor.fetchmany(chunksize):
+        yield typed_frame(rows, columns)
+
+
+def iter_query(query, params=None, chunksize=FETCH_SIZE):
+    """
+    Run a SELECT and yield its result chunksize rows at a time, as DataFrames typed like query_df()'s
+    (except that integer columns stay Int64, since later chunks may not fit a narrower type).
+    For consumers that can process a result incrementally, so only one chunk is ever in memory.
+    Not cached, and holds a pooled connection until the iteration ends (or the generator is closed).
+    """
+    start = time.perf_counter()
+    rows = 0
+    try:
+        with connection(read_only=True) as conn:
+            cursor = conn.execute(query, params or ())
+            for frame in typed_frames(cursor, [desc[0] for desc in cursor.description], chunksize):
+                rows += len(frame)
+                yield frame
+    finally:
+        # includes the time the consumer spent on each chunk
+        record_query(query, params, time.perf_counter() - start, rows)
+
+
+def fetch_df(conn, query, params=None):
+    """query_df() on a connection of the caller's, e.g. one to another database, without the cache."""
+    start = time.perf_counter()
+    cursor = conn.execute(query, params or ())
+    columns = [desc[0] for desc in cursor.description]
+    frames = []
+    convert_seconds = 0.0
+    while rows := cursor.fetchmany(FETCH_SIZE):
+        convert_start = time.perf_counter()
+        frames.append(typed_frame(rows, columns))
+        convert_seconds += time.perf_counter() - convert_start
+    df = combine_frames(frames, columns)
+    record_query(query, params, time.perf_counter() - start, len(df), convert_seconds)
+    return df
+
+
+def query_df(query, params=None):
+    """
+    Run a SELECT and return the result as a DataFrame.
+    Rows are fetched and converted FETCH_SIZE at a time into the dtypes in RESULT_DTYPES, so the whole
+    result never exists as Python tuples and low-cardinality strings are stored once per distinct value.
+    Results are cached until the database changes, so reruns that don't touch data don't touch SQL either.
+    """
+    key = (query, tuple(params or ()))
+    version = data_version()
+    start = time.perf_counter()
+    df = _query_cache.get(key, version)
+    if df is not None:
+        record_query(query, params, time.perf_counter() - start, len(df), cached=True)
+    else:
+        with connection(read_only=True) as conn:
+            df = fetch_df(conn, query, params)
+        _query_cache.put(key, version, df)
+    # callers are free to modify what they get back
+    return df.copy()
 
 
 def run_sql(query, params=None):
@@ -29,14 +458,16 @@ def run_sql(query, params=None):
     if params is None:
         params = ()
 
-    with get_connection() as conn:
-        conn.row_factory = sqlite3.Row
+    is_select = query.strip().upper().startswith("SELECT")
+    start = time.perf_counter()
+    with connection(read_only=is_select) as conn:
         cur = conn.cursor()
+        cur.row_factory = sqlite3.Row
         cur.execute(query, params)
 
-        if query.strip().upper().startswith("SELECT"):
-            results = cur.fetchall()
-            return [dict(row) for row in results]
+        if is_select:
+            results = [dict(row) for row in cur.fetchall()]
         else:
-            conn.commit()
-            return None
+            results = None
+    record_query(query, params, time.perf_counter() - start, len(results) if is_select else cur.rowcount)
+    return results